@@ -0,0 +1,183 @@
+import os
+import sys
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from FeatureMatrix import DELETED_ID, top_k
+
+def lb_keogh(query, candidates, band):
+    """
+    Squared LB_Keogh lower bound of each candidate against the query.
+
+    The envelope is taken over the candidates, zero-extended at both ends, so the bound holds
+    for banded DTW and for any time shift of up to band frames.
+
+    Args:
+        query (numpy.ndarray): (n_frames, n_bands) query.
+        candidates (numpy.ndarray): (num_candidates, n_frames, n_bands) candidates.
+        band (int): Maximum alignment offset in frames.
+    """
+    upper = maximum_filter1d(candidates, 2 * band + 1, axis=1, mode='constant', cval=0)
+    lower = minimum_filter1d(candidates, 2 * band + 1, axis=1, mode='constant', cval=0)
+    excess = np.maximum(query - upper, 0) + np.maximum(lower - query, 0)
+    return np.einsum('ijk,ijk->i', excess, excess)
+
+def dtw_distances(query, candidates, band):
+    """
+    Squared-Euclidean DTW cost of each candidate against the query, within a Sakoe-Chiba band.
+
+    Only the 2 * band + 1 cells around the diagonal are kept per row, indexed k for column
+    j = i + k - band. Each row is one vectorised step over all candidates: diagonal and
+    vertical moves come from the previous row, and horizontal moves are resolved with a
+    cumulative-sum / running-minimum scan instead of a loop over the band.
+    """
+    num_candidates, n_frames, _ = candidates.shape
+    width = 2 * band + 1
+    offsets = np.arange(-band, band + 1)
+    previous = np.full((num_candidates, width), np.inf)
+
+    for i in range(n_frames):
+        columns = i + offsets
+        valid = (columns >= 0) & (columns < n_frames)
+        cost = np.zeros((num_candidates, width))
+        difference = candidates[:, columns[valid], :] - query[i]
+        cost[:, valid] = np.einsum('ijk,ijk->ij', difference, difference)
+
+        if i == 0:
+            # The path starts at (0, 0)
+            from_previous = np.full((num_candidates, width), np.inf)
+            from_previous[:, band] = 0
+        else:
+            vertical = np.concatenate([previous[:, 1:], np.full((num_candidates, 1), np.inf)], axis=1)
+            from_previous = np.minimum(previous, vertical)
+        from_previous[:, ~valid] = np.inf
+
+        # current[k] = min over m <= k of (from_previous[m] + cost[m] + ... + cost[k])
+        cumulative = np.cumsum(cost, axis=1)
+        before = np.concatenate([np.zeros((num_candidates, 1)), cumulative[:, :-1]], axis=1)
+        current = cumulative + np.minimum.accumulate(from_previous - before, axis=1)
+        current[:, ~valid] = np.inf
+        previous = current
+
+    return previous[:, band]
+
+def shift_distances(query, candidates, band):
+    """
+    Smallest squared Euclidean distance between the query and each candidate shifted by up to band frames.
+
+    Correlations at every shift come from one FFT per candidate. Frames shifted past either
+    end are dropped from the candidate and the query is compared against zeros there.
+    """
+    num_candidates, n_frames, _ = candidates.shape
+    size = next_fast_len(2 * n_frames)
+    correlation = irfft(
+        (rfft(candidates, size, axis=1) * np.conj(rfft(query, size, axis=0))).sum(axis=2),
+        size, axis=1
+    )
+
+    # Shifting by n_frames or more leaves no overlap, so larger shifts add nothing
+    limit = min(band, n_frames)
+    shifts = np.arange(-limit, limit + 1)
+    # Candidate frames still inside the window after shifting by s are [max(0, s), min(n_frames, n_frames + s))
+    frame_energy = np.concatenate([np.zeros((num_candidates, 1)), np.cumsum(np.einsum('ijk,ijk->ij', candidates, candidates), axis=1)], axis=1)
+    kept_energy = frame_energy[:, np.minimum(n_frames, n_frames + shifts)] - frame_energy[:, np.maximum(0, shifts)]
+
+    distances = np.einsum('ij,ij->', query, query) + kept_energy - 2 * correlation[:, shifts % size]
+    return np.maximum(distances.min(axis=1), 0)
+
+class AlignedSearch:
+    """
+    Time-shift tolerant search over a FeatureMatrix.
+
+    method='dtw' ranks by banded dynamic time warping, method='xcorr' by the best offset of up to
+    band frames. Candidates pass through a cascade: LB_Keogh against every row, scanned in chunks;
+    for DTW, the reverse LB_Keogh against the query envelope; then the exact distance, in
+    vectorised batches taken in lower-bound order until no remaining bound can beat the k-th best.
+    """
+
+    def __init__(self, matrix, method='dtw', band=config.ALIGN_BAND, batch_size=config.ALIGN_BATCH_SIZE):
+        if method not in ('dtw', 'xcorr'):
+            raise ValueError(f"Unknown alignment method: {method}")
+        self.matrix = matrix
+        self.method = method
+        self.band = band
+        self.batch_size = batch_size
+        self.stats = {}
+
+    def _candidates(self, rows):
+        n_frames, n_bands = self.matrix.shape
+        return np.asarray(self.matrix.matrix()[rows], dtype=np.float64).reshape(len(rows), n_frames, n_bands)
+
+    def lower_bounds(self, query, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """First-stage LB_Keogh of every stored row, with deleted rows at infinity."""
+        n_frames, n_bands = self.matrix.shape
+        matrix = self.matrix.matrix()
+        bounds = np.empty(self.matrix.rows)
+        for start in range(0, self.matrix.rows, chunk_rows):
+            chunk = np.asarray(matrix[start:start + chunk_rows], dtype=np.float64).reshape(-1, n_frames, n_bands)
+            bounds[start:start + len(chunk)] = lb_keogh(query, chunk, self.band)
+        bounds[np.array(self.matrix.ids()) == DELETED_ID] = np.inf
+        return bounds
+
+    def search(self, target_spectrogram, num_matches=config.NUM_MATCHES):
+        """
+        Find the stored spectrograms closest to the target allowing for misalignment in time.
+
+        Returns:
+            tuple: (record ids, distances) of the closest matches, nearest first.
+        """
+        n_frames, n_bands = self.matrix.shape
+        query = self.matrix.query_vector(target_spectrogram).reshape(n_frames, n_bands).astype(np.float64)
+        ids = np.array(self.matrix.ids())
+
+        bounds = self.lower_bounds(query)
+        order = np.argsort(bounds, kind='stable')
+        order = order[np.isfinite(bounds[order])]
+
+        best_rows = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0)
+        exact = 0
+        position = 0
+
+        while position < len(order):
+            threshold = best_distances[-1] if len(best_distances) >= num_matches else np.inf
+            if bounds[order[position]] >= threshold:
+                break
+            rows = order[position:position + self.batch_size]
+            position += len(rows)
+            rows = np.sort(rows[bounds[rows] < threshold])
+            candidates = self._candidates(rows)
+
+            if self.method == 'dtw':
+                # Reverse LB_Keogh: each candidate against the query's envelope
+                keep = self._reverse_bounds(query, candidates) < threshold
+                rows, candidates = rows[keep], candidates[keep]
+                distances = dtw_distances(query, candidates, self.band)
+            else:
+                distances = shift_distances(query, candidates, self.band)
+            exact += len(rows)
+
+            best_rows = np.concatenate([best_rows, rows])
+            best_distances = np.concatenate([best_distances, distances])
+            closest = top_k(best_distances, num_matches)
+            best_rows, best_distances = best_rows[closest], best_distances[closest]
+
+        self.stats = {
+            'candidates': len(order),
+            'exact': exact,
+            'pruned_fraction': 1 - exact / len(order) if len(order) else 0.0,
+        }
+        print(f"Aligned search ({self.method}): exact distance for {exact} of {len(order)} candidates")
+        return ids[best_rows], np.sqrt(best_distances)
+
+    def _reverse_bounds(self, query, candidates):
+        """Squared LB_Keogh of each candidate against the query's envelope; valid for DTW only."""
+        upper = maximum_filter1d(query, 2 * self.band + 1, axis=0, mode='nearest')
+        lower = minimum_filter1d(query, 2 * self.band + 1, axis=0, mode='nearest')
+        excess = np.maximum(candidates - upper, 0) + np.maximum(lower - candidates, 0)
+        return np.einsum('ijk,ijk->i', excess, excess)
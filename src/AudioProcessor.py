@@ -1,44 +1,52 @@
 import os
 import numpy as np
-import soundfile as sf
-import librosa
-from scipy.fft import fft, fftfreq
+from scipy.fft import dct
+
+from Config import config
+from FeaturePlan import get_fft_plan, get_feature_plan
+from Metrics import metrics, timed
+from WavReader import open_audio, probe_audio
 
 class AudioProcessor:
-    def __init__(self, window_length=1024, step_size=512, n_filters=24):
+    def __init__(self, window_length=1024, step_size=512, n_filters=24, dtype=np.float64):
         self.window_length = window_length
         self.step_size = step_size
         self.n_filters = n_filters
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def feature_config(self):
+        """Identifies the settings that shaped a stored spectrogram."""
+        return f"window_length={self.window_length};step_size={self.step_size};n_filters={self.n_filters}"
+
+    def feature_plan(self, samplerate):
+        """Shared, memoized window and Mel projection for this processor's settings."""
+        return get_feature_plan(samplerate, self.window_length, self.step_size, self.n_filters)
+
+    def fft_plan(self, samplerate):
+        """Shared, memoized window for this processor's settings, without the Mel projection."""
+        return get_fft_plan(samplerate, self.window_length, self.step_size)
 
     def load_wav(self, filename):
         """Load WAV file."""
-        data, samplerate = sf.read(filename)
-        return data, samplerate
+        with open_audio(filename) as reader:
+            return reader.read(), reader.samplerate
+
+    @staticmethod
+    def probe_wav(filename):
+        """Sample rate, channels, length in frames and subtype of a WAV file, without decoding it."""
+        return probe_audio(filename)
 
     def perform_fft(self, data, samplerate):
         """Perform FFT on data with specified window length and step size."""
-        N = len(data)
-        T = 1.0 / samplerate
-        num_windows = (N - self.window_length) // self.step_size + 1
-        xf = fftfreq(self.window_length, T)[:self.window_length // 2]
-
-        fft_results = np.zeros((num_windows, self.window_length // 2))
-        for i in range(num_windows):
-            start = i * self.step_size
-            end = start + self.window_length
-            if end > N:
-                break
-            segment = data[start:end]
-            windowed_segment = segment * np.hanning(self.window_length)
-            fft_result = fft(windowed_segment)
-            fft_results[i] = 2.0 / self.window_length * np.abs(fft_result[:self.window_length // 2])
-        
-        return xf, fft_results
+        plan = self.fft_plan(samplerate)
+        frames = plan.frame(np.asarray(data))
+        fft_results = plan.magnitude_spectrum(frames)
+        return plan.frequencies, fft_results.astype(self.dtype, copy=False)
 
     def mel_filterbank(self, samplerate):
         """Generate Mel filterbank."""
-        mel_filters = librosa.filters.mel(sr=samplerate, n_fft=(self.window_length-1), n_mels=(self.n_filters-1))
-        return mel_filters
+        return self.feature_plan(samplerate).mel_filters
 
     def apply_mel_filterbank(self, fft_results, mel_filters):
         """Apply Mel filterbank to FFT results."""
@@ -51,8 +59,8 @@ class AudioProcessor:
         return np.dot(fft_results, mel_filters.T)
 
     def stereo_to_mono(self, input_signal):
-        # Ensure the input is a numpy array
-        input_signal = np.array(input_signal)
+        # Ensure the input is a numpy array, without copying one
+        input_signal = np.asarray(input_signal)
         
         # Check if the signal is stereo
         if input_signal.ndim != 2 or input_signal.shape[1] != 2:
@@ -63,18 +71,101 @@ class AudioProcessor:
         
         return mono_signal
 
-    def wav_file_to_mel_spectrogram(self, filename):
-        """Process a single WAV file to compute Mel spectrograms."""
+    def iter_mel_spectrogram(self, filename, block_size=config.STREAM_BLOCK_SIZE):
+        """
+        Stream a WAV file's Mel spectrogram, one block of frames at a time.
+
+        The file is read block_size samples at a time and mixed down to mono in place; each
+        block is copied into one buffer, allocated up front, after the samples carried over
+        from the last complete window of the previous block. Plain PCM and float WAVs are
+        memory-mapped and converted to float block by block; other formats are decoded by
+        soundfile. Peak memory is set by block_size, not by the length of the file, and the
+        frames are identical to transforming the whole signal at once.
+
+        Yields:
+            numpy.ndarray: (num_windows, n_bands) Mel frames, in order.
+        """
         if not os.path.exists(filename):
             raise FileNotFoundError(f"File not found: {filename}")
 
-        originalData, samplerate = self.load_wav(filename)
+        with open_audio(filename) as reader:
+            plan = self.feature_plan(reader.samplerate)
+            # Whole steps, so a block holds at least one more window than the carry
+            block_size = max(block_size, plan.window_length) // plan.step_size * plan.step_size + plan.step_size
+            # The carry is always shorter than a window, so one buffer holds it and any block
+            buffer = np.empty(plan.window_length + block_size, dtype=np.float64)
+            carried = 0
+            skip = 0
 
-        data = self.stereo_to_mono(originalData)
-        
-        xf, fft_data = self.perform_fft(data, samplerate)
-        mel_filters = self.mel_filterbank(samplerate)
+            blocks = reader.blocks(block_size)
+            while True:
+                with metrics.stage('audio.decode'):
+                    samples = next(blocks, None)
+                if samples is None:
+                    break
+                read = len(samples)
+                # Drop samples a step longer than the window jumped over
+                dropped = min(skip, read)
+                skip -= dropped
+                signal = buffer[:carried + read - dropped]
+                signal[carried:] = samples[dropped:]
+
+                frames = plan.frame(signal)
+                if len(frames):
+                    with metrics.stage('audio.fft'):
+                        fft_results = plan.magnitude_spectrum(frames)
+                    with metrics.stage('audio.mel'):
+                        mel = plan.project_mel(fft_results)
+                    metrics.count('audio.frames', len(frames))
+                    yield mel.astype(self.dtype, copy=False)
+
+                next_start = len(frames) * plan.step_size
+                skip += max(0, next_start - len(signal))
+                carry = signal[next_start:]
+                carried = len(carry)
+                buffer[:carried] = carry
+
+    def wav_file_to_mel_spectrogram(self, filename):
+        """Process a single WAV file to compute Mel spectrograms."""
+        blocks = list(self.iter_mel_spectrogram(filename))
+        metrics.count('audio.files')
+        if not blocks:
+            n_bands = self.feature_plan(self.probe_wav(filename)['samplerate']).mel_filters.shape[0]
+            return np.empty((0, n_bands), dtype=self.dtype)
+        return np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+
+    @staticmethod
+    @timed('audio.embedding')
+    def spectrogram_embedding(mel_spectrogram, n_frames=config.EMBEDDING_FRAMES, n_coefficients=config.EMBEDDING_COEFFICIENTS):
+        """
+        Summarise a Mel spectrogram as a fixed-length vector, whatever its duration.
+
+        The log Mel energies are pooled per band (mean, standard deviation, 10th, 50th and
+        90th percentiles), then resampled to n_frames and compacted across bands by a DCT
+        keeping n_coefficients, which keeps the coarse shape of the sound over time.
+
+        Args:
+            mel_spectrogram (numpy.ndarray): (num_windows, n_bands) spectrogram.
+            n_frames (int): Number of time steps in the resampled envelope.
+            n_coefficients (int): DCT coefficients kept per time step.
+
+        Returns:
+            numpy.ndarray: float32 vector of 5 * n_bands + n_frames * n_coefficients values.
+        """
+        n_bands = mel_spectrogram.shape[1]
+        n_coefficients = min(n_coefficients, n_bands)
+        if mel_spectrogram.shape[0] == 0:
+            return np.zeros(5 * n_bands + n_frames * n_coefficients, dtype=np.float32)
+
+        log_mel = np.log(np.asarray(mel_spectrogram, dtype=np.float64) + 1e-10)
+        statistics = [log_mel.mean(axis=0), log_mel.std(axis=0), *np.percentile(log_mel, [10, 50, 90], axis=0)]
 
-        mel_data = self.apply_mel_filterbank(fft_data, mel_filters)
+        # Linear resample of the time axis to n_frames
+        positions = np.linspace(0, len(log_mel) - 1, n_frames)
+        lower = np.floor(positions).astype(int)
+        upper = np.minimum(lower + 1, len(log_mel) - 1)
+        fraction = (positions - lower)[:, None]
+        envelope = log_mel[lower] * (1 - fraction) + log_mel[upper] * fraction
+        cepstra = dct(envelope, type=2, norm='ortho', axis=1)[:, :n_coefficients]
 
-        return mel_data
+        return np.concatenate([*statistics, cepstra.ravel()]).astype(np.float32)
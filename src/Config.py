@@ -9,12 +9,63 @@ DEFAULT_CONFIG = {
     'FFT_WINDOW_SIZE': 256,
     'FFT_STEP_SIZE': 512,
     'FFT_N_FILTERS': 24,
+    'FEATURE_PLAN_CACHE_SIZE': 8,
+    'STREAM_BLOCK_SIZE': 1 << 18,
     'DB_FILE': 'ffts.sqlite3',
+    'INGEST_WORKERS': 0,
+    'DB_BATCH_SIZE': 500,
+    'SPECTROGRAM_STORAGE_DTYPE': 'float32',
+    'FEATURE_MATRIX_SUFFIX': '.features',
+    'FEATURE_MATRIX_CHUNK_ROWS': 4096,
+    'FEATURE_MATRIX_QUERY_BLOCK': 256,
+    'FEATURE_MATRIX_COMPACT_RATIO': 0.25,
+    'EMBEDDING_MATRIX_SUFFIX': '.embeddings',
+    'EMBEDDING_FRAMES': 16,
+    'EMBEDDING_COEFFICIENTS': 8,
+    'SEARCH_MODE': 'spectrogram',
+    'SEARCH_INDEX': 'brute',
+    'SEARCH_INDEX_REBUILD_RATIO': 0.2,
+    'TREE_LEAF_SIZE': 40,
+    'IVF_NLIST': 0,
+    'IVF_NPROBE': 8,
+    'IVF_TRAIN_ITERATIONS': 20,
+    'IVF_TRAIN_SAMPLE': 50000,
+    'ALIGN_BAND': 8,
+    'ALIGN_BATCH_SIZE': 64,
+    'SEGMENT_CHUNK_FRAMES': 65536,
+    'SEGMENT_HITS_PER_RECORD': 3,
+    'DB_JOURNAL_MODE': 'WAL',
+    'DB_SYNCHRONOUS': 'NORMAL',
+    'SERVICE_HOST': '127.0.0.1',
+    'SERVICE_PORT': 8765,
     'NUM_MATCHES': 5,
     'TABLE_SEPECTROGRAMS': 'mel_sepectrograms',
     'DBSCAN_MIN_SAMPLES': 5,
     'DBSCAN_EPS': 0.5,
-    'PLOT_SIZE': (100,100)
+    'CLUSTER_METHOD': 'hdbscan',
+    'CLUSTER_COMPONENTS': 16,
+    'CLUSTER_MICRO_CLUSTERS': 1024,
+    'CLUSTER_MIN_SIZE': 5,
+    'CLUSTER_BATCH_SIZE': 4096,
+    'CLUSTER_MEMORY_MB': 512,
+    'CLUSTER_JOBS': 0,
+    'CLUSTER_PLOT_SAMPLE': 20000,
+    'CLUSTER_DRIFT_NEW_FRACTION': 0.2,
+    'CLUSTER_DRIFT_DISTANCE_RATIO': 1.5,
+    'CLUSTER_SEARCH_NEIGHBOURS': 3,
+    'TABLE_CLUSTER_MODEL': 'cluster_model',
+    'TABLE_DUPLICATE_FILES': 'duplicate_files',
+    'PLOT_SIZE': (100,100),
+    'THUMBNAIL_DIR': '',
+    'THUMBNAIL_COLORMAP': 'inferno',
+    'PIXMAP_CACHE_SIZE': 1024,
+    'GUI_BATCH_SIZE': 50,
+    'TABLE_PAGE_SIZE': 256,
+    'FEATURE_CACHE_DIR': '',
+    'FEATURE_CACHE_MB': 256,
+    'FEATURE_CACHE_MEMO_SIZE': 32,
+    'METRICS_ENABLED': 0,
+    'METRICS_PREFIX': 'spectrogram'
 }
 
 class Config:
@@ -32,11 +83,13 @@ class Config:
         """Get the environment variable value or return the default."""
         value = os.getenv(env_var)
         if value is not None:
-            # Try to cast to integer if it's a number
-            try:
-                return int(value)
-            except ValueError:
-                return value
+            # Try to cast to integer, then to float, if it's a number
+            for cast in (int, float):
+                try:
+                    return cast(value)
+                except ValueError:
+                    pass
+            return value
         return default
 
     def __repr__(self):
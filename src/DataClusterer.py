@@ -1,26 +1,51 @@
 import os
 import sys
 import numpy as np
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import DBSCAN
-from sklearn.decomposition import PCA
-from sklearn.metrics.pairwise import euclidean_distances
-import matplotlib.pyplot as plt
-
 
 # Dynamically add 'src' to the module search path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Config import config
 from SpectrogramStorage import SpectrogramStorage
+from FeatureMatrix import FeatureMatrix, top_k
+from SearchIndex import open_index
+from AlignedSearch import AlignedSearch
+from SegmentSearch import SegmentSearch
+from AudioProcessor import AudioProcessor
+from EmbeddingClusterer import EmbeddingClusterer
+from Metrics import metrics, timed
 
 class DataClusterer:
-    def __init__(self, eps=config.DBSCAN_EPS, min_samples=config.DBSCAN_MIN_SAMPLES):
+    def __init__(self, eps=config.DBSCAN_EPS, min_samples=config.DBSCAN_MIN_SAMPLES, storage=None, auto_sync=True):
         self.eps = eps
-        self.storage = SpectrogramStorage()
+        self.storage = storage if storage is not None else SpectrogramStorage()
+        # With auto_sync off, matrices are synced once and then only by refresh(), as in a long-running service
+        self.auto_sync = auto_sync
+        self.matrices = {}
+        # Catalogue and layout state each matrix was last synced at; an unchanged state skips the sync
+        self.synced = {}
+        self.indexes = {}
         self.min_samples = min_samples
-        self.scaler = StandardScaler()
-        self.dbscan = DBSCAN(eps=self.eps, min_samples=self.min_samples)
+        self._scaler = None
+        self._dbscan = None
+        # (fitted_at, EmbeddingClusterer) of the clustering saved in the catalogue, see cluster_model
+        self._cluster_model = None
+
+    # scikit-learn and matplotlib are imported on first use, so searching and ingesting never load them
+
+    @property
+    def scaler(self):
+        if self._scaler is None:
+            from sklearn.preprocessing import StandardScaler
+            self._scaler = StandardScaler()
+        return self._scaler
+
+    @property
+    def dbscan(self):
+        if self._dbscan is None:
+            from sklearn.cluster import DBSCAN
+            self._dbscan = DBSCAN(eps=self.eps, min_samples=self.min_samples)
+        return self._dbscan
     
     def cluster_data(self, data):
         """Perform DBSCAN clustering on the data."""
@@ -36,8 +61,104 @@ class DataClusterer:
         
         return scaled_data, clusters
 
+    def cluster_catalogue(self, method=config.CLUSTER_METHOD, min_cluster_size=config.CLUSTER_MIN_SIZE, memory_mb=config.CLUSTER_MEMORY_MB, jobs=config.CLUSTER_JOBS, save=True):
+        """
+        Cluster every catalogued record on its fixed-length embedding, in bounded memory; see EmbeddingClusterer.
+
+        With save, the model and labels replace any clustering stored in the catalogue.
+
+        Returns:
+            tuple: (numpy.ndarray of record ids, numpy.ndarray of labels, -1 for noise, fitted EmbeddingClusterer).
+        """
+        clusterer = EmbeddingClusterer(method=method, min_cluster_size=min_cluster_size, eps=self.eps, memory_mb=memory_mb, jobs=jobs)
+        matrix = self.embedding_matrix()
+        with metrics.stage('cluster.fit'):
+            ids, labels, distances = clusterer.fit(matrix)
+        if save and len(ids):
+            with metrics.stage('cluster.save'):
+                clusterer.save(self.storage, ids, labels, distances)
+            self._cluster_model = (self.storage.cluster_model_fitted_at(), clusterer)
+        return ids, labels, clusterer
+
+    def cluster_model(self):
+        """The clustering saved in the catalogue, reloaded if it has been refitted since; None if never clustered."""
+        fitted_at = self.storage.cluster_model_fitted_at()
+        if fitted_at is None:
+            return None
+        if self._cluster_model is None or self._cluster_model[0] != fitted_at:
+            self._cluster_model = (fitted_at, EmbeddingClusterer.load(self.storage))
+        return self._cluster_model[1]
+
+    def cluster_drift(self):
+        """
+        Drift of the catalogue since it was clustered: the share of records added since, and how much
+        farther from their centroids they lie than the records the model was fitted on.
+
+        Returns:
+            dict or None: SpectrogramStorage.cluster_drift plus 'new_fraction', 'distance_ratio' and
+            'drifted', true once either crosses its CLUSTER_DRIFT_* threshold; None if never clustered.
+        """
+        drift = self.storage.cluster_drift()
+        if drift is None:
+            return None
+        new_fraction = drift['new_rows'] / max(drift['fitted_rows'], 1)
+        if drift['new_rows'] and drift['mean_distance']:
+            distance_ratio = drift['new_mean_distance'] / drift['mean_distance']
+        else:
+            # Small catalogues are clustered row by row, so there is no fitted spread to compare with
+            distance_ratio = 1.0
+        drifted = new_fraction > config.CLUSTER_DRIFT_NEW_FRACTION or distance_ratio > config.CLUSTER_DRIFT_DISTANCE_RATIO
+        return dict(drift, new_fraction=new_fraction, distance_ratio=distance_ratio, drifted=drifted)
+
+    def update_clusters(self, recluster=True, **cluster_options):
+        """
+        Bring a clustered catalogue up to date: label new records with their nearest cluster, then
+        recluster everything if that leaves the catalogue drifted (and recluster is set).
+
+        Returns:
+            dict or None: cluster_drift after labelling, plus 'assigned' and 'reclustered'; None if never clustered.
+        """
+        model = self.cluster_model()
+        if model is None:
+            return None
+        self.storage.backfill_embeddings(AudioProcessor.spectrogram_embedding)
+        with metrics.stage('cluster.assign'):
+            assigned = model.assign_unclustered(self.storage)
+        metrics.count('cluster.assigned', assigned)
+        drift = self.cluster_drift()
+        reclustered = recluster and drift['drifted']
+        if reclustered:
+            self.cluster_catalogue(**cluster_options)
+        return dict(drift, assigned=assigned, reclustered=reclustered)
+
+    def find_in_cluster_neighbourhood(self, target_spectrogram, num_matches=config.NUM_MATCHES, mode=config.SEARCH_MODE):
+        """
+        Exact search over only the records in the clusters nearest the query, and those not labelled yet.
+
+        Returns:
+            tuple or None: (record ids, distances), nearest first; None if the catalogue has not been
+            clustered or the query lies only near noise, so the caller should search everything.
+        """
+        model = self.cluster_model()
+        if model is None:
+            return None
+        embedding = AudioProcessor.spectrogram_embedding(target_spectrogram).reshape(1, -1)
+        labels = model.neighbourhood(embedding)
+        if not labels:
+            return None
+
+        matrix, target = (self.embedding_matrix(), embedding) if mode == 'embedding' else (self.feature_matrix(), target_spectrogram)
+        matrix_ids = np.array(matrix.ids())
+        rows = np.flatnonzero(np.isin(matrix_ids, self.storage.fetch_ids_in_clusters(labels)))
+        distances = matrix.squared_distances_at(matrix.query_vector(target), rows)
+        closest = top_k(distances, num_matches)
+        return matrix_ids[rows[closest]], np.sqrt(distances[closest])
+
     def plot_clusters(self, data, clusters):
         """Plot the clusters using PCA for dimensionality reduction to 2D."""
+        import matplotlib.pyplot as plt
+        from sklearn.decomposition import PCA
+
         pca = PCA(n_components=2)
         data_2d = pca.fit_transform(data)
         
@@ -82,9 +203,132 @@ class DataClusterer:
         ])
         return padded_spectrograms
 
-    def find_closest_matches_in_db(self, target_spectrogram, num_matches=config.NUM_MATCHES):
-        spectrograms = self.storage.fetch_all_spectrograms();
-        return self.find_closest_matches(target_spectrogram, spectrograms, num_matches)
+    def _sync_state(self, path):
+        return self.storage.change_token(), FeatureMatrix.layout_version(path)
+
+    def _needs_sync(self, kind, path, sync):
+        """Whether to (re)open and sync a matrix: always if asked to, and with auto_sync once the catalogue or the matrix has changed."""
+        if kind not in self.matrices or sync:
+            return True
+        return sync is None and self.auto_sync and self.synced.get(kind) != self._sync_state(path)
+
+    def feature_matrix(self, sync=None):
+        """The memory-mapped feature matrix of the catalogue, brought up to date."""
+        path = self.storage.feature_matrix_path
+        if self._needs_sync('spectrogram', path, sync):
+            # Re-read the layout, which another process may have extended
+            matrix = self.matrices['spectrogram'] = FeatureMatrix(path)
+            with metrics.stage('matrix.sync'):
+                matrix.sync(self.storage)
+            self.synced['spectrogram'] = self._sync_state(path)
+        return self.matrices['spectrogram']
+
+    def embedding_matrix(self, sync=None):
+        """The memory-mapped matrix of stored embeddings, filling in any the catalogue lacks."""
+        path = self.storage.embedding_matrix_path
+        if self._needs_sync('embedding', path, sync):
+            self.storage.backfill_embeddings(AudioProcessor.spectrogram_embedding)
+            matrix = self.matrices['embedding'] = FeatureMatrix(path, source='embedding')
+            with metrics.stage('matrix.sync'):
+                matrix.sync(self.storage)
+            self.synced['embedding'] = self._sync_state(path)
+        return self.matrices['embedding']
+
+    def refresh(self):
+        """Sync every matrix opened so far with the catalogue, and the indexes over them."""
+        if 'spectrogram' in self.matrices:
+            self.feature_matrix(sync=True)
+        if 'embedding' in self.matrices:
+            self.embedding_matrix(sync=True)
+        for mode, kind in list(self.indexes):
+            self.search_index(mode, kind)
+
+    def search_index(self, mode=config.SEARCH_MODE, kind=config.SEARCH_INDEX):
+        """The search index of this kind over the spectrogram or embedding matrix, loaded on first use."""
+        if mode == 'embedding':
+            matrix = self.embedding_matrix()
+        elif mode == 'spectrogram':
+            matrix = self.feature_matrix()
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        index = self.indexes.get((mode, kind))
+        if index is None:
+            index = self.indexes[(mode, kind)] = open_index(matrix, kind)
+        else:
+            index.refresh(matrix)
+        return index
+
+    def find_closest_matches_in_db(self, target_spectrogram, num_matches=config.NUM_MATCHES, mode=config.SEARCH_MODE, index=config.SEARCH_INDEX, cluster_filter=False):
+        """
+        Find the closest matches to the target spectrogram among all stored spectrograms.
+
+        Args:
+            target_spectrogram (numpy.ndarray): The target spectrogram to compare against.
+            num_matches (int): Number of closest matches to find.
+            mode (str): 'spectrogram' compares whole padded spectrograms; 'embedding' compares
+                fixed-length embeddings, so the cost does not depend on clip lengths; 'dtw' and
+                'xcorr' compare spectrograms allowing ALIGN_BAND frames of misalignment, see
+                AlignedSearch.
+            index (str): 'brute' for an exact scan, 'tree' for an exact BallTree search or
+                'ivf' for an approximate inverted-file search; see SearchIndex. Ignored by the
+                aligned modes.
+            cluster_filter (bool): In the spectrogram and embedding modes, only scan the query's
+                cluster neighbourhood when the catalogue has been clustered; see
+                find_in_cluster_neighbourhood.
+
+        Returns:
+            numpy.ndarray: Record ids of the closest matches, nearest first.
+        """
+        metrics.count('search.queries')
+        with metrics.stage(f'search.{mode}'):
+            if cluster_filter and mode in ('spectrogram', 'embedding'):
+                found = self.find_in_cluster_neighbourhood(target_spectrogram, num_matches, mode)
+                if found is not None:
+                    return found[0]
+            if mode in ('dtw', 'xcorr'):
+                ids, _ = AlignedSearch(self.feature_matrix(), mode).search(target_spectrogram, num_matches)
+                return ids
+            if mode == 'embedding':
+                target_spectrogram = AudioProcessor.spectrogram_embedding(target_spectrogram).reshape(1, -1)
+            ids, _ = self.search_index(mode, index).search(target_spectrogram, num_matches)
+            return ids
+
+    def find_closest_matches_in_db_many(self, target_spectrograms, num_matches=config.NUM_MATCHES, mode=config.SEARCH_MODE, index=config.SEARCH_INDEX, cluster_filter=False):
+        """
+        Batch version of find_closest_matches_in_db; exact scans run as one matrix product.
+
+        Returns:
+            list of tuple: (record ids, distances) for each target, nearest first.
+        """
+        metrics.count('search.queries', len(target_spectrograms))
+        with metrics.stage(f'search.{mode}.batch'):
+            return self._find_many(target_spectrograms, num_matches, mode, index, cluster_filter)
+
+    def _find_many(self, target_spectrograms, num_matches, mode, index, cluster_filter):
+        if cluster_filter and mode in ('spectrogram', 'embedding'):
+            found = [self.find_in_cluster_neighbourhood(target, num_matches, mode) for target in target_spectrograms]
+            unfiltered = [target for target, result in zip(target_spectrograms, found) if result is None]
+            if unfiltered:
+                rest = iter(self._find_many(unfiltered, num_matches, mode, index, False))
+                found = [next(rest) if result is None else result for result in found]
+            return found
+        if mode in ('dtw', 'xcorr'):
+            search = AlignedSearch(self.feature_matrix(), mode)
+            return [search.search(target, num_matches) for target in target_spectrograms]
+        if mode == 'embedding':
+            target_spectrograms = [AudioProcessor.spectrogram_embedding(target).reshape(1, -1) for target in target_spectrograms]
+        return self.search_index(mode, index).search_many(target_spectrograms, num_matches)
+
+    @timed('search.segments')
+    def find_segments_in_db(self, target_spectrogram, num_matches=config.NUM_MATCHES, normalize=True):
+        """
+        Locate a short target inside the stored recordings, ranked across the whole catalogue.
+
+        Returns:
+            tuple: (record ids, start frames, distances) of the best hits, nearest first.
+        """
+        return SegmentSearch(self.storage, normalize).search(target_spectrogram, num_matches)
 
     def find_closest_matches(self, target_spectrogram, spectrograms, num_matches=config.NUM_MATCHES):
         """
@@ -98,6 +342,8 @@ class DataClusterer:
         Returns:
             list of int: Indices of the closest matches in the spectrograms list.
         """
+        from sklearn.metrics.pairwise import euclidean_distances
+
         # Pad all spectrograms to have the same shape
         padded_spectrograms = self.pad_spectrograms(spectrograms)
         
@@ -109,6 +355,6 @@ class DataClusterer:
         distances = euclidean_distances(reshaped_target, reshaped_spectrograms).flatten()
 
         # Get the indices of the closest matches
-        closest_indices = np.argsort(distances)[:num_matches]
+        closest_indices = top_k(distances, num_matches)
 
         return closest_indices    
\ No newline at end of file
@@ -0,0 +1,249 @@
+import io
+import os
+import sys
+import time
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+NOISE = -1
+
+class EmbeddingClusterer:
+    """
+    Density clustering of the catalogue's fixed-length embeddings within a memory budget.
+
+    The embedding matrix is streamed in chunks: once to fit a standard scaler, once to fit an
+    incremental PCA, once to fit mini-batch k-means micro-clusters in the reduced space and once
+    to assign every row to its nearest micro-cluster. The micro-cluster centroids, far fewer than
+    the rows, are then clustered by HDBSCAN (or DBSCAN weighted by micro-cluster size) on a KD-tree,
+    and each row takes the label of its micro-cluster. Catalogues no larger than micro_clusters
+    skip k-means and cluster the rows themselves.
+
+    Only one chunk of rows, its distances to the centroids and the per-row labels are held in
+    memory, and chunks are sized from memory_mb. scikit-learn is only needed to fit: the fitted
+    projection, centroids and their labels are plain arrays, saved with the labels in the
+    catalogue (save, load) and used to label new records without reclustering (assign_unclustered).
+    """
+
+    def __init__(self, n_components=config.CLUSTER_COMPONENTS, micro_clusters=config.CLUSTER_MICRO_CLUSTERS, method=config.CLUSTER_METHOD,
+                 min_cluster_size=config.CLUSTER_MIN_SIZE, eps=config.DBSCAN_EPS, memory_mb=config.CLUSTER_MEMORY_MB, jobs=config.CLUSTER_JOBS, seed=0):
+        if method not in ('hdbscan', 'dbscan'):
+            raise ValueError(f"Unknown clustering method: {method}")
+        self.n_components = n_components
+        self.micro_clusters = micro_clusters
+        self.method = method
+        self.min_cluster_size = min_cluster_size
+        self.eps = eps
+        self.memory_mb = memory_mb
+        # scikit-learn's convention: -1 uses every core
+        self.jobs = jobs if jobs > 0 else -1
+        self.seed = seed
+        # Fitted standardisation and principal axes: reduce(x) = ((x - mean) / scale - pca_mean) @ components.T
+        self.mean = None
+        self.scale = None
+        self.pca_mean = None
+        self.components = None
+        self.centroids = None
+        self.centroid_labels = None
+        self.centroid_counts = None
+
+    def chunk_rows(self, dim, n_centroids):
+        """Rows per chunk so that a chunk, its float64 copies and its distances to the centroids fit the budget."""
+        bytes_per_row = 8 * (4 * dim + n_centroids)
+        return max(n_centroids, 1, int(self.memory_mb * 2 ** 20) // bytes_per_row)
+
+    @staticmethod
+    def _chunks(data, live, chunk_rows):
+        """Live rows of the matrix, as float64 chunks, without loading the whole matrix."""
+        for start in range(0, len(data), chunk_rows):
+            chunk = np.asarray(data[start:start + chunk_rows], dtype=np.float64)
+            keep = live[start:start + chunk_rows]
+            yield chunk if keep.all() else chunk[keep]
+
+    def reduce(self, embeddings):
+        """Project embeddings into the fitted, standardised principal component space."""
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float64))
+        return ((embeddings - self.mean) / self.scale - self.pca_mean) @ self.components.T
+
+    def assign(self, reduced, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """
+        Nearest centroid for each row of reduced features.
+
+        Returns:
+            tuple: (numpy.ndarray of centroid indexes, numpy.ndarray of Euclidean distances to them).
+        """
+        centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        nearest = np.empty(len(reduced), dtype=np.int64)
+        distances = np.empty(len(reduced), dtype=np.float64)
+        for start in range(0, len(reduced), chunk_rows):
+            chunk = reduced[start:start + chunk_rows]
+            partial = centroid_norms - 2 * chunk @ self.centroids.T
+            closest = np.argmin(partial, axis=1)
+            nearest[start:start + len(chunk)] = closest
+            squared = partial[np.arange(len(chunk)), closest] + np.einsum('ij,ij->i', chunk, chunk)
+            distances[start:start + len(chunk)] = np.sqrt(np.maximum(squared, 0))
+        return nearest, distances
+
+    def predict(self, embeddings):
+        """
+        Labels of new embeddings, from their nearest centroid; NOISE for those nearest a noise micro-cluster.
+
+        Returns:
+            tuple: (numpy.ndarray of labels, numpy.ndarray of distances to the nearest centroid).
+        """
+        nearest, distances = self.assign(self.reduce(embeddings))
+        return self.centroid_labels[nearest], distances
+
+    def neighbourhood(self, embedding, neighbours=config.CLUSTER_SEARCH_NEIGHBOURS):
+        """Labels, other than NOISE, of the clusters owning the centroids nearest an embedding; a search pre-filter."""
+        reduced = self.reduce(embedding)[0]
+        occupied = np.flatnonzero(self.centroid_counts > 0)
+        distances = np.einsum('ij,ij->i', self.centroids[occupied] - reduced, self.centroids[occupied] - reduced)
+        closest = occupied[np.argsort(distances, kind='stable')[:neighbours]]
+        labels = self.centroid_labels[closest]
+        return sorted({int(label) for label in labels if label != NOISE})
+
+    def _fit_projection(self, data, live, chunk_rows):
+        from sklearn.preprocessing import StandardScaler
+        from sklearn.decomposition import IncrementalPCA
+
+        rows = int(live.sum())
+        n_components = max(1, min(self.n_components, data.shape[1], rows))
+        scaler = StandardScaler()
+        for chunk in self._chunks(data, live, chunk_rows):
+            scaler.partial_fit(chunk)
+
+        pca = IncrementalPCA(n_components=n_components)
+        pending = None
+        for chunk in self._chunks(data, live, chunk_rows):
+            chunk = scaler.transform(chunk)
+            # IncrementalPCA needs at least n_components rows per batch: fold short chunks into the next
+            pending = chunk if pending is None else np.concatenate([pending, chunk])
+            if len(pending) >= 2 * n_components:
+                pca.partial_fit(pending)
+                pending = None
+        if pending is not None and (len(pending) >= n_components or not hasattr(pca, 'components_')):
+            pca.partial_fit(pending)
+
+        self.mean, self.scale = scaler.mean_, scaler.scale_
+        self.pca_mean, self.components = pca.mean_, pca.components_
+
+    def _fit_centroids(self, data, live, chunk_rows):
+        rows = int(live.sum())
+        if rows <= self.micro_clusters:
+            self.centroids = self.reduce(np.concatenate(list(self._chunks(data, live, chunk_rows))))
+            return np.arange(rows), np.zeros(rows), np.ones(rows, dtype=np.int64)
+
+        from sklearn.cluster import MiniBatchKMeans
+
+        batch_size = max(self.micro_clusters, config.CLUSTER_BATCH_SIZE)
+        kmeans = MiniBatchKMeans(n_clusters=self.micro_clusters, random_state=self.seed, n_init=1)
+        pending = None
+        for chunk in self._chunks(data, live, chunk_rows):
+            reduced = self.reduce(chunk)
+            # The first batch seeds every centroid, so it must be full: deleted rows can leave every
+            # chunk short of micro_clusters live rows, so carry them over until there are enough
+            if pending is not None:
+                reduced = np.concatenate([pending, reduced])
+                pending = None
+            for start in range(0, len(reduced), batch_size):
+                batch = reduced[start:start + batch_size]
+                if len(batch) >= self.micro_clusters or hasattr(kmeans, 'cluster_centers_'):
+                    kmeans.partial_fit(batch)
+                else:
+                    pending = batch
+        # rows > micro_clusters, so the carried rows always reach a full first batch
+        self.centroids = kmeans.cluster_centers_
+
+        nearest = np.empty(rows, dtype=np.int64)
+        distances = np.empty(rows, dtype=np.float64)
+        done = 0
+        for chunk in self._chunks(data, live, chunk_rows):
+            nearest[done:done + len(chunk)], distances[done:done + len(chunk)] = self.assign(self.reduce(chunk))
+            done += len(chunk)
+        return nearest, distances, np.bincount(nearest, minlength=len(self.centroids))
+
+    def _cluster_centroids(self, counts):
+        occupied = counts > 0
+        labels = np.full(len(self.centroids), NOISE, dtype=np.int64)
+        points = self.centroids[occupied]
+        if self.method == 'hdbscan':
+            from sklearn.cluster import HDBSCAN
+            if len(points) >= max(2, self.min_cluster_size):
+                labels[occupied] = HDBSCAN(min_cluster_size=max(2, self.min_cluster_size), algorithm='kd_tree', n_jobs=self.jobs, copy=True).fit_predict(points)
+        else:
+            from sklearn.cluster import DBSCAN
+            if len(points):
+                # Weighted by size, a micro-cluster counts as the rows it summarises
+                dbscan = DBSCAN(eps=self.eps, min_samples=self.min_cluster_size, algorithm='kd_tree', n_jobs=self.jobs)
+                labels[occupied] = dbscan.fit_predict(points, sample_weight=counts[occupied])
+        return labels
+
+    def fit(self, matrix):
+        """
+        Cluster every row of an embedding FeatureMatrix.
+
+        Returns:
+            tuple: (numpy.ndarray of record ids, numpy.ndarray of their cluster labels, NOISE for noise,
+            numpy.ndarray of their distances to their micro-cluster centroid).
+        """
+        ids = np.array(matrix.ids())
+        live = ids >= 0
+        ids = ids[live]
+        if not len(ids):
+            return ids, np.empty(0, dtype=np.int64), np.empty(0)
+
+        data = matrix.matrix()
+        chunk_rows = self.chunk_rows(data.shape[1], min(self.micro_clusters, len(ids)))
+        self._fit_projection(data, live, chunk_rows)
+        nearest, distances, self.centroid_counts = self._fit_centroids(data, live, chunk_rows)
+        self.centroid_labels = self._cluster_centroids(self.centroid_counts)
+        return ids, self.centroid_labels[nearest], distances
+
+    MODEL_ARRAYS = ('mean', 'scale', 'pca_mean', 'components', 'centroids', 'centroid_labels', 'centroid_counts')
+
+    def to_bytes(self):
+        with io.BytesIO() as buffer:
+            np.savez(buffer, **{name: getattr(self, name) for name in self.MODEL_ARRAYS})
+            return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, blob):
+        clusterer = cls()
+        with np.load(io.BytesIO(blob), allow_pickle=False) as arrays:
+            for name in cls.MODEL_ARRAYS:
+                setattr(clusterer, name, arrays[name])
+        return clusterer
+
+    def save(self, storage, ids, labels, distances):
+        """Store the fitted model and the labels of the records it was fitted on, replacing any earlier clustering."""
+        storage.save_cluster_model(self.to_bytes(), ids, labels, distances, time.time())
+
+    @classmethod
+    def load(cls, storage):
+        """The clustering model saved in the catalogue, or None if it has never been clustered."""
+        model = storage.fetch_cluster_model()
+        return None if model is None else cls.from_bytes(model['model'])
+
+    def assign_unclustered(self, storage, batch_size=config.DB_BATCH_SIZE):
+        """Label every record added since the model was fitted with its nearest cluster. Returns the number labelled."""
+        assigned = 0
+        for ids, embeddings in storage.iter_unclustered_embeddings(batch_size):
+            labels, distances = self.predict(np.concatenate(embeddings))
+            storage.update_cluster_labels(ids, labels, distances)
+            assigned += len(ids)
+        return assigned
+
+    def projection_2d(self, matrix, sample_size=config.CLUSTER_PLOT_SAMPLE, seed=0):
+        """Record ids of a random sample of rows and their first two principal components, for plotting."""
+        ids = np.array(matrix.ids())
+        rng = np.random.default_rng(seed)
+        live_rows = np.flatnonzero(ids >= 0)
+        rows = np.sort(rng.choice(live_rows, min(sample_size, len(live_rows)), replace=False))
+        reduced = self.reduce(matrix.matrix()[rows])
+        if reduced.shape[1] < 2:
+            reduced = np.column_stack([reduced, np.zeros(len(reduced))])
+        return ids[rows], reduced[:, :2]
@@ -0,0 +1,252 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from Ingester import Ingester
+from Metrics import metrics
+
+class FeatureCache:
+    """
+    Mel spectrograms of query files, keyed by a hash of the file's bytes and the feature settings.
+
+    A lookup tries, in order: an in-process memo of recent queries, keyed by path, size and mtime
+    so a repeated query is not even re-read; the catalogue, when the query is a catalogued file
+    that has not changed (by path and stat, or by content hash for files ingested with --hash);
+    and .npy files in a directory, kept under max_bytes by evicting the least recently used, by
+    mtime, which every hit bumps. Only a miss everywhere decodes the file.
+
+    Safe to share between threads; storage is only used under the cache's own lock.
+    """
+
+    def __init__(self, directory, audio_processor, storage=None, max_bytes=config.FEATURE_CACHE_MB * 2 ** 20, memo_size=config.FEATURE_CACHE_MEMO_SIZE):
+        self.directory = directory
+        self.audio_processor = audio_processor
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        # (path, size, mtime) -> [content hash, spectrogram], each None until known
+        self.memo = OrderedDict()
+        # Bytes on disk, counted on the first write
+        self.disk_bytes = None
+
+    def key_for(self, content_hash):
+        return hashlib.sha1(f"{content_hash};{self.audio_processor.feature_config}".encode()).hexdigest()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npy")
+
+    def _memo_entry(self, filepath):
+        """The memo entry of a file in its current state; a new one if the file is new or has changed."""
+        stat = os.stat(filepath)
+        identity = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            entry = self.memo.get(identity)
+            if entry is None:
+                entry = self.memo[identity] = [None, None]
+                while len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+            else:
+                self.memo.move_to_end(identity)
+        return identity, entry
+
+    def _from_catalogue(self, filepath, identity, content_hash=None):
+        """The catalogued spectrogram of the file by path and stat or, given content_hash, by content."""
+        if self.storage is None:
+            return None
+        feature_config = self.audio_processor.feature_config
+        with self.lock:
+            if content_hash is not None:
+                return self.storage.fetch_spectrogram_by_content_hash(content_hash, feature_config)
+            for filename in dict.fromkeys([filepath, identity[0]]):
+                spectrogram = self.storage.fetch_spectrogram_of_file(filename, identity[1], identity[2], feature_config)
+                if spectrogram is not None:
+                    return spectrogram
+            return None
+
+    def _from_disk(self, key):
+        path = self.path_for(key)
+        try:
+            spectrogram = np.load(path, allow_pickle=False)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # A partial or corrupt entry: drop it and recompute
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return spectrogram
+
+    def lookup(self, filepath, content_hash=None):
+        """
+        The file's spectrogram from the memo, the catalogue or the disk cache, without decoding it.
+
+        content_hash, if the caller already has it, saves hashing the file again.
+
+        Returns:
+            numpy.ndarray or None: Read-only (num_windows, n_bands) spectrogram; None on a miss.
+        """
+        identity, entry, spectrogram = self._lookup_unchanged(filepath)
+        if spectrogram is not None:
+            return spectrogram
+        return self._lookup_content(filepath, identity, entry, content_hash)
+
+    def lookup_many(self, filepaths, workers=config.INGEST_WORKERS):
+        """
+        lookup for many files, hashing those that need it on a thread pool rather than one by one.
+
+        Returns:
+            tuple: ({filepath: spectrogram} of the hits, {filepath: content hash} of the files hashed),
+            leaving out files that could not be read.
+        """
+        found, missed = {}, []
+        for filepath in filepaths:
+            try:
+                identity, entry, spectrogram = self._lookup_unchanged(filepath)
+            except OSError:
+                continue
+            if spectrogram is not None:
+                found[filepath] = spectrogram
+            else:
+                missed.append((filepath, identity, entry))
+
+        # Reading and hashing release the GIL, so threads overlap the I/O; storage stays on this thread
+        def hash_file(filepath):
+            try:
+                return Ingester.content_hash(filepath)
+            except OSError:
+                return None
+
+        workers = workers if workers > 0 else os.cpu_count()
+        paths = [filepath for filepath, _, _ in missed]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = dict(zip(paths, executor.map(hash_file, paths)))
+        content_hashes = {}
+        for filepath, identity, entry in missed:
+            if hashes[filepath] is None:
+                continue
+            content_hashes[filepath] = hashes[filepath]
+            spectrogram = self._lookup_content(filepath, identity, entry, hashes[filepath])
+            if spectrogram is not None:
+                found[filepath] = spectrogram
+        return found, content_hashes
+
+    def _lookup_unchanged(self, filepath):
+        """The memo entry of the file and its spectrogram from the memo or, by path and stat alone, the catalogue."""
+        identity, entry = self._memo_entry(filepath)
+        if entry[1] is not None:
+            metrics.count('feature_cache.memo_hits')
+            return identity, entry, entry[1]
+        spectrogram = self._from_catalogue(filepath, identity)
+        if spectrogram is not None:
+            metrics.count('feature_cache.catalogue_hits')
+            return identity, entry, self._remember(entry, spectrogram)
+        return identity, entry, None
+
+    def _lookup_content(self, filepath, identity, entry, content_hash=None):
+        """The spectrogram of the file's bytes from the catalogue or the disk cache; the file is hashed only once per state."""
+        if entry[0] is None:
+            entry[0] = content_hash or Ingester.content_hash(filepath)
+        spectrogram = self._from_catalogue(filepath, identity, entry[0])
+        if spectrogram is not None:
+            metrics.count('feature_cache.catalogue_hits')
+        else:
+            spectrogram = self._from_disk(self.key_for(entry[0]))
+            if spectrogram is None:
+                metrics.count('feature_cache.misses')
+                return None
+            metrics.count('feature_cache.disk_hits')
+        return self._remember(entry, spectrogram)
+
+    def store(self, filepath, mel_spectrogram, content_hash=None):
+        """Cache a spectrogram computed for a file that lookup missed. Returns it, read-only."""
+        _, entry = self._memo_entry(filepath)
+        if entry[0] is None:
+            entry[0] = content_hash or Ingester.content_hash(filepath)
+        mel_spectrogram = self._remember(entry, mel_spectrogram)
+        self._write(self.key_for(entry[0]), mel_spectrogram)
+        return mel_spectrogram
+
+    def features(self, filepath):
+        """The file's Mel spectrogram, decoding it only if no cache layer has it."""
+        spectrogram = self.lookup(filepath)
+        if spectrogram is None:
+            spectrogram = self.store(filepath, self.audio_processor.wav_file_to_mel_spectrogram(filepath))
+        return spectrogram
+
+    def _remember(self, entry, spectrogram):
+        spectrogram = np.asarray(spectrogram).astype(self.audio_processor.dtype, copy=False)
+        # Shared by every later hit, so nobody may modify it in place
+        spectrogram.setflags(write=False)
+        entry[1] = spectrogram
+        return spectrogram
+
+    def _write(self, key, spectrogram):
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, spectrogram, allow_pickle=False)
+        try:
+            # Another thread or process may have cached the same file meanwhile
+            replaced_bytes = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_bytes = 0
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.disk_bytes += os.path.getsize(path) - replaced_bytes
+            if self.disk_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        """(path, size, mtime) of every cached file."""
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime_ns
+
+    def _evict(self):
+        """Remove the least recently used files until the cache is within max_bytes; other processes may share it, so recount first."""
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.disk_bytes <= self.max_bytes:
+                break
+            self._remove(path)
+            self.disk_bytes -= size
+            metrics.count('feature_cache.evictions')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Forget every cached spectrogram, in memory and on disk."""
+        with self.lock:
+            self.memo.clear()
+            for path, _, _ in list(self._entries()):
+                self._remove(path)
+            self.disk_bytes = 0
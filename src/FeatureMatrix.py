@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import functools
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: lock a byte of the lock file instead
+    fcntl = None
+    import msvcrt
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+DELETED_ID = -1
+EMPTY_META = {'rows': 0, 'n_frames': 0, 'n_bands': 0, 'last_id': 0, 'deleted': 0, 'generation': 0}
+
+def _exclusive(method):
+    """Run a method that rewrites the matrix files under the matrix's inter-process lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def top_k(distances, k):
+    """Positions of the k smallest finite distances, nearest first, by partial selection."""
+    if k < len(distances):
+        candidates = np.argpartition(distances, k)[:k]
+    else:
+        candidates = np.arange(len(distances))
+    closest = candidates[np.argsort(distances[candidates], kind='stable')]
+    return closest[np.isfinite(distances[closest])]
+
+class FeatureMatrix:
+    """
+    Contiguous float32 matrix of zero-padded, flattened spectrograms kept next to the SQLite file.
+    With source='embedding' the rows are the stored fixed-length embeddings instead.
+
+    Three files share the path prefix: '.f32' holds the rows, '.ids' the int64 record id of each
+    row (DELETED_ID once deleted) and '.json' the layout. Rows are appended in record id order,
+    so searches read one memory map instead of decoding every BLOB, and the OS page cache shares
+    it between processes. Rows are only visible once the layout file counts them. Every rewrite
+    that moves rows bumps the layout's generation, so indexes over row positions can tell.
+
+    Every write (sync, append, delete, compact, reset) holds an exclusive lock on a fourth file,
+    '.lock', and re-reads the layout once it has it, so processes syncing the same matrix at once,
+    e.g. serve.py and ingest.py, take turns instead of appending rows twice or truncating each
+    other's appends. Readers do not lock.
+    """
+
+    def __init__(self, path, source='spectrogram'):
+        self.path = path
+        self.source = source
+        self.data_path = path + '.f32'
+        self.ids_path = path + '.ids'
+        self.meta_path = path + '.json'
+        self.lock_path = path + '.lock'
+        self.meta = self._read_meta()
+        self._lock_file = None
+        self._lock_depth = 0
+
+    @contextmanager
+    def locked(self):
+        """Hold the exclusive write lock, re-reading the layout on acquiring it; re-entrant within this object."""
+        if self._lock_depth == 0:
+            lock_file = open(self.lock_path, 'a+b')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            except BaseException:
+                lock_file.close()
+                raise
+            self._lock_file = lock_file
+            # Another process may have written since the layout was last read
+            self.meta = self._read_meta()
+        self._lock_depth += 1
+        try:
+            yield self
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                # Closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+    def _read_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict(EMPTY_META)
+
+    def _write_meta(self):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    @staticmethod
+    def layout_version(path):
+        """Inode, modification time and size of a matrix's layout file, which every write rewrites; None if it has none."""
+        try:
+            stat = os.stat(path + '.json')
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    @property
+    def generation(self):
+        return self.meta.get('generation', 0)
+
+    @property
+    def shape(self):
+        """Shape every stored spectrogram is padded to."""
+        return self.meta['n_frames'], self.meta['n_bands']
+
+    def ids(self, mode='r'):
+        if self.rows == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.memmap(self.ids_path, dtype=np.int64, mode=mode, shape=(self.rows,))
+
+    def matrix(self):
+        """Read-only (rows, n_frames * n_bands) view of the stored features."""
+        n_frames, n_bands = self.shape
+        if self.rows == 0:
+            return np.empty((0, n_frames * n_bands), dtype=np.float32)
+        return np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(self.rows, n_frames * n_bands))
+
+    def _pad(self, spectrograms, n_frames, n_bands):
+        block = np.zeros((len(spectrograms), n_frames, n_bands), dtype=np.float32)
+        for i, s in enumerate(spectrograms):
+            block[i, :s.shape[0], :s.shape[1]] = s
+        # Explicit row width, so an empty block (e.g. a chunk whose rows were all deleted) still reshapes
+        return block.reshape(len(spectrograms), n_frames * n_bands)
+
+    def _rewrite(self, n_frames, n_bands, keep=None, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """Copy the matrix into a new layout, optionally keeping only rows where keep is True."""
+        old_frames, old_bands = self.shape
+        matrix = self.matrix()
+        ids = np.array(self.ids())
+        rows = 0
+
+        with open(self.data_path + '.tmp', 'wb') as data_file, open(self.ids_path + '.tmp', 'wb') as ids_file:
+            for start in range(0, self.rows, chunk_rows):
+                chunk = matrix[start:start + chunk_rows].reshape(-1, old_frames, old_bands)
+                chunk_ids = ids[start:start + chunk_rows]
+                if keep is not None:
+                    chunk = chunk[keep[start:start + chunk_rows]]
+                    chunk_ids = chunk_ids[keep[start:start + chunk_rows]]
+                data_file.write(self._pad(chunk, n_frames, n_bands).tobytes())
+                ids_file.write(chunk_ids.astype(np.int64).tobytes())
+                rows += len(chunk_ids)
+
+        del matrix
+        os.replace(self.data_path + '.tmp', self.data_path)
+        os.replace(self.ids_path + '.tmp', self.ids_path)
+        self.meta.update(rows=rows, n_frames=n_frames, n_bands=n_bands, generation=self.generation + 1)
+        if keep is not None:
+            self.meta['deleted'] = 0
+        self._write_meta()
+
+    @_exclusive
+    def append(self, ids, spectrograms):
+        """Append spectrograms with their record ids, widening the layout if one of them is larger."""
+        if not len(ids):
+            return
+        n_frames = max(self.meta['n_frames'], *(s.shape[0] for s in spectrograms))
+        n_bands = max(self.meta['n_bands'], *(s.shape[1] for s in spectrograms))
+        if self.rows and (n_frames, n_bands) != self.shape:
+            self._rewrite(n_frames, n_bands)
+        self._truncate_uncommitted()
+
+        with open(self.data_path, 'ab') as data_file, open(self.ids_path, 'ab') as ids_file:
+            data_file.write(self._pad(spectrograms, n_frames, n_bands).tobytes())
+            ids_file.write(np.asarray(ids, dtype=np.int64).tobytes())
+
+        self.meta.update(
+            rows=self.rows + len(ids), n_frames=n_frames, n_bands=n_bands,
+            last_id=max(self.meta['last_id'], int(max(ids)))
+        )
+        self._write_meta()
+
+    def _truncate_uncommitted(self):
+        """Drop bytes written after the last committed row, e.g. by an interrupted append."""
+        n_frames, n_bands = self.shape
+        for path, row_size in ((self.data_path, n_frames * n_bands * 4), (self.ids_path, 8)):
+            if os.path.exists(path) and os.path.getsize(path) != self.rows * row_size:
+                os.truncate(path, self.rows * row_size)
+
+    @_exclusive
+    def delete(self, ids):
+        """Mark the rows of the given record ids as deleted; compact() drops them."""
+        stored_ids = self.ids(mode='r+')
+        deleted = np.isin(stored_ids, ids)
+        if deleted.any():
+            stored_ids[deleted] = DELETED_ID
+            stored_ids.flush()
+            self.meta['deleted'] += int(deleted.sum())
+            self._write_meta()
+
+    @_exclusive
+    def reset(self):
+        """Remove every stored row."""
+        for path in (self.data_path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.meta = dict(EMPTY_META, generation=self.generation + 1)
+        self._write_meta()
+
+    @_exclusive
+    def compact(self):
+        """Rewrite the matrix without deleted rows."""
+        self._rewrite(*self.shape, keep=np.array(self.ids()) != DELETED_ID)
+
+    @_exclusive
+    def sync(self, storage, batch_size=config.DB_BATCH_SIZE):
+        """Bring the matrix up to date with the catalogue: append new records, drop deleted ones."""
+        stored_ids = self.ids()
+        live_ids = storage.fetch_ids()
+        if not np.isin(live_ids[live_ids <= self.meta['last_id']], stored_ids).all():
+            # Ids were reused, e.g. after the table was dropped: start again
+            self.reset()
+            stored_ids = self.ids()
+        removed = stored_ids[(stored_ids != DELETED_ID) & ~np.isin(stored_ids, live_ids)]
+        if len(removed):
+            self.delete(removed)
+        if self.meta['deleted'] and self.meta['deleted'] >= config.FEATURE_MATRIX_COMPACT_RATIO * self.rows:
+            self.compact()
+
+        if self.source == 'embedding':
+            batches = storage.iter_embeddings_after(self.meta['last_id'], batch_size)
+        else:
+            batches = storage.iter_spectrograms_after(self.meta['last_id'], batch_size)
+        for ids, spectrograms in batches:
+            self.append(ids, spectrograms)
+
+    def query_vector(self, target_spectrogram):
+        """
+        Pad or crop a spectrogram to the stored layout and flatten it.
+
+        Cropping drops a term that is the same for every candidate, so rankings match
+        padding everything to the target.
+        """
+        n_frames, n_bands = self.shape
+        target = np.zeros((n_frames, n_bands), dtype=np.float32)
+        rows = min(n_frames, target_spectrogram.shape[0])
+        bands = min(n_bands, target_spectrogram.shape[1])
+        target[:rows, :bands] = target_spectrogram[:rows, :bands]
+        return target.reshape(-1)
+
+    def squared_distances(self, query, start=0, stop=None, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """Squared Euclidean distances from a query vector to rows start:stop, read in chunks."""
+        matrix = self.matrix()
+        stop = self.rows if stop is None else stop
+        distances = np.empty(stop - start, dtype=np.float64)
+        for chunk_start in range(start, stop, chunk_rows):
+            difference = matrix[chunk_start:min(chunk_start + chunk_rows, stop)] - query
+            distances[chunk_start - start:chunk_start - start + len(difference)] = np.einsum('ij,ij->i', difference, difference)
+        return distances
+
+    def squared_distances_at(self, query, rows, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """Squared Euclidean distances from a query vector to the given rows, gathered in chunks."""
+        matrix = self.matrix()
+        distances = np.empty(len(rows), dtype=np.float64)
+        for start in range(0, len(rows), chunk_rows):
+            difference = matrix[rows[start:start + chunk_rows]] - query
+            distances[start:start + len(difference)] = np.einsum('ij,ij->i', difference, difference)
+        return distances
+
+    def nearest(self, target_spectrogram, num_matches=config.NUM_MATCHES, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """
+        Find the stored spectrograms closest to the target in Euclidean distance, by exact scan.
+
+        Returns:
+            tuple: (record ids, distances) of the closest matches, nearest first.
+        """
+        distances = self.squared_distances(self.query_vector(target_spectrogram), chunk_rows=chunk_rows)
+        ids = np.array(self.ids())
+        distances[ids == DELETED_ID] = np.inf
+
+        closest = top_k(distances, num_matches)
+        return ids[closest], np.sqrt(distances[closest])
+
+    def nearest_many(self, target_spectrograms, num_matches=config.NUM_MATCHES, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS, query_block=config.FEATURE_MATRIX_QUERY_BLOCK):
+        """
+        Exact nearest matches for many targets at once, as one matrix product per chunk of rows.
+
+        Queries are processed query_block at a time and a running top-k is kept per query,
+        so memory stays bounded by query_block * chunk_rows distances.
+
+        Returns:
+            list of tuple: (record ids, distances) for each target, nearest first.
+        """
+        if not len(target_spectrograms):
+            return []
+        queries = np.stack([self.query_vector(target) for target in target_spectrograms]).astype(np.float64)
+        ids = np.array(self.ids())
+        matrix = self.matrix()
+        results = []
+
+        for block_start in range(0, len(queries), query_block):
+            block = queries[block_start:block_start + query_block]
+            block_norms = np.einsum('ij,ij->i', block, block)
+            best_rows = np.empty((len(block), 0), dtype=np.int64)
+            best_distances = np.empty((len(block), 0), dtype=np.float64)
+
+            for start in range(0, self.rows, chunk_rows):
+                chunk = np.asarray(matrix[start:start + chunk_rows], dtype=np.float64)
+                distances = block_norms[:, None] - 2 * block @ chunk.T + np.einsum('ij,ij->i', chunk, chunk)[None, :]
+                distances[:, ids[start:start + len(chunk)] == DELETED_ID] = np.inf
+
+                best_rows = np.hstack([best_rows, np.broadcast_to(np.arange(start, start + len(chunk)), distances.shape)])
+                best_distances = np.hstack([best_distances, distances])
+                if best_distances.shape[1] > num_matches:
+                    keep = np.argpartition(best_distances, num_matches - 1, axis=1)[:, :num_matches]
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                    best_distances = np.take_along_axis(best_distances, keep, axis=1)
+
+            order = np.argsort(best_distances, axis=1, kind='stable')
+            best_rows = np.take_along_axis(best_rows, order, axis=1)
+            best_distances = np.take_along_axis(best_distances, order, axis=1)
+            for rows, distances in zip(best_rows, best_distances):
+                finite = np.isfinite(distances)
+                results.append((ids[rows[finite]], np.sqrt(np.maximum(distances[finite], 0))))
+
+        return results
@@ -0,0 +1,94 @@
+import os
+import sys
+from functools import lru_cache, cached_property
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import sparse
+from scipy.fft import rfft, rfftfreq
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+class FFTPlan:
+    """Precomputed framing and windowing state for one (samplerate, window_length, step_size) configuration."""
+
+    def __init__(self, samplerate, window_length, step_size):
+        self.samplerate = samplerate
+        self.window_length = window_length
+        self.step_size = step_size
+
+        self.window = np.hanning(window_length)
+        self.n_bins = window_length // 2
+        self.frequencies = rfftfreq(window_length, 1.0 / samplerate)[:self.n_bins]
+
+        # Plans are shared between callers through the cache, so keep them read-only.
+        for array in (self.window, self.frequencies):
+            array.setflags(write=False)
+
+    @property
+    def key(self):
+        return (self.samplerate, self.window_length, self.step_size)
+
+    def frame(self, data):
+        """Return a zero-copy (num_windows, window_length) view of the windows of data."""
+        if len(data) < self.window_length:
+            return np.empty((0, self.window_length), dtype=data.dtype)
+        return sliding_window_view(data, self.window_length)[::self.step_size]
+
+    def magnitude_spectrum(self, frames):
+        """Windowed, scaled magnitude half-spectrum of every frame in one batched rfft."""
+        spectrum = rfft(frames * self.window, axis=-1)[:, :self.n_bins]
+        fft_results = np.abs(spectrum)
+        fft_results *= 2.0 / self.window_length
+        return fft_results
+
+class FeaturePlan(FFTPlan):
+    """An FFTPlan plus the Mel filterbank for n_filters bands, built on first use."""
+
+    def __init__(self, samplerate, window_length, step_size, n_filters):
+        super().__init__(samplerate, window_length, step_size)
+        self.n_filters = n_filters
+
+    @property
+    def key(self):
+        return (self.samplerate, self.window_length, self.step_size, self.n_filters)
+
+    @cached_property
+    def mel_filters(self):
+        # librosa is slow to import and only needed here, once per plan
+        import librosa
+        mel_filters = librosa.filters.mel(sr=self.samplerate, n_fft=(self.window_length-1), n_mels=(self.n_filters-1))
+        mel_filters.setflags(write=False)
+        return mel_filters
+
+    @cached_property
+    def mel_projection(self):
+        # The filterbank is almost entirely zeros: keep a sparse (n_mels, n_bins) copy for projection.
+        return sparse.csr_array(self.mel_filters)
+
+    def project_mel(self, fft_results):
+        """Project (num_windows, n_bins) magnitudes onto the Mel filterbank."""
+        mel_bins = self.mel_filters.shape[1]
+        if fft_results.shape[1] != mel_bins:
+            raise ValueError(f"Mismatch between FFT results and Mel filterbank dimensions: {fft_results.shape[1]} != {mel_bins}")
+        return np.ascontiguousarray((self.mel_projection @ fft_results.T).T)
+
+    def frames_to_mel(self, frames):
+        """Frames to Mel spectrogram in a single call."""
+        return self.project_mel(self.magnitude_spectrum(frames))
+
+    def signal_to_mel(self, data):
+        return self.frames_to_mel(self.frame(data))
+
+@lru_cache(maxsize=config.FEATURE_PLAN_CACHE_SIZE)
+def get_fft_plan(samplerate, window_length, step_size):
+    """Return the memoized FFTPlan for this configuration, for callers that need no Mel projection."""
+    return FFTPlan(samplerate, window_length, step_size)
+
+@lru_cache(maxsize=config.FEATURE_PLAN_CACHE_SIZE)
+def get_feature_plan(samplerate, window_length, step_size, n_filters):
+    """Return the memoized FeaturePlan for this configuration, building it on first use."""
+    return FeaturePlan(samplerate, window_length, step_size, n_filters)
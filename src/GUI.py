@@ -2,13 +2,12 @@
 
 import sys
 import os
-import sounddevice as sd  
-import soundfile as sf
+import threading
 from PySide6.QtWidgets import (
     QMainWindow, QWidget, QVBoxLayout, QPushButton,
-    QFileDialog, QTableView, QMessageBox, QScrollArea, QLabel
+    QFileDialog, QTableView, QMessageBox, QScrollArea, QLabel, QProgressBar
 )
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QThreadPool
 from PySide6.QtGui import QPixmap, QAction
 
 # Dynamically add 'src' to the module search path
@@ -20,8 +19,11 @@ from Config import config
 from AudioProcessor import AudioProcessor
 from DataClusterer import DataClusterer
 from SpectrogramStorage import SpectrogramStorage
-from SpectrogramPlotter import SpectrogramPlotter
+from ThumbnailCache import ThumbnailCache
+from FeatureCache import FeatureCache
 from ClickableQLabel import ClickableQLabel
+from Ingester import Ingester
+from GUIWorkers import IngestWorker, FindWorker, PlaybackWorker
 
 class GUI(QMainWindow):
     def __init__(self):
@@ -30,8 +32,16 @@ class GUI(QMainWindow):
         self.setGeometry(100, 100, 800, 600)
         self.storage = SpectrogramStorage()
         self.audio_processor = AudioProcessor(config.FFT_WINDOW_SIZE, config.FFT_STEP_SIZE, config.FFT_N_FILTERS)
-        self.clusterer = DataClusterer()
-        self.plotter = SpectrogramPlotter()
+        # Searches run on pool threads, one at a time under search_lock, on a connection of their own
+        self.search_lock = threading.Lock()
+        self.clusterer = DataClusterer(storage=SpectrogramStorage(self.storage.db_file, check_same_thread=False))
+        self.thumbnails = ThumbnailCache(self.storage.thumbnail_dir, config.PLOT_SIZE)
+        # Repeated queries skip decoding; the cache's connection is serialised by the cache itself
+        self.feature_cache = FeatureCache(self.storage.feature_cache_dir, self.audio_processor, SpectrogramStorage(self.storage.db_file, check_same_thread=False))
+        self.ingester = Ingester()
+        self.pool = QThreadPool.globalInstance()
+        self.ingest_worker = None
+        self.find_workers = set()
         self.init_ui()
 
     def init_ui(self):
@@ -56,11 +66,11 @@ class GUI(QMainWindow):
         layout.addWidget(scroll_area)
 
         # Initialize Model and Table View
-        self.model = RecordTableModel()
+        self.model = RecordTableModel(thumbnails=self.thumbnails, storage=self.storage)
         self.table_view.setModel(self.model)
         
         # Set custom delegate for the spectrogram column
-        self.spectrogram_delegate = SpectrogramDelegate(self.table_view)
+        self.spectrogram_delegate = SpectrogramDelegate(self.table_view, self.thumbnails, self.storage.db_file)
         self.table_view.setItemDelegateForColumn(2, self.spectrogram_delegate)
 
         # Initialize Table Content
@@ -98,6 +108,27 @@ class GUI(QMainWindow):
         find_match_action.triggered.connect(self.find_closest_match)
         match_menu.addAction(find_match_action)
 
+        # Add toggle for ranking on embeddings rather than whole spectrograms
+        self.embedding_search_action = QAction("Rank by &Embedding", self)
+        self.embedding_search_action.setCheckable(True)
+        self.embedding_search_action.setChecked(config.SEARCH_MODE == 'embedding')
+        match_menu.addAction(self.embedding_search_action)
+
+        # Add toggle for searching only the query's cluster neighbourhood
+        self.cluster_filter_action = QAction("Search Query's &Cluster Only", self)
+        self.cluster_filter_action.setCheckable(True)
+        match_menu.addAction(self.cluster_filter_action)
+
+        # Progress of background ingests, with a button to stop them
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.clicked.connect(self.cancel_ingest)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
     def wipe_database(self):
         """Wipe the database with user confirmation."""
         reply = QMessageBox.question(
@@ -116,44 +147,98 @@ class GUI(QMainWindow):
         """Ingest a file into the database."""
         file_path, _ = QFileDialog.getOpenFileName(self, "Select a file", filter="WAV Files (*.wav)")
         if file_path:
-            mel_spectrogram = self.audio_processor.wav_file_to_mel_spectrogram(file_path)
-            self.storage.save_data_to_sql(mel_spectrogram, file_path)
-            self.update_table()
+            self.start_ingest([file_path])
 
     def ingest_directory(self):
         """Add all files from a directory"""
         dir_path = QFileDialog.getExistingDirectory(self, "Select a directory")
         if dir_path:
-            for file_name in os.listdir(dir_path):
-                if file_name.endswith('.wav'):  # Only process WAV files
-                    file_path = os.path.join(dir_path, file_name)
-                    mel_spectrogram = self.audio_processor.wav_file_to_mel_spectrogram(file_path)
-                    self.storage.save_data_to_sql(mel_spectrogram, file_path)
+            file_paths = [
+                os.path.join(dir_path, file_name)
+                for file_name in os.listdir(dir_path)
+                if file_name.endswith('.wav')  # Only process WAV files
+            ]
+            self.start_ingest(file_paths)
+
+    def start_ingest(self, file_paths):
+        """Ingest files in the background, showing new records as each batch is committed."""
+        if self.ingest_worker is not None:
+            QMessageBox.information(self, "Ingest Running", "Wait for the current ingest to finish or cancel it first.")
+            return
+        worker = IngestWorker(file_paths, self.audio_processor, self.storage.db_file, workers=config.INGEST_WORKERS)
+        worker.signals.progress.connect(self.on_ingest_progress)
+        worker.signals.committed.connect(self.on_ingest_committed)
+        worker.signals.result.connect(self.on_ingest_result)
+        worker.signals.error.connect(lambda error: QMessageBox.critical(self, "Ingest Failed", error))
+        worker.signals.finished.connect(self.on_ingest_finished)
+        self.ingest_worker = worker
+
+        self.progress_bar.setRange(0, 0)  # Busy until the files to process are known
+        self.progress_bar.show()
+        self.cancel_button.setEnabled(True)
+        self.cancel_button.show()
+        self.statusBar().showMessage(f"Checking {len(file_paths)} files...")
+        self.pool.start(worker)
+
+    def cancel_ingest(self):
+        if self.ingest_worker is not None:
+            self.ingest_worker.cancel()
+            self.cancel_button.setEnabled(False)
+            self.statusBar().showMessage("Cancelling...")
+
+    def on_ingest_progress(self, done, total):
+        self.progress_bar.setRange(0, max(total, 1))
+        self.progress_bar.setValue(done)
+        if self.ingest_worker is not None and not self.ingest_worker.cancelled:
+            self.statusBar().showMessage(f"Ingesting {done}/{total}")
+
+    def on_ingest_committed(self, stats):
+        if stats['inserted']:
             self.update_table()
 
+    def on_ingest_result(self, result):
+        stats, failures = result['stats'], result['failures']
+        state = "Cancelled" if result['cancelled'] else "Done"
+        self.statusBar().showMessage(f"{state}: {stats['inserted']} added, {stats['duplicates']} duplicates, {len(failures)} failed", 10000)
+        if failures:
+            QMessageBox.warning(self, "Ingest Errors", "\n".join(f"{path}: {error}" for path, error in failures))
+
+    def on_ingest_finished(self):
+        self.ingest_worker = None
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
     def find_closest_match(self):
         """Find the closest match for a file."""
         filepath, _ = QFileDialog.getOpenFileName(self, "Select the subject of your search", filter="WAV Files (*.wav)")
 
         if filepath:
             print(f'Filepath {filepath}')
-            mel_spectrogram = self.audio_processor.wav_file_to_mel_spectrogram(filepath)
-            plot_path = filepath.replace('.wav', f'.png')
-            plt = self.plotter.plot_mel_spectrogram(mel_spectrogram, plot_path)
-            print(f'Show {plot_path}')
-            plt.close()
-
-            closest_match_ids = self.clusterer.find_closest_matches_in_db(mel_spectrogram)
-            if closest_match_ids:
-                self.update_table()
-                self.select_table_row(closest_match_ids[0])
-            else:
-                QMessageBox.information(self, "No Matches", "No closest matches found.")
+            mode = 'embedding' if self.embedding_search_action.isChecked() else 'spectrogram'
+            worker = FindWorker(filepath, self.audio_processor, self.clusterer, self.search_lock, mode,
+                                cluster_filter=self.cluster_filter_action.isChecked(), feature_cache=self.feature_cache)
+            worker.signals.result.connect(self.on_find_result)
+            worker.signals.error.connect(lambda error: QMessageBox.critical(self, "Search Failed", error))
+            worker.signals.finished.connect(lambda: self.find_workers.discard(worker))
+            self.find_workers.add(worker)
+            self.statusBar().showMessage(f"Searching for {os.path.basename(filepath)}...")
+            self.pool.start(worker)
+
+    def on_find_result(self, closest_match_ids):
+        if closest_match_ids is None:
+            return
+        self.statusBar().clearMessage()
+        if len(closest_match_ids):
+            self.update_table()
+            self.select_table_row(closest_match_ids[0])
+        else:
+            QMessageBox.information(self, "No Matches", "No closest matches found.")
 
     def update_table(self):
-        """Update the model with data from the database."""
-        records = self.storage.fetch_ids_and_paths()
-        self.model.setRecords(records)
+        """Bring the model up to date with the database; new records are appended as rows."""
+        if self.model.sync():
+            # Loaded records were replaced, so re-ingested files may have new thumbnails under the same path
+            self.spectrogram_delegate.clear_cache()
 
     def select_table_row(self, match_id):
         """Select the row in the table corresponding to the match_id."""
@@ -162,20 +247,29 @@ class GUI(QMainWindow):
             print("Error: match_id is not an integer:", match_id)
             return
 
-        for row in range(self.model.rowCount()):
-            if self.model.data(self.model.index(row, 0)) == match_id:
-                print(f'Table select row for {match_id}')
-                self.table_view.selectRow(row)
-                # Implement clicking the image label if necessary
-                break
+        row = self.model.row_for_id(match_id)
+        if row is not None:
+            print(f'Table select row for {match_id}')
+            self.table_view.selectRow(row)
+            self.table_view.scrollTo(self.model.index(row, 0))
+            # Implement clicking the image label if necessary
 
     def play_audio_file(self, file_path):
-        """Play an audio file given its file path."""
-        try:
-            print(f'Play {file_path}')
-            data, samplerate = sf.read(file_path)
-            sd.play(data, samplerate)
-            sd.wait()  # Wait until the audio finishes playing
-        except Exception as e:
-            print(f"Error playing file {file_path}: {e}")
-            QMessageBox.critical(self, "Error", f"Failed to play audio file: {e}")
+        """Play an audio file given its file path, without blocking the UI."""
+        print(f'Play {file_path}')
+        worker = PlaybackWorker(file_path)
+        worker.signals.error.connect(lambda error: self.on_playback_error(file_path, error))
+        self.pool.start(worker)
+
+    def on_playback_error(self, file_path, error):
+        print(f"Error playing file {file_path}: {error}")
+        QMessageBox.critical(self, "Error", f"Failed to play audio file: {error}")
+
+    def closeEvent(self, event):
+        """Stop background work before the window and its connections go away."""
+        if self.ingest_worker is not None:
+            self.ingest_worker.cancel()
+        for worker in list(self.find_workers):
+            worker.cancel()
+        self.pool.waitForDone()
+        super().closeEvent(event)
@@ -0,0 +1,143 @@
+# src/GUIWorkers.py
+
+import os
+import sys
+import threading
+
+from PySide6.QtCore import QObject, QRunnable, Signal
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+class WorkerSignals(QObject):
+    # (files done, files to do)
+    progress = Signal(int, int)
+    # Counts of a batch of records just committed to the database
+    committed = Signal(object)
+    result = Signal(object)
+    error = Signal(str)
+    finished = Signal()
+
+class Worker(QRunnable):
+    """
+    Pool task that runs work() off the UI thread and reports back through signals.
+
+    Signals are delivered to the UI thread as queued events, so slots may touch widgets.
+    cancel() only sets a flag; work() checks it between steps and returns early.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            self.signals.result.emit(self.work())
+        except Exception as e:
+            self.signals.error.emit(f"{type(e).__name__}: {e}")
+        finally:
+            self.signals.finished.emit()
+
+    def work(self):
+        raise NotImplementedError
+
+class IngestWorker(Worker):
+    """
+    Ingest WAV files on the process pool, with a storage connection of its own.
+
+    Emits progress after every file and committed after every batch, so the table can show
+    new records while the rest are still being processed.
+
+    Result:
+        dict: {'stats', 'failures', 'cancelled'} as returned by Ingester.process_files.
+    """
+
+    def __init__(self, filepaths, audio_processor, db_file, plotter=None, workers=config.INGEST_WORKERS, batch_size=config.GUI_BATCH_SIZE):
+        super().__init__()
+        self.filepaths = filepaths
+        self.audio_processor = audio_processor
+        self.db_file = db_file
+        self.plotter = plotter
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def work(self):
+        import multiprocessing
+        from SpectrogramStorage import SpectrogramStorage
+        from Ingester import Ingester
+
+        # SQLite connections cannot cross threads, so open one here rather than borrowing the UI's
+        storage = SpectrogramStorage(self.db_file)
+        try:
+            ingester = Ingester()
+            pending = ingester.plan_incremental(self.filepaths, storage, self.audio_processor.feature_config)
+            total = len(pending)
+            self.signals.progress.emit(0, total)
+            stats, failures = ingester.process_files(
+                pending, self.audio_processor, storage, self.plotter, self.workers, self.batch_size,
+                progress=lambda done, _: self.signals.progress.emit(done, total),
+                should_stop=self._cancelled.is_set,
+                on_commit=self.signals.committed.emit,
+                # Forking a process that runs Qt's threads can deadlock the child on a lock they held
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        finally:
+            storage.close()
+        return {'stats': stats, 'failures': failures, 'cancelled': self.cancelled}
+
+class FindWorker(Worker):
+    """
+    Extract a query's features, through feature_cache if given, and search the catalogue.
+
+    The clusterer's storage must have been opened with check_same_thread=False; lock serialises
+    searches, since several finds may be queued at once.
+
+    Result:
+        numpy.ndarray or None: Record ids of the closest matches, nearest first; None if cancelled.
+    """
+
+    def __init__(self, filepath, audio_processor, clusterer, lock, mode=config.SEARCH_MODE, num_matches=config.NUM_MATCHES, cluster_filter=False, feature_cache=None):
+        super().__init__()
+        self.cluster_filter = cluster_filter
+        self.feature_cache = feature_cache
+        self.filepath = filepath
+        self.audio_processor = audio_processor
+        self.clusterer = clusterer
+        self.lock = lock
+        self.mode = mode
+        self.num_matches = num_matches
+
+    def work(self):
+        if self.feature_cache is None:
+            mel_spectrogram = self.audio_processor.wav_file_to_mel_spectrogram(self.filepath)
+        else:
+            mel_spectrogram = self.feature_cache.features(self.filepath)
+        if self.cancelled:
+            return None
+        with self.lock:
+            return self.clusterer.find_closest_matches_in_db(mel_spectrogram, self.num_matches, mode=self.mode, cluster_filter=self.cluster_filter)
+
+class PlaybackWorker(Worker):
+    """Decode an audio file and start playing it. Returns as soon as playback starts; a new playback replaces the current one."""
+
+    def __init__(self, filepath):
+        super().__init__()
+        self.filepath = filepath
+
+    def work(self):
+        import sounddevice as sd
+        import soundfile as sf
+
+        data, samplerate = sf.read(self.filepath)
+        sd.play(data, samplerate)
+        return self.filepath
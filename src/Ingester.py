@@ -1,21 +1,267 @@
 import os
+import sys
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-def wav_file_to_mel_spectrogram(filepath, audio_processor, storage, plotter):
-    """Process a single WAV file and save spectrograms and plots."""
-    print(f"Processing file: {filepath}")
-    spectrograms = audio_processor.wav_file_to_mel_spectrogram(filepath)
-
-    storage.save_data_to_sql(spectrograms, filepath)
-    
-    plot_path = filepath.replace('.wav', f'.png')
-    plt = plotter.plot_mel_spectrogram(spectrograms, plot_path)
-    plt.close()
-    print(f"Processed and saved spectrograms for {filepath}")
-
-def process_directory(directory_path, audio_processor, storage, plotter):
-    """Process all WAV files in a directory and its subdirectories."""
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            if file.lower().endswith('.wav'):
-                filepath = os.path.join(root, file)
-                wav_file_to_mel_spectrogram(filepath, audio_processor, storage, plotter)
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from EmbeddingClusterer import EmbeddingClusterer
+from Metrics import metrics, timed
+
+# Per-process state for pool workers, set by _init_worker
+_worker_audio_processor = None
+_worker_plotter = None
+_worker_content_hash = False
+
+def _init_worker(audio_processor, plotter, content_hash=False, metrics_enabled=False):
+    global _worker_audio_processor, _worker_plotter, _worker_content_hash
+    _worker_audio_processor = audio_processor
+    _worker_plotter = plotter
+    _worker_content_hash = content_hash
+    # A forked worker starts with a copy of the parent's metrics, which must not be sent back
+    metrics.reset()
+    metrics.enable(metrics_enabled)
+
+def _extract_one(filepath, audio_processor, plotter, content_hash):
+    """Decode, transform and optionally render one file. Never raises."""
+    try:
+        with metrics.stage('ingest.extract'):
+            fingerprint = Ingester.file_fingerprint(filepath, audio_processor.feature_config, content_hash)
+            spectrograms = audio_processor.wav_file_to_mel_spectrogram(filepath)
+            embedding = audio_processor.spectrogram_embedding(spectrograms)
+        if plotter is not None:
+            with metrics.stage('ingest.plot'):
+                plotter.render(spectrograms, filepath)
+        return filepath, spectrograms, fingerprint, embedding, None
+    except Exception as e:
+        return filepath, None, None, None, f"{type(e).__name__}: {e}"
+
+def _extract_features(filepath):
+    """Pool task: _extract_one with the worker's settings. Also returns the file's metrics, if enabled."""
+    result = _extract_one(filepath, _worker_audio_processor, _worker_plotter, _worker_content_hash)
+    # Each task ships its own measurements, cleared so the next task's are not sent twice
+    return result, metrics.snapshot(reset=True) if metrics.enabled else None
+
+class Ingester:
+    @staticmethod
+    def find_wav_files(directory_path):
+        """Yield every WAV file in a directory and its subdirectories."""
+        for root, _, files in os.walk(directory_path):
+            for file in files:
+                if file.lower().endswith('.wav'):
+                    yield os.path.join(root, file)
+
+    @staticmethod
+    def content_hash(filepath, chunk_size=1 << 20):
+        """Fast BLAKE2 digest of a file's bytes."""
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(filepath, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    @staticmethod
+    def file_fingerprint(filepath, feature_config, content_hash=False):
+        """Size, mtime, optional content hash and feature settings identifying one ingested file."""
+        stat = os.stat(filepath)
+        return {
+            'file_size': stat.st_size,
+            'file_mtime_ns': stat.st_mtime_ns,
+            'content_hash': Ingester.content_hash(filepath) if content_hash else None,
+            'feature_config': feature_config,
+        }
+
+    @timed('ingest.plan')
+    def plan_incremental(self, filepaths, storage, feature_config, content_hash=False):
+        """
+        Select the files that need (re)processing, using one bulk read of the stored fingerprints.
+
+        Files whose size, mtime and feature settings all match are skipped. With content_hash,
+        a file whose stat changed but whose bytes did not is also skipped and its stored
+        fingerprint refreshed. Records of changed files are kept until their replacement is
+        saved, so a file that no longer decodes keeps its record and is retried next time.
+
+        Returns:
+            list of str: Files that are new, changed or were ingested with other settings.
+        """
+        known = storage.fetch_fingerprints()
+        pending = []
+        stale = []
+        refreshed = {}
+
+        for filepath in filepaths:
+            stored = known.get(filepath)
+            if stored is None:
+                pending.append(filepath)
+                continue
+
+            current = self.file_fingerprint(filepath, feature_config)
+            if stored['feature_config'] == feature_config:
+                if (stored['file_size'], stored['file_mtime_ns']) == (current['file_size'], current['file_mtime_ns']):
+                    continue
+                if content_hash and stored['content_hash'] and stored['content_hash'] == self.content_hash(filepath):
+                    refreshed[filepath] = dict(current, content_hash=stored['content_hash'])
+                    continue
+
+            stale.append(filepath)
+            pending.append(filepath)
+
+        if refreshed:
+            storage.update_fingerprints(refreshed)
+
+        print(f"{len(pending)} files to process ({len(stale)} changed), {len(known) - len(stale)} already catalogued")
+        return pending
+
+    def prune_missing(self, directory_path, storage):
+        """Delete records of files under directory_path that no longer exist. Returns the number pruned."""
+        prefix = os.path.join(directory_path, '')
+        missing = [
+            filename for filename in storage.fetch_fingerprints()
+            if filename.startswith(prefix) and not os.path.exists(filename)
+        ]
+        if missing:
+            storage.delete_filenames(missing)
+            print(f"Pruned {len(missing)} records of deleted files")
+        return len(missing)
+
+    def wav_file_to_mel_spectrogram(self, filepath, audio_processor, storage, plotter, content_hash=False):
+        """Process a single WAV file and save spectrograms and, if given a plotter, its image."""
+        print(f"Processing file: {filepath}")
+        fingerprint = self.file_fingerprint(filepath, audio_processor.feature_config, content_hash)
+        spectrograms = audio_processor.wav_file_to_mel_spectrogram(filepath)
+        embedding = audio_processor.spectrogram_embedding(spectrograms)
+
+        storage.save_data_to_sql(spectrograms, filepath, fingerprint, embedding, replace=True)
+
+        if plotter is not None:
+            plotter.render(spectrograms, filepath)
+        print(f"Processed and saved spectrograms for {filepath}")
+
+    def process_directory(self, directory_path, audio_processor, storage, plotter, workers=config.INGEST_WORKERS, incremental=True, content_hash=False, prune=True):
+        """
+        Process all new or changed WAV files in a directory and its subdirectories.
+
+        Returns:
+            tuple: (counts, failures) as returned by process_files.
+        """
+        filepaths = self.find_wav_files(directory_path)
+        if incremental:
+            filepaths = self.plan_incremental(filepaths, storage, audio_processor.feature_config, content_hash)
+        if prune:
+            self.prune_missing(directory_path, storage)
+
+        return self.process_files(filepaths, audio_processor, storage, plotter, workers, content_hash=content_hash)
+
+    @staticmethod
+    def worker_pool(audio_processor, plotter=None, workers=config.INGEST_WORKERS, content_hash=False, mp_context=None):
+        """
+        Process pool for extract_features, for callers that extract many times and keep one pool.
+
+        mp_context is the multiprocessing context of the pool, by default the platform's; callers
+        with threads of their own running should pass a 'spawn' one, since forking them is unsafe.
+        """
+        workers = workers if workers > 0 else os.cpu_count()
+        return ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker, initargs=(audio_processor, plotter, content_hash, metrics.enabled))
+
+    @staticmethod
+    def extract_features(filepaths, audio_processor, plotter=None, workers=config.INGEST_WORKERS, content_hash=False, mp_context=None, executor=None):
+        """
+        Decode and transform WAV files on a process pool, yielding results in input order.
+
+        The pool is executor if given, which must come from worker_pool with the same settings and
+        is left running; otherwise one is made with worker_pool and shut down when done. Without
+        an executor, one worker means the files are processed in this process, one at a time.
+
+        Yields:
+            tuple: (filepath, spectrogram, fingerprint, embedding, error); error is None on success,
+            otherwise a message and the other values are None.
+        """
+        workers = workers if workers > 0 else os.cpu_count()
+        if workers == 1 and executor is None:
+            for filepath in filepaths:
+                yield _extract_one(filepath, audio_processor, plotter, content_hash)
+            return
+
+        own_executor = executor is None
+        if own_executor:
+            executor = Ingester.worker_pool(audio_processor, plotter, workers, content_hash, mp_context)
+        # Only a few files per worker are in flight, so a long or lazy list of paths is never
+        # submitted all at once and results can be saved while later files are still decoding
+        window = deque()
+        try:
+            for filepath in filepaths:
+                window.append(executor.submit(_extract_features, filepath))
+                if len(window) >= workers * 4:
+                    result, worker_metrics = window.popleft().result()
+                    metrics.merge(worker_metrics)
+                    yield result
+            while window:
+                result, worker_metrics = window.popleft().result()
+                metrics.merge(worker_metrics)
+                yield result
+        finally:
+            # If the caller stops early, drop the files not yet started instead of finishing them
+            for future in window:
+                future.cancel()
+            if own_executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def process_files(self, filepaths, audio_processor, storage, plotter=None, workers=config.INGEST_WORKERS, batch_size=config.DB_BATCH_SIZE, content_hash=False,
+                      progress=None, should_stop=None, on_commit=None, assign_clusters=True, mp_context=None):
+        """
+        Decode and transform WAV files on a process pool, writing results through the single storage connection.
+
+        Args:
+            filepaths (iterable of str): WAV files to ingest.
+            audio_processor (AudioProcessor): Processor used, pickled, by every worker.
+            storage (SpectrogramStorage): The only writer; receives results in batches.
+            plotter (ThumbnailCache, SpectrogramPlotter or None): If given, workers also render an image of each file.
+            workers (int): Number of worker processes; 0 or less means one per CPU, and 1 processes
+                the files in this process.
+            batch_size (int): Number of results per storage transaction.
+            content_hash (bool): Also store a content hash in each file's fingerprint.
+            progress (callable or None): Called with (files done, filepath) after each file.
+            should_stop (callable or None): Polled after each file; when it returns True, files not yet
+                started are dropped and the results so far are saved.
+            on_commit (callable or None): Called with the counts of each batch once it is committed.
+            assign_clusters (bool): If the catalogue has been clustered, label each committed batch
+                with its nearest clusters; reclustering is left to DataClusterer.update_clusters.
+            mp_context (multiprocessing context or None): Context of the worker pool; see extract_features.
+
+        Returns:
+            tuple: (dict of inserted/replaced/duplicates/skipped counts, list of (filepath, error message) for files that failed).
+        """
+        failures = []
+        cluster_model = EmbeddingClusterer.load(storage) if assign_clusters else None
+
+        def committed(saved):
+            if cluster_model is not None:
+                cluster_model.assign_unclustered(storage)
+            if on_commit is not None:
+                on_commit(saved)
+
+        # Files already catalogued (changed ones, or every one in a full run) have their records replaced
+        with storage.batch_writer(batch_size, committed, replace=True) as writer:
+            results = self.extract_features(filepaths, audio_processor, plotter, workers, content_hash, mp_context)
+            for done, (filepath, spectrograms, fingerprint, embedding, error) in enumerate(results, start=1):
+                metrics.count('ingest.files')
+                if error is not None:
+                    print(f"Error processing {filepath}: {error}")
+                    failures.append((filepath, error))
+                    metrics.count('ingest.failures')
+                else:
+                    print(f"Processed file: {filepath}")
+                    writer.add(spectrograms, filepath, fingerprint, embedding)
+                if progress is not None:
+                    progress(done, filepath)
+                if should_stop is not None and should_stop():
+                    print(f"Stopped after {done} files")
+                    results.close()
+                    break
+
+        stats = writer.stats
+        print(f"Saved {stats['inserted']} spectrograms ({stats['replaced']} replacing stored ones), {stats['duplicates']} duplicates, {len(failures)} files failed")
+        return stats, failures
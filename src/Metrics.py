@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import atexit
+import time
+import bisect
+import functools
+import threading
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+# Upper bounds in seconds of the latency histogram buckets, as in Prometheus' defaults but wider
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0,
+)
+
+class _NullStage:
+    """What stage() returns while metrics are off: entering and leaving it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+class Metrics:
+    """
+    Process-wide counters and per-stage latency histograms.
+
+    Off by default, in which case stage() hands back a shared no-op context manager and count()
+    and observe() return at once, so instrumented code can stay in production paths. Worker
+    processes ship their snapshot() back to be merge()d. Summaries are JSON (to_dict) or
+    Prometheus text exposition (to_prometheus).
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        # name -> [bucket counts..., +Inf count], sum, min, max
+        self.histograms = {}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def stage(self, name):
+        """Context manager timing one run of a stage into its histogram."""
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {'buckets': [0] * (len(BUCKETS) + 1), 'sum': 0.0, 'min': seconds, 'max': seconds}
+            histogram['buckets'][bucket] += 1
+            histogram['sum'] += seconds
+            histogram['min'] = min(histogram['min'], seconds)
+            histogram['max'] = max(histogram['max'], seconds)
+
+    def snapshot(self, reset=False):
+        """Raw counters and histograms, e.g. to send from a worker process; optionally clear them."""
+        with self.lock:
+            snapshot = {
+                'counters': dict(self.counters),
+                'histograms': {name: dict(histogram, buckets=list(histogram['buckets'])) for name, histogram in self.histograms.items()},
+            }
+            if reset:
+                self.counters = {}
+                self.histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add a snapshot taken in another process."""
+        if not snapshot:
+            return
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot['histograms'].items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    self.histograms[name] = dict(other, buckets=list(other['buckets']))
+                    continue
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['sum'] += other['sum']
+                histogram['min'] = min(histogram['min'], other['min'])
+                histogram['max'] = max(histogram['max'], other['max'])
+
+    @staticmethod
+    def _quantile(histogram, q):
+        """Quantile estimated by linear interpolation within its bucket, clamped to the observed range."""
+        counts = histogram['buckets']
+        target = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= target:
+                lower = BUCKETS[index - 1] if index > 0 else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else histogram['max']
+                estimate = lower + (upper - lower) * (target - seen) / count
+                return min(max(estimate, histogram['min']), histogram['max'])
+            seen += count
+        return histogram['max']
+
+    def to_dict(self):
+        """JSON-ready summary: counters, and per stage its count, total and latency percentiles in milliseconds."""
+        snapshot = self.snapshot()
+        stages = {}
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            count = sum(histogram['buckets'])
+            stages[name] = {
+                'count': count,
+                'total_s': histogram['sum'],
+                'mean_ms': histogram['sum'] / count * 1000,
+                'min_ms': histogram['min'] * 1000,
+                'p50_ms': self._quantile(histogram, 0.5) * 1000,
+                'p90_ms': self._quantile(histogram, 0.9) * 1000,
+                'p99_ms': self._quantile(histogram, 0.99) * 1000,
+                'max_ms': histogram['max'] * 1000,
+            }
+        return {'counters': dict(sorted(snapshot['counters'].items())), 'stages': stages}
+
+    def to_prometheus(self, prefix=config.METRICS_PREFIX):
+        """Prometheus text exposition: one histogram family labelled by stage, one counter family labelled by name."""
+        snapshot = self.snapshot()
+        lines = [f"# HELP {prefix}_stage_seconds Time spent per pipeline stage.", f"# TYPE {prefix}_stage_seconds histogram"]
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, '+Inf'), histogram['buckets']):
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {cumulative}')
+        lines += [f"# HELP {prefix}_events_total Pipeline event counts.", f"# TYPE {prefix}_events_total counter"]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+# The process's metrics; METRICS_ENABLED turns them on for every run
+metrics = Metrics(enabled=bool(config.METRICS_ENABLED))
+
+def timed(name):
+    """Decorator timing every call of a function as stage name."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            with metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def add_metrics_arguments(parser):
+    """Add the --metrics-out, --metrics-format, --profile and --profile-out options to a script's parser."""
+    parser.add_argument("--metrics-out", help="Write per-stage timings and counters to this file, or - for stderr.")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], help="Summary format; by default Prometheus text for .prom files and JSON otherwise.")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and print the top functions to stderr.")
+    parser.add_argument("--profile-out", help="Run under cProfile and save the stats to this file.")
+
+def write_summary(path, output_format=None):
+    if output_format is None:
+        output_format = 'prometheus' if path.endswith('.prom') else 'json'
+    text = metrics.to_prometheus() if output_format == 'prometheus' else json.dumps(metrics.to_dict(), indent=2) + '\n'
+    if path == '-':
+        sys.stderr.write(text)
+    else:
+        with open(path, 'w') as f:
+            f.write(text)
+
+def instrument_script(args):
+    """
+    Apply add_metrics_arguments' options to a script run: collect metrics if a summary is wanted and
+    profile with cProfile if asked. Both are written out when the interpreter exits, even on failure.
+    """
+    metrics_out = getattr(args, 'metrics_out', None)
+    profile_out = getattr(args, 'profile_out', None) or ('-' if getattr(args, 'profile', False) else None)
+    profiler = None
+    if metrics_out:
+        metrics.enable()
+    if profile_out:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler is not None:
+            profiler.disable()
+            if profile_out == '-':
+                import pstats
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
+            else:
+                profiler.dump_stats(profile_out)
+        if metrics_out:
+            write_summary(metrics_out, getattr(args, 'metrics_format', None))
+
+    atexit.register(finish)
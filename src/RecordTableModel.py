@@ -1,14 +1,44 @@
 # src/RecordTableModel.py
 
+import os
+import sys
+
 from PySide6.QtCore import QAbstractTableModel, Qt, QModelIndex
 
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+# Role giving (record id, filename) of the spectrogram column, so a delegate can render a missing thumbnail
+THUMBNAIL_SOURCE_ROLE = Qt.UserRole + 1
+
 class RecordTableModel(QAbstractTableModel):
-    def __init__(self, records=None, parent=None):
+    """
+    Catalogue records as (id, filename) rows, in id order.
+
+    With a storage, rows are paged in lazily: the view calls fetchMore as it scrolls, and each
+    page is read with keyset pagination (id > last loaded id), so opening a large catalogue
+    reads a single page. Record ids only grow, so new records are appended by sync() as row
+    inserts instead of a model reset. An id to row index makes row_for_id O(1).
+    """
+
+    def __init__(self, records=None, parent=None, thumbnails=None, storage=None, page_size=config.TABLE_PAGE_SIZE):
         super().__init__(parent)
-        self.records = records if records is not None else []
+        self.records = []
+        self.row_of = {}
+        # With a ThumbnailCache, the spectrogram column gives cached thumbnail paths, rendered on first display
+        self.thumbnails = thumbnails
+        self.storage = storage
+        self.page_size = page_size
+        self.last_id = 0
+        # Whether every stored record has been loaded; cleared by sync() when new ones may exist
+        self.exhausted = storage is None
+        if records is not None:
+            self._append(records)
 
     def rowCount(self, parent=QModelIndex()):
-        return len(self.records)
+        return 0 if parent.isValid() else len(self.records)
 
     def columnCount(self, parent=QModelIndex()):
         return 3  # ID, Filename, Spectrogram
@@ -19,6 +49,10 @@ class RecordTableModel(QAbstractTableModel):
         row = index.row()
         column = index.column()
 
+        if role == THUMBNAIL_SOURCE_ROLE and column == 2:
+            record = self.records[row]
+            return (record[0], record[1])
+
         if role == Qt.DisplayRole:
             record = self.records[row]
             if column == 0:
@@ -26,6 +60,8 @@ class RecordTableModel(QAbstractTableModel):
             elif column == 1:
                 return record[1]  # Filename
             elif column == 2:
+                if self.thumbnails is not None:
+                    return self.thumbnails.path_for(record[1])
                 plot_path = record[1].replace('.wav', '.png')
                 return plot_path  # Return the image path for the delegate to use
 
@@ -38,8 +74,78 @@ class RecordTableModel(QAbstractTableModel):
                 return headers[section]
         return None
 
-    def setRecords(self, records):
+    def _append(self, records):
+        for record in records:
+            self.row_of[record[0]] = len(self.records)
+            self.records.append(record)
+        if self.records:
+            self.last_id = max(self.last_id, self.records[-1][0])
+
+    def _insert(self, records):
+        if records:
+            first = len(self.records)
+            self.beginInsertRows(QModelIndex(), first, first + len(records) - 1)
+            self._append(records)
+            self.endInsertRows()
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        page = self.storage.fetch_ids_and_paths_after(self.last_id, self.page_size)
+        if len(page) < self.page_size:
+            self.exhausted = True
+        self._insert(page)
+
+    def sync(self):
+        """
+        Catch up with the catalogue after records were added or deleted.
+
+        New records are inserted as rows if everything before them is loaded, otherwise left for
+        fetchMore. If loaded records were deleted, the model is reset to its first page.
+
+        Returns:
+            bool: Whether the model was reset.
+        """
+        if self.storage is None:
+            return False
+        if self.storage.count_records_up_to(self.last_id) != len(self.records):
+            self.reset()
+            return True
+        if self.exhausted:
+            # Everything is loaded, so the view will not ask for more: insert the new rows here
+            while True:
+                page = self.storage.fetch_ids_and_paths_after(self.last_id, self.page_size)
+                self._insert(page)
+                if len(page) < self.page_size:
+                    break
+        return False
+
+    def reset(self):
+        """Drop every loaded row; the view pages them in again."""
         self.beginResetModel()
-        self.records = records
+        self.records = []
+        self.row_of = {}
+        self.last_id = 0
+        self.exhausted = self.storage is None
         self.endResetModel()
 
+    def row_for_id(self, record_id):
+        """Row of a record, paging in the records before it if needed. None if it is not in the catalogue."""
+        record_id = int(record_id)
+        while record_id not in self.row_of and record_id > self.last_id and self.canFetchMore():
+            self.fetchMore()
+        return self.row_of.get(record_id)
+
+    def setRecords(self, records):
+        """Show a fixed list of records instead of paging them from storage."""
+        self.beginResetModel()
+        self.records = []
+        self.row_of = {}
+        self.last_id = 0
+        self.storage = None
+        self.exhausted = True
+        self._append(records)
+        self.endResetModel()
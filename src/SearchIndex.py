@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import time
+from abc import ABC, abstractmethod
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from FeatureMatrix import DELETED_ID, top_k
+
+class SearchIndex(ABC):
+    """
+    Nearest-neighbour index over the rows of a FeatureMatrix, searched by Euclidean distance.
+
+    An index covers the first built_rows rows of one matrix generation. Rows appended since
+    are scanned exactly on every search until the tail outgrows SEARCH_INDEX_REBUILD_RATIO,
+    and deleted rows are filtered out, so results stay complete between rebuilds.
+
+    A saved index is '.index.json', its layout, next to '.index.npz', its arrays, so loading
+    one never unpickles anything.
+    """
+
+    # Names of the attributes holding the index's arrays, saved to and loaded from the .npz
+    ARRAYS = ()
+
+    kind = None
+
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.built_rows = 0
+        self.generation = None
+        self.loaded = False
+
+    @property
+    def index_path(self):
+        return f"{self.matrix.path}.{self.kind}.index"
+
+    def is_current(self):
+        """Whether the index still describes the matrix well enough to be searched."""
+        if self.generation != self.matrix.generation or self.built_rows > self.matrix.rows:
+            return False
+        return self.matrix.rows - self.built_rows <= config.SEARCH_INDEX_REBUILD_RATIO * max(self.built_rows, 1)
+
+    def refresh(self, matrix=None):
+        """Attach to the (re-synced) matrix, loading the saved index or rebuilding it if stale."""
+        if matrix is not None:
+            self.matrix = matrix
+        if not self.loaded:
+            self.loaded = self.load()
+        if not self.is_current():
+            start = time.perf_counter()
+            self.build()
+            self.save()
+            self.loaded = True
+            print(f"Built {self.kind} index of {self.built_rows} rows in {time.perf_counter() - start:.2f}s")
+        return self
+
+    def _meta(self):
+        return {'built_rows': self.built_rows, 'generation': self.generation, 'arrays': [name for name in self.ARRAYS if getattr(self, name) is not None]}
+
+    def save(self):
+        # Arrays first, so the layout never names arrays that are not there yet
+        tmp_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_path, **{name: getattr(self, name) for name in self.ARRAYS if getattr(self, name) is not None})
+        os.replace(tmp_path, self.index_path + '.npz')
+        tmp_path = self.index_path + '.json.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._meta(), f)
+        os.replace(tmp_path, self.index_path + '.json')
+
+    def load(self):
+        """Load the saved index, if any. Returns whether one was loaded."""
+        try:
+            with open(self.index_path + '.json') as f:
+                meta = json.load(f)
+            with np.load(self.index_path + '.npz', allow_pickle=False) as arrays:
+                loaded = {name: arrays[name] for name in meta['arrays']}
+        except (OSError, ValueError, KeyError):
+            # Missing, partial or from an older version: build it again
+            return False
+        self.built_rows = meta['built_rows']
+        self.generation = meta['generation']
+        for name in self.ARRAYS:
+            setattr(self, name, loaded.get(name))
+        return True
+
+    def build(self):
+        self.built_rows = self.matrix.rows
+        self.generation = self.matrix.generation
+
+    @abstractmethod
+    def candidates(self, query, num_matches):
+        """Candidate rows among the first built_rows and their squared distances to the query."""
+
+    def search(self, target_spectrogram, num_matches=config.NUM_MATCHES):
+        """
+        Find the stored rows closest to the target.
+
+        Returns:
+            tuple: (record ids, distances) of the closest matches, nearest first.
+        """
+        query = self.matrix.query_vector(target_spectrogram)
+        rows, distances = self.candidates(query, num_matches)
+
+        # Rows appended since the index was built are scanned exactly
+        if self.built_rows < self.matrix.rows:
+            rows = np.concatenate([rows, np.arange(self.built_rows, self.matrix.rows)])
+            distances = np.concatenate([distances, self.matrix.squared_distances(query, self.built_rows)])
+
+        ids = np.array(self.matrix.ids())[rows]
+        distances[ids == DELETED_ID] = np.inf
+        closest = top_k(distances, num_matches)
+        return ids[closest], np.sqrt(distances[closest])
+
+    def search_many(self, target_spectrograms, num_matches=config.NUM_MATCHES):
+        """Search for each target; returns a list of (record ids, distances)."""
+        return [self.search(target, num_matches) for target in target_spectrograms]
+
+class BruteForceIndex(SearchIndex):
+    """Exact scan of every row; nothing to build or store."""
+
+    kind = 'brute'
+
+    def is_current(self):
+        return True
+
+    def load(self):
+        return True
+
+    def candidates(self, query, num_matches):
+        # Nothing is indexed: every row is in the exactly scanned tail
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    def search(self, target_spectrogram, num_matches=config.NUM_MATCHES):
+        return self.matrix.nearest(target_spectrogram, num_matches)
+
+    def search_many(self, target_spectrograms, num_matches=config.NUM_MATCHES):
+        return self.matrix.nearest_many(target_spectrograms, num_matches)
+
+class TreeIndex(SearchIndex):
+    """
+    Exact search through a scikit-learn BallTree, held in memory only: it is built from the
+    matrix when first searched in a process, and never saved.
+    """
+
+    kind = 'tree'
+
+    def __init__(self, matrix):
+        super().__init__(matrix)
+        self.tree = None
+
+    def save(self):
+        pass
+
+    def load(self):
+        return False
+
+    def build(self):
+        from sklearn.neighbors import BallTree
+
+        super().build()
+        self.tree = BallTree(np.asarray(self.matrix.matrix()), leaf_size=config.TREE_LEAF_SIZE) if self.built_rows else None
+
+    def candidates(self, query, num_matches):
+        if self.tree is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        # Ask for enough extra neighbours to cover rows deleted since the build
+        k = min(num_matches + self.matrix.meta['deleted'], self.built_rows)
+        distances, rows = self.tree.query(query.reshape(1, -1), k=k)
+        return rows[0], distances[0] ** 2
+
+class IVFIndex(SearchIndex):
+    """
+    Approximate search with an inverted file: rows are grouped under k-means centroids and
+    only the nprobe lists nearest the query are scanned. More probes raise recall and latency.
+    """
+
+    kind = 'ivf'
+    ARRAYS = ('centroids', 'order', 'offsets')
+
+    def __init__(self, matrix, nlist=config.IVF_NLIST, nprobe=config.IVF_NPROBE):
+        super().__init__(matrix)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.order = None
+        self.offsets = None
+
+    @staticmethod
+    def _assign(data, centroids, chunk_rows=config.FEATURE_MATRIX_CHUNK_ROWS):
+        """Index of the nearest centroid for each row of data."""
+        centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+        labels = np.empty(len(data), dtype=np.int64)
+        for start in range(0, len(data), chunk_rows):
+            chunk = np.asarray(data[start:start + chunk_rows], dtype=np.float32)
+            labels[start:start + len(chunk)] = np.argmin(centroid_norms - 2 * chunk @ centroids.T, axis=1)
+        return labels
+
+    def _kmeans(self, data, n_clusters, iterations=config.IVF_TRAIN_ITERATIONS, seed=0):
+        rng = np.random.default_rng(seed)
+        centroids = data[rng.choice(len(data), n_clusters, replace=False)].copy()
+        for _ in range(iterations):
+            labels = self._assign(data, centroids)
+            order = np.argsort(labels, kind='stable')
+            counts = np.bincount(labels, minlength=n_clusters)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            filled = counts > 0
+            # Empty clusters keep their previous centroid
+            sums = np.add.reduceat(data[order], starts[filled], axis=0)
+            centroids[filled] = sums / counts[filled, None]
+        return centroids
+
+    def build(self):
+        super().build()
+        if not self.built_rows:
+            self.centroids = self.order = self.offsets = None
+            return
+
+        matrix = self.matrix.matrix()
+        nlist = self.nlist if self.nlist > 0 else int(np.sqrt(self.built_rows))
+        nlist = max(1, min(nlist, self.built_rows))
+
+        # Train on a sample, then assign every row
+        rng = np.random.default_rng(0)
+        sample_size = min(self.built_rows, config.IVF_TRAIN_SAMPLE)
+        sample_rows = np.sort(rng.choice(self.built_rows, sample_size, replace=False))
+        self.centroids = self._kmeans(np.asarray(matrix[sample_rows], dtype=np.float32), nlist)
+
+        labels = self._assign(matrix[:self.built_rows], self.centroids)
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))])
+
+    def candidates(self, query, num_matches):
+        if self.centroids is None:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        centroid_distances = np.einsum('ij,ij->i', self.centroids - query, self.centroids - query)
+        probes = top_k(centroid_distances, self.nprobe)
+        rows = np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probes]))
+
+        return rows, self.matrix.squared_distances_at(query, rows)
+
+INDEX_TYPES = {index_type.kind: index_type for index_type in (BruteForceIndex, TreeIndex, IVFIndex)}
+
+def open_index(matrix, kind=config.SEARCH_INDEX):
+    """Load the saved index of this kind for the matrix, building it if missing or stale."""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown search index: {kind}. Expected one of {', '.join(INDEX_TYPES)}")
+    return INDEX_TYPES[kind](matrix).refresh()
+
+def evaluate_index(index, num_queries=100, num_matches=config.NUM_MATCHES, seed=0):
+    """
+    Measure an index against an exact scan, using stored rows as queries.
+
+    Returns:
+        dict: recall@num_matches and per-query latency in milliseconds for the index and the exact scan.
+    """
+    matrix = index.matrix
+    rng = np.random.default_rng(seed)
+    live_rows = np.flatnonzero(np.array(matrix.ids()) != DELETED_ID)
+    query_rows = rng.choice(live_rows, min(num_queries, len(live_rows)), replace=False)
+    queries = [np.array(matrix.matrix()[row]).reshape(matrix.shape) for row in query_rows]
+
+    recalls, latencies, exact_latencies = [], [], []
+    for query in queries:
+        start = time.perf_counter()
+        exact_ids, _ = matrix.nearest(query, num_matches)
+        exact_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ids, _ = index.search(query, num_matches)
+        latencies.append(time.perf_counter() - start)
+
+        recalls.append(len(np.intersect1d(ids, exact_ids)) / max(len(exact_ids), 1))
+
+    def milliseconds(values):
+        return {
+            'mean': 1000 * float(np.mean(values)),
+            'p50': 1000 * float(np.percentile(values, 50)),
+            'p95': 1000 * float(np.percentile(values, 95)),
+        }
+
+    return {
+        'kind': index.kind,
+        'rows': matrix.rows,
+        'queries': len(queries),
+        'num_matches': num_matches,
+        'recall': float(np.mean(recalls)) if recalls else None,
+        'latency_ms': milliseconds(latencies) if latencies else None,
+        'exact_latency_ms': milliseconds(exact_latencies) if exact_latencies else None,
+    }
@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import stat
+import time
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from SpectrogramStorage import SpectrogramStorage
+from DataClusterer import DataClusterer
+from Ingester import Ingester
+from Metrics import metrics
+
+class SearchService:
+    """
+    Warm state behind the search daemon: one storage connection, the memory-mapped matrices and
+    the loaded indexes, kept for the life of the process.
+
+    Query features are extracted concurrently by the request threads, batches on one process pool
+    kept until close(); catalogue access and searches are serialised by a lock, which ingest
+    only takes to sync the matrices once its files are saved. Before each search the database's
+    data_version is checked, and the matrices and indexes are synced incrementally only when it
+    has changed.
+    """
+
+    def __init__(self, audio_processor, db_file=config.DB_FILE, mode=config.SEARCH_MODE, index=config.SEARCH_INDEX, workers=config.INGEST_WORKERS):
+        self.audio_processor = audio_processor
+        self.storage = SpectrogramStorage(db_file, check_same_thread=False)
+        self.clusterer = DataClusterer(storage=self.storage, auto_sync=False)
+        self.mode = mode
+        self.index = index
+        self.workers = workers
+        # Worker processes are started by the request threads, so spawned rather than forked from them
+        self.mp_context = multiprocessing.get_context('spawn')
+        # The pool only starts its processes once a batch is submitted
+        self.executor = Ingester.worker_pool(audio_processor, workers=workers, mp_context=self.mp_context) if workers != 1 else None
+        self.lock = threading.Lock()
+        self.ingest_lock = threading.Lock()
+        self.data_version = None
+        self.started = time.time()
+        self.requests = 0
+        self.refreshes = 0
+
+    def warm(self):
+        """Open the default matrix and index before the first request arrives."""
+        with self.lock:
+            self.data_version = self.storage.data_version()
+            if self.mode in ('spectrogram', 'embedding'):
+                self.clusterer.search_index(self.mode, self.index)
+            else:
+                self.clusterer.feature_matrix()
+
+    def _refresh_if_changed(self, force=False):
+        """Sync with the catalogue if another connection has committed since the last check. Call with the lock held."""
+        version = self.storage.data_version()
+        if force or version != self.data_version:
+            self.clusterer.refresh()
+            self.data_version = version
+            self.refreshes += 1
+
+    def extract(self, paths):
+        """Query features for each path, as (path, spectrogram, error)."""
+        if len(paths) > 1 and self.executor is not None:
+            return [
+                (filepath, spectrogram, error)
+                for filepath, spectrogram, _, _, error in Ingester.extract_features(paths, self.audio_processor, workers=self.workers, executor=self.executor)
+            ]
+        results = []
+        for filepath in paths:
+            try:
+                results.append((filepath, self.audio_processor.wav_file_to_mel_spectrogram(filepath), None))
+            except Exception as e:
+                results.append((filepath, None, f"{type(e).__name__}: {e}"))
+        return results
+
+    def match(self, paths, num_matches=config.NUM_MATCHES, mode=None, index=None):
+        """
+        Closest catalogued records for each query file.
+
+        Returns:
+            list of dict: One {'query', 'matches', 'error'} per path, in order, with matches as
+            {'rank', 'id', 'filename', 'distance'}, the same shape as batch find's JSON Lines.
+        """
+        mode = mode or self.mode
+        index = index or self.index
+        extracted = self.extract(paths)
+        targets = [(filepath, spectrogram) for filepath, spectrogram, error in extracted if error is None]
+
+        with self.lock:
+            self._refresh_if_changed()
+            self.requests += 1
+            matches = self.clusterer.find_closest_matches_in_db_many([spectrogram for _, spectrogram in targets], num_matches, mode, index)
+            filenames = self.storage.fetch_filenames({int(record_id) for ids, _ in matches for record_id in ids})
+
+        found = {
+            filepath: [
+                {'rank': rank, 'id': int(record_id), 'filename': filenames.get(int(record_id)), 'distance': float(distance)}
+                for rank, (record_id, distance) in enumerate(zip(ids, distances), start=1)
+            ]
+            for (filepath, _), (ids, distances) in zip(targets, matches)
+        }
+        return [
+            {'query': filepath, 'matches': found.get(filepath, []), 'error': error}
+            for filepath, _, error in extracted
+        ]
+
+    def notify(self, paths=None):
+        """
+        Pick up catalogue changes: ingest the given files, if any, then sync the matrices and indexes.
+
+        Returns:
+            dict: Ingest counts and the number of rows now searchable.
+        """
+        stats, failures = {}, []
+        if paths:
+            # Ingest on a connection of its own, so searches carry on meanwhile; one ingest at a time
+            with self.ingest_lock:
+                storage = SpectrogramStorage(self.storage.db_file)
+                try:
+                    ingester = Ingester()
+                    filepaths = [filepath for path in paths for filepath in (ingester.find_wav_files(path) if os.path.isdir(path) else [path])]
+                    pending = ingester.plan_incremental(filepaths, storage, self.audio_processor.feature_config)
+                    stats, failures = ingester.process_files(pending, self.audio_processor, storage, workers=self.workers, mp_context=self.mp_context)
+                finally:
+                    storage.close()
+        with self.lock:
+            self._refresh_if_changed(force=True)
+            rows = self.clusterer.feature_matrix().rows
+        return {'ingested': stats, 'failures': [{'path': path, 'error': error} for path, error in failures], 'rows': rows}
+
+    def status(self):
+        with self.lock:
+            matrices = {mode: {'rows': matrix.rows, 'generation': matrix.generation} for mode, matrix in self.clusterer.matrices.items()}
+            return {
+                'db': self.storage.db_file,
+                'uptime_s': time.time() - self.started,
+                'requests': self.requests,
+                'refreshes': self.refreshes,
+                'matrices': matrices,
+                'indexes': [f"{mode}/{kind}" for mode, kind in self.clusterer.indexes],
+            }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            self.storage.close()
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON over HTTP:
+
+        GET  /status
+        GET  /metrics (Prometheus text; empty unless metrics are enabled)
+        POST /match   {"paths": [...], "num_matches": 5, "mode": ..., "index": ...}
+        POST /notify  {"paths": [...]}   (files or directories to ingest; optional)
+    """
+
+    server_version = "SpectrogramSearch/1.0"
+
+    def address_string(self):
+        # Unix socket clients have no host address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def _send(self, status, payload, content_type='application/json'):
+        body = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._send(200, self.server.service.status())
+        elif self.path == '/metrics':
+            self._send(200, metrics.to_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {'error': f"Unknown endpoint: {self.path}"})
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self._send(400, {'error': f"Invalid JSON: {e}"})
+            return
+
+        service = self.server.service
+        try:
+            if self.path == '/match':
+                results = service.match(request.get('paths', []), request.get('num_matches', config.NUM_MATCHES), request.get('mode'), request.get('index'))
+                self._send(200, {'results': results})
+            elif self.path == '/notify':
+                self._send(200, service.notify(request.get('paths')))
+            else:
+                self._send(404, {'error': f"Unknown endpoint: {self.path}"})
+        except ValueError as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': f"{type(e).__name__}: {e}"})
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host=config.SERVICE_HOST, port=config.SERVICE_PORT, socket_path=None):
+    """HTTP server for the service on a TCP port, or on a Unix socket if socket_path is given."""
+    if socket_path:
+        try:
+            mode = os.lstat(socket_path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            # Only a socket left behind by an earlier run is ours to replace
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"Refusing to replace {socket_path}: it exists and is not a socket")
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, SearchRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), SearchRequestHandler)
+    server.service = service
+    return server
@@ -0,0 +1,136 @@
+import os
+import sys
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from FeatureMatrix import top_k
+
+def sliding_distances(query, record, normalize=True, chunk_frames=config.SEGMENT_CHUNK_FRAMES):
+    """
+    Distance from the query to every window of the record with the query's length (a distance profile).
+
+    The correlation at every offset comes from FFTs, summed over bands, and window sums from
+    prefix sums, so there is no loop per offset. Long records are processed chunk_frames offsets
+    at a time (overlap-save), which bounds memory by the chunk rather than the recording.
+
+    Args:
+        query (numpy.ndarray): (m, n_bands) query spectrogram.
+        record (numpy.ndarray): (n, n_bands) stored spectrogram, n >= m.
+        normalize (bool): Compare z-normalised windows, so level differences do not count.
+        chunk_frames (int): Offsets computed per FFT.
+
+    Returns:
+        numpy.ndarray: n - m + 1 Euclidean distances, one per start frame.
+    """
+    m, n_bands = query.shape
+    n_offsets = record.shape[0] - m + 1
+    length = m * n_bands
+
+    frame_sums = np.concatenate([[0], np.cumsum(record.sum(axis=1))])
+    frame_squares = np.concatenate([[0], np.cumsum(np.einsum('ij,ij->i', record, record))])
+    window_sums = frame_sums[m:] - frame_sums[:-m]
+    window_squares = frame_squares[m:] - frame_squares[:-m]
+
+    size = next_fast_len(min(chunk_frames, n_offsets) + m - 1)
+    reversed_query = rfft(query[::-1], size, axis=0)
+    correlation = np.empty(n_offsets)
+    for start in range(0, n_offsets, chunk_frames):
+        stop = min(start + chunk_frames, n_offsets)
+        segment = record[start:stop + m - 1]
+        # Valid part of the convolution with the reversed query: correlation at offsets start..stop
+        full = irfft((rfft(segment, size, axis=0) * reversed_query).sum(axis=1), size)
+        correlation[start:stop] = full[m - 1:m - 1 + stop - start]
+
+    if not normalize:
+        squared = np.einsum('ij,ij->', query, query) + window_squares - 2 * correlation
+        return np.sqrt(np.maximum(squared, 0))
+
+    query_mean = query.mean()
+    query_std = query.std()
+    window_mean = window_sums / length
+    window_std = np.sqrt(np.maximum(window_squares / length - window_mean ** 2, 0))
+
+    # Pearson correlation of each window with the query; flat windows or queries count as uncorrelated
+    denominator = length * query_std * window_std
+    pearson = np.divide(
+        correlation - length * query_mean * window_mean, denominator,
+        out=np.zeros(n_offsets), where=denominator > 1e-12
+    )
+    return np.sqrt(np.maximum(2 * length * (1 - np.clip(pearson, -1, 1)), 0))
+
+def separated_minima(distances, num_hits, exclusion):
+    """Start frames of up to num_hits lowest distances, at least exclusion frames apart, best first."""
+    distances = distances.copy()
+    offsets = []
+    for _ in range(num_hits):
+        offset = int(np.argmin(distances))
+        if not np.isfinite(distances[offset]):
+            break
+        offsets.append(offset)
+        distances[max(0, offset - exclusion):offset + exclusion + 1] = np.inf
+    return np.array(offsets, dtype=np.int64)
+
+class SegmentSearch:
+    """
+    Sub-sequence search: where in the stored recordings does a short sample occur?
+
+    Every stored spectrogram at least as long as the query is scanned with sliding_distances.
+    The best few non-overlapping offsets of each record compete for a library-wide top-k, so a
+    hit repeated in one recording can be reported more than once.
+    """
+
+    def __init__(self, storage, normalize=True, hits_per_record=config.SEGMENT_HITS_PER_RECORD, chunk_frames=config.SEGMENT_CHUNK_FRAMES):
+        self.storage = storage
+        self.normalize = normalize
+        self.hits_per_record = hits_per_record
+        self.chunk_frames = chunk_frames
+        self.stats = {}
+
+    def search(self, target_spectrogram, num_matches=config.NUM_MATCHES, batch_size=config.DB_BATCH_SIZE):
+        """
+        Locate the target in the stored spectrograms.
+
+        Returns:
+            tuple: (record ids, start frames, distances) of the best hits, nearest first.
+        """
+        query = np.asarray(target_spectrogram, dtype=np.float64)
+        m = query.shape[0]
+        # Hits in one recording may not overlap
+        exclusion = max(1, m - 1)
+
+        best_ids = np.empty(0, dtype=np.int64)
+        best_offsets = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0)
+        scanned = skipped = frames = 0
+
+        for ids, spectrograms in self.storage.iter_spectrograms_after(0, batch_size):
+            hit_ids, hit_offsets, hit_distances = [best_ids], [best_offsets], [best_distances]
+            for record_id, spectrogram in zip(ids, spectrograms):
+                if spectrogram.shape[0] < m or m == 0:
+                    skipped += 1
+                    continue
+                n_bands = min(query.shape[1], spectrogram.shape[1])
+                distances = sliding_distances(
+                    query[:, :n_bands], np.asarray(spectrogram[:, :n_bands], dtype=np.float64),
+                    self.normalize, self.chunk_frames
+                )
+                offsets = separated_minima(distances, self.hits_per_record, exclusion)
+                hit_ids.append(np.full(len(offsets), record_id, dtype=np.int64))
+                hit_offsets.append(offsets)
+                hit_distances.append(distances[offsets])
+                scanned += 1
+                frames += spectrogram.shape[0]
+
+            best_ids = np.concatenate(hit_ids)
+            best_offsets = np.concatenate(hit_offsets)
+            best_distances = np.concatenate(hit_distances)
+            closest = top_k(best_distances, num_matches)
+            best_ids, best_offsets, best_distances = best_ids[closest], best_offsets[closest], best_distances[closest]
+
+        self.stats = {'scanned': scanned, 'skipped': skipped, 'frames': frames}
+        print(f"Segment search: scanned {scanned} recordings ({frames} frames), skipped {skipped} shorter than the query")
+        return best_ids, best_offsets, best_distances
@@ -1,35 +1,131 @@
 # src/SpectrogramDelegate.py
 
+import os
+import sys
+import threading
+from collections import OrderedDict
+
 from PySide6.QtWidgets import QStyledItemDelegate, QLabel, QStyleOptionViewItem
-from PySide6.QtGui import QPainter, QPixmap
-from PySide6.QtCore import QSize, Qt, QRect, QEvent
+from PySide6.QtGui import QPainter, QPixmap, QImage
+from PySide6.QtCore import QSize, Qt, QRect, QEvent, QObject, QRunnable, QThreadPool, Signal
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from RecordTableModel import THUMBNAIL_SOURCE_ROLE
+
+# One storage connection per loader thread, opened on first use: SQLite connections cannot be shared between threads
+_thread_state = threading.local()
+
+def _thread_storage(db_file):
+    storage = getattr(_thread_state, 'storage', None)
+    if storage is None or storage.db_file != db_file:
+        from SpectrogramStorage import SpectrogramStorage
+        storage = _thread_state.storage = SpectrogramStorage(db_file)
+    return storage
+
+class ThumbnailSignals(QObject):
+    # (cache key, scaled image); a null image if the thumbnail could not be loaded
+    loaded = Signal(object, QImage)
+
+class ThumbnailLoader(QRunnable):
+    """Pool task: render the thumbnail if it is missing, then decode and scale it off the UI thread."""
+
+    def __init__(self, key, path, source, thumbnails, db_file, signals):
+        super().__init__()
+        self.key = key
+        self.path = path
+        self.source = source
+        self.thumbnails = thumbnails
+        self.db_file = db_file
+        self.signals = signals
+
+    def run(self):
+        image = QImage()
+        try:
+            if self.thumbnails is not None and self.source is not None and self.db_file:
+                record_id, filename = self.source
+                self.thumbnails.ensure(record_id, filename, _thread_storage(self.db_file))
+            image = QImage(self.path)
+            if not image.isNull():
+                _, width, height = self.key
+                image = image.scaled(width, height, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        except Exception as e:
+            print(f"Error loading thumbnail {self.path}: {e}")
+        self.signals.loaded.emit(self.key, image)
 
 class SpectrogramDelegate(QStyledItemDelegate):
-    def __init__(self, parent=None):
+    """
+    Paints spectrogram thumbnails from a bounded LRU cache of pixmaps pre-scaled to the cell.
+
+    A miss paints a placeholder and queues the load on a thread pool; when the image arrives it
+    is cached and the view repainted. QImage is decoded and scaled in the worker, and only the
+    cheap QImage to QPixmap conversion happens on the UI thread.
+    """
+
+    def __init__(self, parent=None, thumbnails=None, db_file=None, cache_size=config.PIXMAP_CACHE_SIZE):
         super().__init__(parent)
-    
+        self.thumbnails = thumbnails
+        self.db_file = db_file
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.pending = set()
+        self.pool = QThreadPool.globalInstance()
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.on_loaded)
+
     def paint(self, painter: QPainter, option: QStyleOptionViewItem, index):
         if index.column() == 2:  # Assuming column 2 is for spectrogram
-            pixmap = QPixmap(index.data())  # Fetch the image path
-            if not pixmap.isNull():
+            path = index.data()  # Fetch the image path
+            rect = self.getAdjustedRect(option)
+            pixmap = self.cached_pixmap(path, rect.size(), index.data(THUMBNAIL_SOURCE_ROLE)) if path else None
+            if pixmap is None:
+                painter.fillRect(rect, option.palette.midlight())
+            elif not pixmap.isNull():
                 # Paint the pixmap in the cell
-                rect = self.getAdjustedRect(option)
                 painter.drawPixmap(rect, pixmap)
         else:
             super().paint(painter, option, index)
-    
+
+    def cached_pixmap(self, path, size, source=None):
+        """The cached pixmap for path at size, or None after queueing a load if it is not cached yet."""
+        key = (path, size.width(), size.height())
+        pixmap = self.cache.get(key)
+        if pixmap is not None:
+            self.cache.move_to_end(key)
+            return pixmap
+        if key not in self.pending:
+            self.pending.add(key)
+            self.pool.start(ThumbnailLoader(key, path, source, self.thumbnails, self.db_file, self.signals))
+        return None
+
+    def on_loaded(self, key, image):
+        self.pending.discard(key)
+        # Failed loads are cached as null pixmaps too, so they are not retried on every repaint
+        self.cache[key] = QPixmap.fromImage(image) if not image.isNull() else QPixmap()
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        view = self.parent()
+        if view is not None:
+            view.viewport().update()
+
+    def clear_cache(self):
+        """Forget every cached pixmap, e.g. after thumbnails were re-rendered."""
+        self.cache.clear()
+
     def sizeHint(self, option, index):
         if index.column() == 2:
             return QSize(100, 100)  # Set size hint for the image
         else:
             return super().sizeHint(option, index)
-    
+
     def getAdjustedRect(self, option):
         rect = option.rect
         # Adjust the rect to ensure proper alignment
         rect.adjust(5, 5, -5, -5)
         return rect
-    
+
     def editorEvent(self, event, model, option, index):
         if event.type() == QEvent.MouseButtonRelease and index.column() == 2:
             # Handle click event
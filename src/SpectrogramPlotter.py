@@ -1,10 +1,11 @@
 
-import matplotlib.pyplot as plt
-
 class SpectrogramPlotter:
     @staticmethod
     def plot_mel_spectrogram(mel_spectrogram, filename):
         """Plot and save Mel spectrogram."""
+        # Imported here so that loading the plotter does not load matplotlib
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(12, 6))
         plt.imshow(mel_spectrogram.T, aspect='auto', origin='lower', cmap='inferno')
         plt.colorbar(format='%+2.0f dB')
@@ -15,4 +16,9 @@ class SpectrogramPlotter:
         # plt.close()
         return plt
 
+    def render(self, mel_spectrogram, wav_filename):
+        """Save the full-size plot next to the WAV file, as ingest used to."""
+        plt = self.plot_mel_spectrogram(mel_spectrogram, wav_filename.replace('.wav', '.png'))
+        plt.close()
+
 
@@ -9,13 +9,103 @@ import hashlib
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Config import config
+from Metrics import metrics, timed
+
+# Per-file fingerprint columns used to skip unchanged files on re-ingest
+FINGERPRINT_COLUMNS = {
+    'file_size': 'INTEGER',
+    'file_mtime_ns': 'INTEGER',
+    'content_hash': 'TEXT',
+    'feature_config': 'TEXT',
+}
+
+# Spectrograms are stored as raw little-endian samples described by these columns.
+# Rows written before versioning have a NULL format_version and hold an np.save blob.
+FORMAT_VERSION = 1
+FORMAT_COLUMNS = {
+    'format_version': 'INTEGER',
+    'n_frames': 'INTEGER',
+    'n_bands': 'INTEGER',
+    'dtype': 'TEXT',
+}
+SPECTROGRAM_COLUMNS = ', '.join(['spectrogram', *FORMAT_COLUMNS])
+
+# Fixed-length float32 summary of each spectrogram, see AudioProcessor.spectrogram_embedding
+EMBEDDING_COLUMNS = {
+    'embedding': 'BLOB',
+}
+
+# Columns after id, filename, spectrogram and spectrogram_hash, in insert order
+EXTRA_COLUMNS = {**FORMAT_COLUMNS, **EMBEDDING_COLUMNS, **FINGERPRINT_COLUMNS}
+
+# Files whose spectrogram is already stored under another file have no record of their own; the
+# spectrogram hash and fingerprint of each are kept in config.TABLE_DUPLICATE_FILES instead, so an
+# incremental ingest can skip them too
+
+# Cluster of each record and its distance to the nearest centroid, set after insert; NULL until assigned.
+# See EmbeddingClusterer; the fitted model itself is the single row of config.TABLE_CLUSTER_MODEL.
+CLUSTER_COLUMNS = {
+    'cluster_label': 'INTEGER',
+    'cluster_distance': 'REAL',
+}
+
+class BatchWriter:
+    """
+    Buffers records and writes them through SpectrogramStorage.save_many, one transaction per batch.
+
+    If given, on_flush is called with the counts of each committed batch, e.g. to show new rows as they land.
+    With replace, each record supersedes any stored record of the same file; see save_many.
+    """
+
+    def __init__(self, storage, batch_size=config.DB_BATCH_SIZE, on_flush=None, replace=False):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.replace = replace
+        self.batch = []
+        self.stats = {'inserted': 0, 'replaced': 0, 'duplicates': 0, 'skipped': 0}
+
+    def add(self, mel_spectrogram, filename, fingerprint=None, embedding=None):
+        self.batch.append((mel_spectrogram, filename, fingerprint, embedding))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            saved = self.storage.save_many(self.batch, self.batch_size, self.replace)
+            for key, count in saved.items():
+                self.stats[key] += count
+            self.batch = []
+            if self.on_flush is not None:
+                self.on_flush(saved)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Keep whatever was already produced, even if the caller is failing
+        self.flush()
 
 class SpectrogramStorage:
-    def __init__(self, db_file=config.DB_FILE):
+    def __init__(self, db_file=config.DB_FILE, check_same_thread=True):
         self.db_file = db_file
-        self.conn = sqlite3.connect(self.db_file)
+        self.feature_matrix_path = db_file + config.FEATURE_MATRIX_SUFFIX
+        self.embedding_matrix_path = db_file + config.EMBEDDING_MATRIX_SUFFIX
+        # Thumbnails default to a directory next to the database
+        self.thumbnail_dir = config.THUMBNAIL_DIR or db_file + '.thumbnails'
+        self.feature_cache_dir = config.FEATURE_CACHE_DIR or db_file + '.querycache'
+        # Pass check_same_thread=False only when every use of the connection is serialised by the caller
+        self.conn = sqlite3.connect(self.db_file, check_same_thread=check_same_thread)
+        self.configure_connection()
         self.create_table()
 
+    def configure_connection(self):
+        """Apply journal and sync pragmas suited to bulk writes."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"PRAGMA journal_mode={config.DB_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.DB_SYNCHRONOUS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+
     def drop_table(self):
         self.storage.conn.cursor().execute(f"DROP TABLE IF EXISTS {config.TABLE_SEPECTROGRAMS}")
 
@@ -27,10 +117,42 @@ class SpectrogramStorage:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 filename TEXT NOT NULL UNIQUE,
                 spectrogram BLOB,
-                spectrogram_hash TEXT NOT NULL UNIQUE
+                spectrogram_hash TEXT NOT NULL UNIQUE,
+                {', '.join(f'{column} {column_type}' for column, column_type in {**EXTRA_COLUMNS, **CLUSTER_COLUMNS}.items())}
+            )
+        ''')
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {config.TABLE_DUPLICATE_FILES} (
+                filename TEXT PRIMARY KEY,
+                spectrogram_hash TEXT NOT NULL,
+                {', '.join(f'{column} {column_type}' for column, column_type in FINGERPRINT_COLUMNS.items())}
+            )
+        ''')
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {config.TABLE_DUPLICATE_FILES}_spectrogram_hash ON {config.TABLE_DUPLICATE_FILES} (spectrogram_hash)")
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {config.TABLE_CLUSTER_MODEL} (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                model BLOB NOT NULL,
+                fitted_last_id INTEGER NOT NULL,
+                fitted_rows INTEGER NOT NULL,
+                mean_distance REAL,
+                fitted_at REAL NOT NULL
             )
         ''')
         self.conn.commit()
+        self.migrate_schema()
+
+    def migrate_schema(self):
+        """Add any columns missing from tables created by older versions."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"PRAGMA table_info({config.TABLE_SEPECTROGRAMS})")
+        existing = {row[1] for row in cursor.fetchall()}
+        for column, column_type in {**EXTRA_COLUMNS, **CLUSTER_COLUMNS}.items():
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {config.TABLE_SEPECTROGRAMS} ADD COLUMN {column} {column_type}")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {config.TABLE_SEPECTROGRAMS}_cluster_label ON {config.TABLE_SEPECTROGRAMS} (cluster_label)")
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {config.TABLE_SEPECTROGRAMS}_content_hash ON {config.TABLE_SEPECTROGRAMS} (content_hash)")
+        self.conn.commit()
 
     def compute_hash(self, data):
         """Compute an MD5 hash for the given data."""
@@ -38,41 +160,372 @@ class SpectrogramStorage:
         hasher.update(data)
         return hasher.hexdigest()
 
-    def save_data_to_sql(self, mel_spectrogram, filename):
-        """Save Mel spectrogram data to an SQLite database, ensure unique spectrogram data."""
-        
-        # Serialize the numpy array to a binary format
-        with io.BytesIO() as buffer:
-            np.save(buffer, mel_spectrogram)
-            blob = buffer.getvalue()
-        
-        # Compute hash of the spectrogram
-        spectrogram_hash = self.compute_hash(blob)
+    def serialize_spectrogram(self, mel_spectrogram):
+        """Serialize a spectrogram to raw little-endian bytes. Returns the BLOB, its hash and the format column values."""
+        dtype = np.dtype(config.SPECTROGRAM_STORAGE_DTYPE).newbyteorder('<')
+        mel_spectrogram = np.ascontiguousarray(mel_spectrogram, dtype=dtype)
+        n_frames, n_bands = mel_spectrogram.shape
+        blob = mel_spectrogram.tobytes()
+        spectrogram_hash = self.compute_hash(f"{n_frames}x{n_bands}:".encode() + blob)
+        return blob, spectrogram_hash, (FORMAT_VERSION, n_frames, n_bands, dtype.str)
+
+    @staticmethod
+    def deserialize_spectrogram(blob, format_version, n_frames, n_bands, dtype):
+        """Decode a stored spectrogram. Current-format rows are a read-only view over the BLOB, without copying."""
+        if format_version == FORMAT_VERSION:
+            return np.frombuffer(blob, dtype=np.dtype(dtype)).reshape(n_frames, n_bands)
+        with io.BytesIO(blob) as buffer:
+            return np.load(buffer, allow_pickle=False)
+
+    @staticmethod
+    def serialize_embedding(embedding):
+        return None if embedding is None else np.asarray(embedding, dtype='<f4').tobytes()
+
+    @staticmethod
+    def deserialize_embedding(blob):
+        return np.frombuffer(blob, dtype='<f4')
+
+    def _insert_row(self, mel_spectrogram, filename, fingerprint, embedding=None):
+        blob, spectrogram_hash, format_values = self.serialize_spectrogram(mel_spectrogram)
+        fingerprint = fingerprint or {}
+        return (
+            filename, blob, spectrogram_hash, *format_values,
+            self.serialize_embedding(embedding),
+            *(fingerprint.get(column) for column in FINGERPRINT_COLUMNS),
+        )
+
+    def _insert_sql(self):
+        columns = ['filename', 'spectrogram', 'spectrogram_hash', *EXTRA_COLUMNS]
+        placeholders = ', '.join('?' * len(columns))
+        return f"INSERT INTO {config.TABLE_SEPECTROGRAMS} ({', '.join(columns)}) VALUES ({placeholders})"
+
+    def save_data_to_sql(self, mel_spectrogram, filename, fingerprint=None, embedding=None, replace=False):
+        """Save Mel spectrogram data to an SQLite database, ensure unique spectrogram data. With replace, supersede the file's stored record."""
+        if replace:
+            # Only save_many knows when the old record may go
+            self.save_many([(mel_spectrogram, filename, fingerprint, embedding)], replace=True)
+            return
+
+        # Serialize the numpy array to a binary format and hash it
+        row = self._insert_row(mel_spectrogram, filename, fingerprint, embedding)
         
         cursor = self.conn.cursor()
         try:
-            cursor.execute(f'''
-                INSERT INTO {config.TABLE_SEPECTROGRAMS} (filename, spectrogram, spectrogram_hash)
-                VALUES (?, ?, ?)
-            ''', (filename, blob, spectrogram_hash))
+            cursor.execute(self._insert_sql(), row)
             self.conn.commit()
         except sqlite3.IntegrityError as e:
             print(f"Warning: A record with the same filename or spectrogram already exists. {e}")
             self.conn.rollback()
+
+    def save_many(self, records, batch_size=config.DB_BATCH_SIZE, replace=False):
+        """
+        Save (mel_spectrogram, filename, fingerprint[, embedding]) tuples with executemany, one transaction per batch.
+
+        Rows clashing with an existing filename or spectrogram hash are counted as duplicates
+        rather than raising; records without a spectrogram are skipped. A file whose spectrogram
+        is stored under another file has its fingerprint kept as a duplicate, see
+        fetch_fingerprints. With replace, the stored record of each file is deleted in the same
+        transaction as its new row is inserted, so a re-ingested file gets a new id (which the
+        feature matrices pick up as a delete plus an append); if the new row would be a
+        duplicate, the old record stays, so a file is never left without a record.
+
+        Returns:
+            dict: Counts of 'inserted', 'replaced' (stored records superseded), 'duplicates' and 'skipped' records.
+        """
+        stats = {'inserted': 0, 'replaced': 0, 'duplicates': 0, 'skipped': 0}
+        table = config.TABLE_SEPECTROGRAMS
+        insert_sql = self._insert_sql().replace('INSERT INTO', 'INSERT OR IGNORE INTO', 1)
+        # Delete a file's record unless its new spectrogram is stored under another file, when the insert would be ignored
+        replace_sql = f"""
+            DELETE FROM {table} WHERE filename = ?1
+            AND NOT EXISTS (SELECT 1 FROM {table} WHERE spectrogram_hash = ?2 AND filename != ?1)
+        """
+        duplicate_columns = ', '.join(['filename', 'spectrogram_hash', *FINGERPRINT_COLUMNS])
+        duplicate_sql = f"""
+            INSERT OR REPLACE INTO {config.TABLE_DUPLICATE_FILES} ({duplicate_columns})
+            SELECT ?1, ?2, {', '.join(f'?{index}' for index in range(3, 3 + len(FINGERPRINT_COLUMNS)))}
+            WHERE EXISTS (SELECT 1 FROM {table} WHERE spectrogram_hash = ?2 AND filename != ?1)
+        """
+        # Rows are filename, spectrogram, spectrogram_hash, then EXTRA_COLUMNS in order
+        fingerprint_start = 3 + len(FORMAT_COLUMNS) + len(EMBEDDING_COLUMNS)
+        records = list(records)
+
+        for start in range(0, len(records), batch_size):
+            with metrics.stage('storage.serialize'):
+                rows = [
+                    self._insert_row(*record)
+                    for record in records[start:start + batch_size]
+                    if record[0] is not None
+                ]
+            stats['skipped'] += min(batch_size, len(records) - start) - len(rows)
+
+            replaced = 0
+            with metrics.stage('storage.commit'), self.conn:
+                changes_before = self.conn.total_changes
+                if replace:
+                    # Row by row, so a spectrogram repeated within the batch is only new for its first file
+                    for row in rows:
+                        deleted_before = self.conn.total_changes
+                        self.conn.execute(replace_sql, (row[0], row[2]))
+                        replaced += self.conn.total_changes - deleted_before
+                        self.conn.execute(insert_sql, row)
+                else:
+                    self.conn.executemany(insert_sql, rows)
+                inserted = self.conn.total_changes - changes_before - replaced
+                self.conn.executemany(f"DELETE FROM {config.TABLE_DUPLICATE_FILES} WHERE filename = ?", [(row[0],) for row in rows])
+                self.conn.executemany(duplicate_sql, [
+                    (row[0], row[2], *row[fingerprint_start:fingerprint_start + len(FINGERPRINT_COLUMNS)])
+                    for row in rows if row[fingerprint_start] is not None
+                ])
+                if replaced:
+                    self._drop_orphaned_duplicates()
+            stats['replaced'] += replaced
+            metrics.count('storage.inserted', inserted)
+            metrics.count('storage.duplicates', len(rows) - inserted)
+            stats['inserted'] += inserted
+            stats['duplicates'] += len(rows) - inserted
+
+        return stats
+
+    def _drop_orphaned_duplicates(self):
+        """Forget duplicates of spectrograms no longer stored, so the next ingest gives them a record. Call in a transaction."""
+        self.conn.execute(f"""
+            DELETE FROM {config.TABLE_DUPLICATE_FILES}
+            WHERE spectrogram_hash NOT IN (SELECT spectrogram_hash FROM {config.TABLE_SEPECTROGRAMS})
+        """)
+
+    def batch_writer(self, batch_size=config.DB_BATCH_SIZE, on_flush=None, replace=False):
+        """Context manager that collects records and saves them in batches; see BatchWriter."""
+        return BatchWriter(self, batch_size, on_flush, replace)
+
+    def fetch_fingerprints(self):
+        """Fetch the stored fingerprint of every file, duplicates included, keyed by filename."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT filename, {', '.join(FINGERPRINT_COLUMNS)} FROM {config.TABLE_SEPECTROGRAMS}")
+        fingerprints = {
+            row[0]: dict(zip(FINGERPRINT_COLUMNS, row[1:]))
+            for row in cursor.fetchall()
+        }
+        # A file that kept its old record because its new spectrogram is a duplicate is described by the latter
+        cursor.execute(f"SELECT filename, {', '.join(FINGERPRINT_COLUMNS)} FROM {config.TABLE_DUPLICATE_FILES}")
+        fingerprints.update((row[0], dict(zip(FINGERPRINT_COLUMNS, row[1:]))) for row in cursor.fetchall())
+        return fingerprints
+
+    def update_fingerprints(self, fingerprints):
+        """Replace the stored fingerprints of already catalogued files, given as {filename: fingerprint}."""
+        assignments = ', '.join(f"{column} = ?" for column in FINGERPRINT_COLUMNS)
+        values = [(*(fingerprint.get(column) for column in FINGERPRINT_COLUMNS), filename) for filename, fingerprint in fingerprints.items()]
+        with self.conn:
+            for table in (config.TABLE_SEPECTROGRAMS, config.TABLE_DUPLICATE_FILES):
+                self.conn.executemany(f"UPDATE {table} SET {assignments} WHERE filename = ?", values)
+
+    def delete_filenames(self, filenames):
+        """Delete the records of the given files."""
+        with self.conn:
+            for table in (config.TABLE_SEPECTROGRAMS, config.TABLE_DUPLICATE_FILES):
+                self.conn.executemany(
+                    f"DELETE FROM {table} WHERE filename = ?",
+                    [(filename,) for filename in filenames]
+                )
+            self._drop_orphaned_duplicates()
     
+    def save_cluster_model(self, model, ids, labels, distances, fitted_at):
+        """Replace the clustering: the model BLOB and the label of every record it was fitted on, in one transaction."""
+        ids = [int(record_id) for record_id in ids]
+        with self.conn:
+            self.conn.execute(f"UPDATE {config.TABLE_SEPECTROGRAMS} SET cluster_label = NULL, cluster_distance = NULL")
+            self.conn.executemany(
+                f"UPDATE {config.TABLE_SEPECTROGRAMS} SET cluster_label = ?, cluster_distance = ? WHERE id = ?",
+                zip(map(int, labels), map(float, distances), ids)
+            )
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {config.TABLE_CLUSTER_MODEL} (id, model, fitted_last_id, fitted_rows, mean_distance, fitted_at) VALUES (1, ?, ?, ?, ?, ?)",
+                (model, max(ids, default=0), len(ids), float(np.mean(distances)) if len(ids) else None, fitted_at)
+            )
+
+    def fetch_cluster_model(self):
+        """The saved clustering model as a dict of its columns, or None if the catalogue has never been clustered."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT model, fitted_last_id, fitted_rows, mean_distance, fitted_at FROM {config.TABLE_CLUSTER_MODEL} WHERE id = 1")
+        row = cursor.fetchone()
+        return None if row is None else dict(zip(['model', 'fitted_last_id', 'fitted_rows', 'mean_distance', 'fitted_at'], row))
+
+    def cluster_model_fitted_at(self):
+        """When the saved clustering model was fitted, or None; cheap enough to poll before every search."""
+        row = self.conn.execute(f"SELECT fitted_at FROM {config.TABLE_CLUSTER_MODEL} WHERE id = 1").fetchone()
+        return None if row is None else row[0]
+
+    def update_cluster_labels(self, ids, labels, distances):
+        with self.conn:
+            self.conn.executemany(
+                f"UPDATE {config.TABLE_SEPECTROGRAMS} SET cluster_label = ?, cluster_distance = ? WHERE id = ?",
+                zip(map(int, labels), map(float, distances), map(int, ids))
+            )
+
+    def iter_unclustered_embeddings(self, batch_size=config.DB_BATCH_SIZE):
+        """Yield (ids, embeddings) batches of the records with an embedding but no cluster label yet, in id order."""
+        cursor = self.conn.cursor()
+        last_id = 0
+        while True:
+            cursor.execute(f'''
+                SELECT id, embedding FROM {config.TABLE_SEPECTROGRAMS}
+                WHERE id > ? AND cluster_label IS NULL AND embedding IS NOT NULL ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield [row[0] for row in rows], [self.deserialize_embedding(row[1]).reshape(1, -1) for row in rows]
+            last_id = rows[-1][0]
+
+    def cluster_drift(self):
+        """
+        How far the catalogue has moved since it was last clustered.
+
+        Returns:
+            dict or None: 'fitted_rows' and 'mean_distance' at the last fit, and the count and mean
+            centroid distance of the 'new_rows' labelled since; None if never clustered.
+        """
+        model = self.fetch_cluster_model()
+        if model is None:
+            return None
+        new_rows, new_mean_distance = self.conn.execute(
+            f"SELECT COUNT(*), AVG(cluster_distance) FROM {config.TABLE_SEPECTROGRAMS} WHERE id > ? AND cluster_label IS NOT NULL",
+            (model['fitted_last_id'],)
+        ).fetchone()
+        return {
+            'fitted_rows': model['fitted_rows'],
+            'mean_distance': model['mean_distance'],
+            'new_rows': new_rows,
+            'new_mean_distance': new_mean_distance,
+        }
+
+    def fetch_ids_in_clusters(self, labels, include_unclustered=True):
+        """Ids of the records in the given clusters, plus those not labelled yet unless include_unclustered is False."""
+        labels = [int(label) for label in labels]
+        condition = f"cluster_label IN ({', '.join('?' * len(labels))})" if labels else "0"
+        if include_unclustered:
+            condition += " OR cluster_label IS NULL"
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT id FROM {config.TABLE_SEPECTROGRAMS} WHERE {condition}", labels)
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    def data_version(self):
+        """SQLite's data_version: changes whenever another connection commits to the database."""
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def change_token(self):
+        """(data_version, total_changes): differs once this or any other connection has committed changes since it was taken."""
+        return self.data_version(), self.conn.total_changes
+
     def fetch_all_spectrograms(self):
         """Fetch all Mel spectrogram data from the SQLite database."""
         cursor = self.conn.cursor()
-        cursor.execute(f"SELECT spectrogram FROM {config.TABLE_SEPECTROGRAMS}")
-        rows = cursor.fetchall()
-        
-        mel_spectrograms = []
-        for row in rows:
-            with io.BytesIO(row[0]) as buffer:
-                mel_spectrogram = np.load(buffer, allow_pickle=True)
-                mel_spectrograms.append(mel_spectrogram)
-        
-        return mel_spectrograms
+        cursor.execute(f"SELECT {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}")
+        return [self.deserialize_spectrogram(*row) for row in cursor.fetchall()]
+
+    def fetch_ids(self):
+        """Fetch every record id, in ascending order."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT id FROM {config.TABLE_SEPECTROGRAMS} ORDER BY id")
+        return np.fromiter((row[0] for row in cursor), dtype=np.int64)
+
+    def iter_spectrograms_after(self, last_id, batch_size=config.DB_BATCH_SIZE):
+        """Yield (ids, spectrograms) batches of the records with an id above last_id, in id order."""
+        cursor = self.conn.cursor()
+        while True:
+            cursor.execute(f'''
+                SELECT id, {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield [row[0] for row in rows], [self.deserialize_spectrogram(*row[1:]) for row in rows]
+            last_id = rows[-1][0]
+
+    def iter_embeddings_after(self, last_id, batch_size=config.DB_BATCH_SIZE):
+        """Yield (ids, embeddings) batches of the records with an id above last_id that have an embedding, in id order."""
+        cursor = self.conn.cursor()
+        while True:
+            cursor.execute(f'''
+                SELECT id, embedding FROM {config.TABLE_SEPECTROGRAMS}
+                WHERE id > ? AND embedding IS NOT NULL ORDER BY id LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                return
+            yield [row[0] for row in rows], [self.deserialize_embedding(row[1]).reshape(1, -1) for row in rows]
+            last_id = rows[-1][0]
+
+    def backfill_embeddings(self, embed, batch_size=config.DB_BATCH_SIZE):
+        """Compute embed(spectrogram) for records stored without an embedding. Returns the number filled."""
+        cursor = self.conn.cursor()
+        filled = 0
+        while True:
+            cursor.execute(f'''
+                SELECT id, {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+                WHERE embedding IS NULL ORDER BY id LIMIT ?
+            ''', (batch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                return filled
+            with self.conn:
+                self.conn.executemany(
+                    f"UPDATE {config.TABLE_SEPECTROGRAMS} SET embedding = ? WHERE id = ?",
+                    [(self.serialize_embedding(embed(self.deserialize_spectrogram(*row[1:]))), row[0]) for row in rows]
+                )
+            filled += len(rows)
+
+    def fetch_spectrogram_of_file(self, filename, file_size, file_mtime_ns, feature_config):
+        """Stored spectrogram of a file, if it was catalogued with these settings and has not changed since; otherwise None."""
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+            WHERE filename = ? AND file_size = ? AND file_mtime_ns = ? AND feature_config = ?
+        ''', (filename, file_size, file_mtime_ns, feature_config))
+        row = cursor.fetchone()
+        return None if row is None else self.deserialize_spectrogram(*row)
+
+    def fetch_spectrogram_by_content_hash(self, content_hash, feature_config):
+        """Stored spectrogram of any file with these bytes, catalogued with these settings and a content hash; otherwise None."""
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+            WHERE content_hash = ? AND feature_config = ? LIMIT 1
+        ''', (content_hash, feature_config))
+        row = cursor.fetchone()
+        return None if row is None else self.deserialize_spectrogram(*row)
+
+    @timed('storage.fetch')
+    def fetch_records(self, ids):
+        """Fetch the records with the given ids, in the same order."""
+        ids = [int(record_id) for record_id in ids]
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT id, filename, {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+            WHERE id IN ({', '.join('?' * len(ids))})
+        ''', ids)
+        records = {
+            record_id: {
+                'id': record_id,
+                'spectrogram': self.deserialize_spectrogram(*spectrogram_data),
+                'filename': filename
+            }
+            for record_id, filename, *spectrogram_data in cursor.fetchall()
+        }
+        return [records[record_id] for record_id in ids if record_id in records]
+
+    def fetch_filenames(self, ids):
+        """Fetch {id: filename} for the given record ids."""
+        ids = [int(record_id) for record_id in ids]
+        filenames = {}
+        cursor = self.conn.cursor()
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(ids), 900):
+            batch = ids[start:start + 900]
+            cursor.execute(f"SELECT id, filename FROM {config.TABLE_SEPECTROGRAMS} WHERE id IN ({', '.join('?' * len(batch))})", batch)
+            filenames.update(cursor.fetchall())
+        return filenames
 
     def fetch_ids_and_paths(self):
         """Fetch IDs and paths from the SQLite3 database."""
@@ -81,26 +534,75 @@ class SpectrogramStorage:
         records = cursor.fetchall()
         return records
 
+    def fetch_ids_and_paths_after(self, last_id, limit=config.TABLE_PAGE_SIZE):
+        """Fetch up to limit (id, filename) rows with an id above last_id, in id order; a keyset page."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT id, filename FROM {config.TABLE_SEPECTROGRAMS} WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit))
+        return cursor.fetchall()
+
+    def count_records_up_to(self, last_id):
+        """Number of records with an id of at most last_id."""
+        cursor = self.conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM {config.TABLE_SEPECTROGRAMS} WHERE id <= ?", (last_id,))
+        return cursor.fetchone()[0]
+
     def fetch_all_records(self):
         """Fetch all Mel spectrogram data and associated metadata from the SQLite database."""
         cursor = self.conn.cursor()
-        cursor.execute(f"SELECT id, spectrogram, filename FROM {config.TABLE_SEPECTROGRAMS}")
-        rows = cursor.fetchall()
+        cursor.execute(f"SELECT id, filename, {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}")
         
         records = []
-        for row in rows:
-            record_id, spectrogram_data, filename = row
-            # Use io.BytesIO to handle the binary data
-            with io.BytesIO(spectrogram_data) as buffer:
-                mel_spectrogram = np.load(buffer, allow_pickle=True)
-                records.append({
-                    'id': record_id,
-                    'spectrogram': mel_spectrogram,
-                    'filename': filename
-                })
+        for record_id, filename, *spectrogram_data in cursor.fetchall():
+            records.append({
+                'id': record_id,
+                'spectrogram': self.deserialize_spectrogram(*spectrogram_data),
+                'filename': filename
+            })
         
         return records
 
+    def migrate_spectrogram_format(self, batch_size=config.DB_BATCH_SIZE):
+        """
+        Re-encode rows still holding legacy np.save blobs into the current format.
+
+        Returns:
+            tuple: (number of rows migrated, number left unchanged because the re-encoded data clashed with another row).
+        """
+        cursor = self.conn.cursor()
+        update_sql = f'''
+            UPDATE OR IGNORE {config.TABLE_SEPECTROGRAMS}
+            SET spectrogram = ?, spectrogram_hash = ?, {', '.join(f'{column} = ?' for column in FORMAT_COLUMNS)}
+            WHERE id = ?
+        '''
+        migrated = 0
+        conflicts = 0
+        last_id = -1
+
+        while True:
+            cursor.execute(f'''
+                SELECT id, {SPECTROGRAM_COLUMNS} FROM {config.TABLE_SEPECTROGRAMS}
+                WHERE id > ? AND (format_version IS NULL OR format_version != ?)
+                ORDER BY id LIMIT ?
+            ''', (last_id, FORMAT_VERSION, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for record_id, *spectrogram_data in rows:
+                blob, spectrogram_hash, format_values = self.serialize_spectrogram(self.deserialize_spectrogram(*spectrogram_data))
+                updates.append((blob, spectrogram_hash, *format_values, record_id))
+
+            changes_before = self.conn.total_changes
+            with self.conn:
+                self.conn.executemany(update_sql, updates)
+            changed = self.conn.total_changes - changes_before
+            migrated += changed
+            conflicts += len(updates) - changed
+            last_id = rows[-1][0]
+
+        return migrated, conflicts
+
     def close(self):
         print(f"Closing DB connection")
         self.conn.close()
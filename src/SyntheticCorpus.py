@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import wave
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+MANIFEST = 'corpus.json'
+KINDS = ('tone', 'chirp', 'noise', 'hit')
+
+def corpus_spec(num_files, seed=0, durations=(0.25, 1.0, 4.0, 15.0), samplerates=(22050, 44100, 48000), channels=(1, 2), files_per_dir=1000):
+    """The parameters that, with the generator's version, fully determine a corpus."""
+    return {
+        'version': 1,
+        'num_files': num_files,
+        'seed': seed,
+        'durations': list(durations),
+        'samplerates': list(samplerates),
+        'channels': list(channels),
+        'files_per_dir': files_per_dir,
+    }
+
+def file_params(spec, index):
+    """Kind, duration, sample rate, channels and sound parameters of one file, from its own seeded generator."""
+    rng = np.random.default_rng([spec['seed'], index])
+    return {
+        'kind': KINDS[rng.integers(len(KINDS))],
+        'duration': float(rng.choice(spec['durations'])),
+        'samplerate': int(rng.choice(spec['samplerates'])),
+        'channels': int(rng.choice(spec['channels'])),
+        'frequency': float(80 * 2 ** rng.uniform(0, 6)),
+        'decay': float(rng.uniform(1, 20)),
+        'level': float(rng.uniform(0.1, 0.8)),
+        'noise_seed': int(rng.integers(2 ** 31)),
+    }
+
+def synthesize(params):
+    """(frames, channels) float64 samples in [-1, 1] for one file's parameters."""
+    samplerate = params['samplerate']
+    t = np.arange(int(params['duration'] * samplerate)) / samplerate
+    rng = np.random.default_rng(params['noise_seed'])
+    frequency = params['frequency']
+    if params['kind'] == 'tone':
+        signal = np.sin(2 * np.pi * frequency * t) + 0.3 * np.sin(2 * np.pi * 2 * frequency * t)
+    elif params['kind'] == 'chirp':
+        # Exponential sweep over two octaves
+        end = max(t[-1], 1e-3) if len(t) else 1.0
+        signal = np.sin(2 * np.pi * frequency * end / np.log(4) * (4 ** (t / end) - 1))
+    elif params['kind'] == 'noise':
+        signal = rng.standard_normal(len(t)) * 0.5
+    else:
+        signal = (np.sin(2 * np.pi * frequency * t) + rng.standard_normal(len(t)) * 0.5) * np.exp(-t * params['decay'])
+    signal = params['level'] * signal / max(np.abs(signal).max(initial=0), 1e-9)
+    # Channels differ slightly so stereo files are not trivially mono
+    return np.stack([signal * (1 - 0.1 * channel) for channel in range(params['channels'])], axis=1)
+
+def write_wav(path, samples, samplerate):
+    """Write float samples as 16-bit PCM with the standard library, so bytes are identical on every platform."""
+    pcm = np.clip(np.round(samples * 32767), -32768, 32767).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(samples.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(samplerate)
+        f.writeframes(pcm.tobytes())
+
+def file_path(directory, spec, index):
+    params = file_params(spec, index)
+    subdirectory = f"{index // spec['files_per_dir']:04d}"
+    return os.path.join(directory, subdirectory, f"{index:07d}_{params['kind']}_{params['samplerate']}_{params['channels']}ch.wav")
+
+def _write_range(directory, spec, start, stop):
+    written = 0
+    for index in range(start, stop):
+        path = file_path(directory, spec, index)
+        if not os.path.exists(path):
+            params = file_params(spec, index)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and moved into place, so a file left by an interrupted run is never half-written
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            write_wav(tmp_path, synthesize(params), params['samplerate'])
+            os.replace(tmp_path, path)
+            written += 1
+    return written
+
+def generate_corpus(directory, spec, workers=config.INGEST_WORKERS, chunk_files=500):
+    """
+    Write the corpus described by spec into directory, on a process pool, and record it in a manifest.
+
+    Every file depends only on the seed and its index, so generation is resumable and the same
+    spec always gives byte-identical files. An existing corpus with the same spec is reused.
+
+    Returns:
+        dict: The manifest: the spec, the files written this time and the total audio size.
+    """
+    manifest_path = os.path.join(directory, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest['spec'] == spec:
+            return dict(manifest, written=0)
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    workers = workers if workers > 0 else os.cpu_count()
+    starts = list(range(0, spec['num_files'], chunk_files))
+    stops = [min(start + chunk_files, spec['num_files']) for start in starts]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        written = sum(executor.map(_write_range, [directory] * len(starts), [spec] * len(starts), starts, stops))
+
+    frames = 0
+    for index in range(spec['num_files']):
+        params = file_params(spec, index)
+        frames += int(params['duration'] * params['samplerate']) * params['channels']
+    manifest = {
+        'spec': spec,
+        'files': spec['num_files'],
+        'audio_bytes': frames * 2,
+        'fingerprint': hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:12],
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return dict(manifest, written=written)
+
+def corpus_files(directory, spec, limit=None):
+    """Paths of the corpus files in index order, optionally only the first limit."""
+    count = spec['num_files'] if limit is None else min(limit, spec['num_files'])
+    return [file_path(directory, spec, index) for index in range(count)]
@@ -0,0 +1,132 @@
+import os
+import sys
+import zlib
+import struct
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+@lru_cache(maxsize=None)
+def colormap_table(name=config.THUMBNAIL_COLORMAP):
+    """(256, 3) uint8 RGB lookup table of a matplotlib colormap. Only matplotlib.colors is loaded, not pyplot."""
+    from matplotlib import colormaps
+    table = (colormaps[name](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+    table.setflags(write=False)
+    return table
+
+def encode_png(image):
+    """Encode an (height, width, 3) uint8 RGB image as PNG bytes."""
+    height, width, _ = image.shape
+    # Each scanline starts with filter type 0 (none)
+    scanlines = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+    scanlines[:, 1:] = image.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ])
+
+def spectrogram_image(mel_spectrogram, size=config.PLOT_SIZE, colormap=config.THUMBNAIL_COLORMAP):
+    """
+    Render a Mel spectrogram straight to an RGB array of the given (width, height).
+
+    Levels are shown in dB, scaled to the spectrogram's own range, with low bands at the bottom.
+    Time is max-pooled into the columns so short events stay visible in long recordings.
+    """
+    width, height = size
+    if mel_spectrogram.size == 0:
+        return np.zeros((height, width, 3), dtype=np.uint8)
+
+    levels = 10 * np.log10(np.maximum(np.asarray(mel_spectrogram, dtype=np.float64), 1e-10))
+    n_frames, n_bands = levels.shape
+
+    column_starts = np.arange(width) * n_frames // width
+    if n_frames >= width:
+        columns = np.maximum.reduceat(levels, column_starts, axis=0)
+    else:
+        columns = levels[column_starts]
+    band_rows = (np.arange(height)[::-1] * n_bands) // height
+    grid = columns[:, band_rows].T
+
+    low, high = levels.min(), levels.max()
+    scaled = (grid - low) * (255 / (high - low)) if high > low else np.zeros_like(grid)
+    return colormap_table(colormap)[scaled.astype(np.uint8)]
+
+class ThumbnailCache:
+    """
+    PNG thumbnails of stored spectrograms, in their own directory rather than next to the WAVs.
+
+    Thumbnails are named after a hash of the source path and the size, written atomically, and
+    re-rendered when the source file is newer than its thumbnail. They can be rendered during
+    ingest (render), as a separate pass over the catalogue (render_missing) or on first display
+    (ensure).
+    """
+
+    def __init__(self, directory, size=config.PLOT_SIZE, colormap=config.THUMBNAIL_COLORMAP):
+        self.directory = directory
+        self.size = tuple(size)
+        self.colormap = colormap
+
+    def path_for(self, filename):
+        key = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        width, height = self.size
+        return os.path.join(self.directory, key[:2], f"{key}_{width}x{height}.png")
+
+    def is_current(self, filename):
+        """Whether a thumbnail exists and is no older than its source file (if the source is still there)."""
+        try:
+            rendered = os.stat(self.path_for(filename)).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        try:
+            return rendered >= os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            return True
+
+    def render(self, mel_spectrogram, filename):
+        """Render and save the thumbnail of a spectrogram. Returns its path."""
+        path = self.path_for(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Threads of one process may render the same file at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_png(spectrogram_image(mel_spectrogram, self.size, self.colormap)))
+        os.replace(tmp_path, path)
+        return path
+
+    def ensure(self, record_id, filename, storage):
+        """Path of the record's thumbnail, rendering it from the stored spectrogram first if needed."""
+        if not self.is_current(filename):
+            records = storage.fetch_records([record_id])
+            if not records:
+                return None
+            self.render(records[0]['spectrogram'], filename)
+        return self.path_for(filename)
+
+    def render_missing(self, storage, workers=config.INGEST_WORKERS, batch_size=config.DB_BATCH_SIZE):
+        """Render every catalogued record without a current thumbnail, on a thread pool. Returns the number rendered."""
+        workers = workers if workers > 0 else os.cpu_count()
+        rendered = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for ids, spectrograms in storage.iter_spectrograms_after(0, batch_size):
+                filenames = storage.fetch_filenames(ids)
+                pending = [
+                    (spectrogram, filenames[record_id])
+                    for record_id, spectrogram in zip(ids, spectrograms)
+                    if not self.is_current(filenames[record_id])
+                ]
+                rendered += len(list(executor.map(lambda item: self.render(*item), pending)))
+        return rendered
@@ -0,0 +1,199 @@
+import os
+import sys
+import struct
+import numpy as np
+import soundfile as sf
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (format tag, bits per sample) -> (soundfile subtype, sample dtype, scale to [-1, 1), offset)
+# The scales are powers of two, so conversion matches libsndfile's exactly.
+SAMPLE_FORMATS = {
+    (WAVE_FORMAT_PCM, 8): ('PCM_U8', np.uint8, 1 / 0x80, -128.0),
+    (WAVE_FORMAT_PCM, 16): ('PCM_16', np.dtype('<i2'), 1 / 0x8000, 0),
+    (WAVE_FORMAT_PCM, 24): ('PCM_24', np.uint8, 1 / 0x800000, 0),
+    (WAVE_FORMAT_PCM, 32): ('PCM_32', np.dtype('<i4'), 1 / 0x80000000, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): ('FLOAT', np.dtype('<f4'), 1, 0),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): ('DOUBLE', np.dtype('<f8'), 1, 0),
+}
+
+def parse_wav_header(filename):
+    """
+    Read the RIFF header of a plain PCM or float WAV file, without touching the samples.
+
+    Returns:
+        dict or None: samplerate, channels, frames, subtype, bits, data_offset and format_tag,
+        or None if the file is not a WAV this module can map (compressed, RF64, malformed...).
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+
+        info = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, size = struct.unpack('<4sI', chunk_header)
+
+            if chunk_id == b'fmt ':
+                body = f.read(size)
+                if len(body) < 16:
+                    return None
+                format_tag, channels, samplerate, _, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    # The real format is the first two bytes of the sub-format GUID
+                    format_tag = struct.unpack('<H', body[24:26])[0]
+                if (format_tag, bits) not in SAMPLE_FORMATS or channels == 0 or block_align != channels * bits // 8:
+                    return None
+                info = {
+                    'samplerate': samplerate,
+                    'channels': channels,
+                    'subtype': SAMPLE_FORMATS[(format_tag, bits)][0],
+                    'bits': bits,
+                    'format_tag': format_tag,
+                }
+            elif chunk_id == b'data':
+                if info is None:
+                    return None
+                data_offset = f.tell()
+                # Trust the file size over the header, which is often wrong in truncated or streamed files
+                size = min(size, os.fstat(f.fileno()).st_size - data_offset)
+                info.update(frames=size // (info['channels'] * info['bits'] // 8), data_offset=data_offset)
+                return info
+            else:
+                f.seek(size, os.SEEK_CUR)
+
+            # Chunks are word aligned
+            if size % 2:
+                f.seek(1, os.SEEK_CUR)
+
+def probe_audio(filename):
+    """Sample rate, channels, length in frames and subtype of an audio file, from its header only."""
+    info = parse_wav_header(filename)
+    if info is not None:
+        return {key: info[key] for key in ('samplerate', 'channels', 'frames', 'subtype')}
+    info = sf.info(filename)
+    return {'samplerate': info.samplerate, 'channels': info.channels, 'frames': info.frames, 'subtype': info.subtype}
+
+class AudioReader:
+    """Float64 reader over an audio file, read whole or in blocks mixed down to mono."""
+
+    samplerate = None
+    channels = None
+    frames = None
+
+    def _read(self, out):
+        """Fill out, a (block_size, channels) float64 array, with the next samples; return the number read."""
+        raise NotImplementedError
+
+    def read(self):
+        """The whole remaining signal: (frames,) for mono, else (frames, channels), like soundfile.read."""
+        data = np.empty((self.frames, self.channels), dtype=np.float64)
+        read = self._read(data)
+        data = data[:read]
+        return data[:, 0] if self.channels == 1 else data
+
+    def blocks(self, block_size=config.STREAM_BLOCK_SIZE):
+        """
+        Yield the signal block_size frames at a time, mixed down to mono.
+
+        Blocks are views of buffers reused between iterations; copy any that must outlive one.
+        """
+        # Short files fit in one block no larger than themselves
+        block_size = max(1, min(block_size, self.frames + 1))
+        block = np.empty((block_size, self.channels), dtype=np.float64)
+        mono = np.empty(block_size, dtype=np.float64)
+        while read := self._read(block):
+            if self.channels == 1:
+                yield block[:read, 0]
+            elif self.channels == 2:
+                # Same result as the mean, without a strided reduction
+                samples = np.add(block[:read, 0], block[:read, 1], out=mono[:read])
+                samples *= 0.5
+                yield samples
+            else:
+                yield np.mean(block[:read], axis=1, out=mono[:read])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class PcmWavReader(AudioReader):
+    """
+    Fast path for plain PCM and float WAV files: the data chunk is memory-mapped as a numpy
+    view and integer samples are converted to float only block by block, as they are read.
+    """
+
+    def __init__(self, filename, header=None):
+        header = header if header is not None else parse_wav_header(filename)
+        if header is None:
+            raise ValueError(f"Not a plain PCM or float WAV file: {filename}")
+        self.samplerate = header['samplerate']
+        self.channels = header['channels']
+        self.frames = header['frames']
+        _, dtype, self.scale, self.offset = SAMPLE_FORMATS[(header['format_tag'], header['bits'])]
+        self.bytes_per_sample = header['bits'] // 8
+        self.position = 0
+
+        shape = (self.frames, self.channels, 3) if header['bits'] == 24 else (self.frames, self.channels)
+        if self.frames:
+            self.samples = np.memmap(filename, dtype=dtype, mode='r', offset=header['data_offset'], shape=shape)
+        else:
+            self.samples = np.empty(shape, dtype=dtype)
+
+    def _read(self, out):
+        stop = min(self.position + len(out), self.frames)
+        chunk = self.samples[self.position:stop]
+        read = stop - self.position
+        self.position = stop
+
+        if self.bytes_per_sample == 3:
+            # Assemble little-endian 24-bit samples in the top of an int32, then shift back down to sign-extend
+            chunk = (
+                (chunk[..., 0].astype(np.int32) << 8) | (chunk[..., 1].astype(np.int32) << 16) | (chunk[..., 2].astype(np.int32) << 24)
+            ) >> 8
+        target = out[:read]
+        if self.offset:
+            np.add(chunk, self.offset, out=target)
+            chunk = target
+        np.multiply(chunk, self.scale, out=target)
+        return read
+
+    def close(self):
+        self.samples = None
+
+class SoundFileReader(AudioReader):
+    """Fallback through libsndfile for compressed or unusual formats."""
+
+    def __init__(self, filename):
+        self.file = sf.SoundFile(filename)
+        self.samplerate = self.file.samplerate
+        self.channels = self.file.channels
+        self.frames = self.file.frames
+
+    def _read(self, out):
+        return len(self.file.read(len(out), dtype='float64', always_2d=True, out=out))
+
+    def close(self):
+        self.file.close()
+
+def open_audio(filename):
+    """Open an audio file through the memory-mapped fast path if it is a plain WAV, else through soundfile."""
+    header = parse_wav_header(filename)
+    if header is not None:
+        return PcmWavReader(filename, header)
+    return SoundFileReader(filename)
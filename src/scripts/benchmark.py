@@ -0,0 +1,309 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from SyntheticCorpus import corpus_spec, generate_corpus, corpus_files
+
+STAGES = ["fft", "mel", "ingest", "storage", "find", "cluster"]
+REPORT_FORMAT = 1
+
+def peak_rss_mb():
+    """Peak resident set size of this process and of its largest finished child, in MB; None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 / 2 ** 20 if sys.platform == 'darwin' else 1 / 2 ** 10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+def latency_summary(seconds):
+    """Latency percentiles in milliseconds of a list of per-item timings."""
+    if not len(seconds):
+        return None
+    milliseconds = np.asarray(seconds) * 1000
+    return {
+        'count': len(milliseconds),
+        'mean': float(milliseconds.mean()),
+        'p50': float(np.percentile(milliseconds, 50)),
+        'p90': float(np.percentile(milliseconds, 90)),
+        'p99': float(np.percentile(milliseconds, 99)),
+        'max': float(milliseconds.max()),
+    }
+
+def timed(function, items):
+    """Call function on each item; returns (results, per-item seconds, total seconds)."""
+    results, latencies = [], []
+    started = time.perf_counter()
+    for item in items:
+        start = time.perf_counter()
+        results.append(function(item))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies, time.perf_counter() - started
+
+def result(name, items, seconds, latencies=None, **extra):
+    return {
+        'stage': name,
+        'items': items,
+        'seconds': seconds,
+        'throughput_per_s': items / seconds if seconds > 0 else None,
+        'latency_ms': latency_summary(latencies) if latencies is not None else None,
+        **extra,
+    }
+
+def audio_processor(args):
+    from AudioProcessor import AudioProcessor
+    return AudioProcessor(args.window_length, args.step_size, args.n_filters)
+
+def sample_files(args):
+    """An evenly spread, deterministic sample of the corpus, covering every kind, rate and channel count."""
+    files = corpus_files(args.corpus, corpus_spec_from(args))
+    step = max(1, len(files) // args.sample)
+    return files[::step][:args.sample]
+
+def corpus_spec_from(args):
+    return corpus_spec(args.files, args.seed, args.durations, args.samplerates, args.channels)
+
+def ingest_db(args):
+    return os.path.join(args.workdir, 'ingest.sqlite3')
+
+def ensure_ingested(args):
+    """Ingest the corpus into the working database if an earlier stage has not, for the stages that search it."""
+    from SpectrogramStorage import SpectrogramStorage
+    from Ingester import Ingester
+
+    storage = SpectrogramStorage(ingest_db(args))
+    ingester = Ingester()
+    pending = ingester.plan_incremental(corpus_files(args.corpus, corpus_spec_from(args)), storage, audio_processor(args).feature_config)
+    if pending:
+        ingester.process_files(pending, audio_processor(args), storage, workers=args.workers)
+    return storage
+
+def stage_fft(args):
+    processor = audio_processor(args)
+    signals = []
+    for filepath in sample_files(args):
+        data, samplerate = processor.load_wav(filepath)
+        signals.append((processor.stereo_to_mono(data) if data.ndim > 1 else data, samplerate))
+    # Warm the cached FFT plans so the timings are of the transform alone
+    for samplerate in {samplerate for _, samplerate in signals}:
+        processor.fft_plan(samplerate)
+    _, latencies, seconds = timed(lambda signal: processor.perform_fft(*signal), signals)
+    audio_seconds = sum(len(data) / samplerate for data, samplerate in signals)
+    return result('fft', len(signals), seconds, latencies, audio_seconds_per_s=audio_seconds / seconds)
+
+def stage_mel(args):
+    processor = audio_processor(args)
+    files = sample_files(args)
+    # The first call loads librosa and builds the Mel filterbank; keep that out of the timings
+    processor.wav_file_to_mel_spectrogram(files[0])
+    _, latencies, seconds = timed(processor.wav_file_to_mel_spectrogram, files)
+    audio_bytes = sum(os.path.getsize(filepath) for filepath in files)
+    return result('mel', len(files), seconds, latencies, mb_per_s=audio_bytes / 2 ** 20 / seconds)
+
+def stage_ingest(args):
+    from SpectrogramStorage import SpectrogramStorage
+    from Ingester import Ingester
+
+    db_file = ingest_db(args)
+    for suffix in ('', '-wal', '-shm'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_file + suffix)
+    files = corpus_files(args.corpus, corpus_spec_from(args))
+    storage = SpectrogramStorage(db_file)
+    started = time.perf_counter()
+    stats, failures = Ingester().process_files(files, audio_processor(args), storage, workers=args.workers)
+    seconds = time.perf_counter() - started
+    storage.close()
+    audio_bytes = sum(os.path.getsize(filepath) for filepath in files)
+    return result('ingest', len(files), seconds, workers=args.workers, inserted=stats['inserted'], failed=len(failures),
+                  mb_per_s=audio_bytes / 2 ** 20 / seconds)
+
+def stage_storage(args):
+    from SpectrogramStorage import SpectrogramStorage
+
+    db_file = os.path.join(args.workdir, 'storage.sqlite3')
+    for suffix in ('', '-wal', '-shm'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(db_file + suffix)
+    storage = SpectrogramStorage(db_file)
+    rng = np.random.default_rng(args.seed)
+    records = [
+        (rng.random((int(rng.integers(10, 400)), args.n_filters), dtype=np.float32), f"/synthetic/{index:07d}.wav", None, None)
+        for index in range(args.storage_records)
+    ]
+
+    started = time.perf_counter()
+    storage.save_many(records)
+    write_seconds = time.perf_counter() - started
+
+    ids = storage.fetch_ids()
+    lookups = rng.choice(ids, min(len(ids), args.queries * 10), replace=False)
+    _, latencies, _ = timed(lambda record_id: storage.fetch_records([int(record_id)]), lookups)
+
+    started = time.perf_counter()
+    scanned = sum(len(batch_ids) for batch_ids, _ in storage.iter_spectrograms_after(0))
+    scan_seconds = time.perf_counter() - started
+    storage.close()
+    return result('storage', len(records), write_seconds, latencies, write_records_per_s=len(records) / write_seconds,
+                  scan_records_per_s=scanned / scan_seconds)
+
+def stage_find(args):
+    from DataClusterer import DataClusterer
+
+    storage = ensure_ingested(args)
+    clusterer = DataClusterer(storage=storage, auto_sync=False)
+    ids = storage.fetch_ids()
+    rng = np.random.default_rng(args.seed)
+    query_ids = rng.choice(ids, min(len(ids), args.queries), replace=False)
+    # Queries are stored spectrograms with a little noise, so each has a known nearest record
+    records = storage.fetch_records(query_ids)
+    queries = [record['spectrogram'] * (1 + 0.01 * rng.standard_normal(record['spectrogram'].shape)) for record in records]
+    expected = [record['id'] for record in records]
+
+    modes = {}
+    for mode in args.find_modes:
+        clusterer.find_closest_matches_in_db(queries[0], mode=mode, index=args.index)  # Build or load the matrix and index
+        found, latencies, seconds = timed(lambda query: clusterer.find_closest_matches_in_db(query, mode=mode, index=args.index), queries)
+        # Share of queries whose own record came first; below 1 means the mode or index lost it
+        recall = float(np.mean([len(ids) > 0 and ids[0] == record_id for ids, record_id in zip(found, expected)]))
+        modes[mode] = {'seconds': seconds, 'queries_per_s': len(queries) / seconds, 'recall_at_1': recall, 'latency_ms': latency_summary(latencies)}
+    storage.close()
+    first = modes[args.find_modes[0]]
+    return result('find', len(queries), first['seconds'], None, catalogue=len(ids), index=args.index, latency_ms=first['latency_ms'],
+                  recall_at_1=first['recall_at_1'], modes=modes)
+
+def stage_cluster(args):
+    from DataClusterer import DataClusterer
+
+    storage = ensure_ingested(args)
+    clusterer = DataClusterer(storage=storage)
+    clusterer.embedding_matrix()
+    started = time.perf_counter()
+    ids, labels, _ = clusterer.cluster_catalogue(save=False)
+    seconds = time.perf_counter() - started
+    storage.close()
+    return result('cluster', len(ids), seconds, clusters=int(len(set(labels.tolist()) - {-1})), noise=int(np.sum(labels < 0)))
+
+def run_stage(args):
+    """Child process: run one stage with library output sent to stderr, then print its result as JSON."""
+    stage = globals()[f"stage_{args.stage}"]
+    with contextlib.redirect_stdout(sys.stderr):
+        measured = stage(args)
+    peak, peak_child = peak_rss_mb()
+    measured.update(peak_rss_mb=peak, peak_child_rss_mb=peak_child)
+    print(json.dumps(measured))
+
+def compare(report, baseline):
+    """Print throughput and median latency relative to an earlier report."""
+    previous = {stage['stage']: stage for stage in baseline.get('stages', [])}
+    for stage in report['stages']:
+        before = previous.get(stage['stage'])
+        if before is None or 'error' in stage or 'error' in before:
+            continue
+        line = f"{stage['stage']:8s}"
+        if stage.get('throughput_per_s') and before.get('throughput_per_s'):
+            line += f" throughput x{stage['throughput_per_s'] / before['throughput_per_s']:.2f}"
+        if stage.get('latency_ms') and before.get('latency_ms'):
+            line += f"  p50 x{stage['latency_ms']['p50'] / before['latency_ms']['p50']:.2f}"
+        if stage.get('peak_rss_mb') and before.get('peak_rss_mb'):
+            line += f"  peak RSS x{stage['peak_rss_mb'] / before['peak_rss_mb']:.2f}"
+        print(line, file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark feature extraction, ingest, storage, search and clustering on a synthetic corpus.")
+    parser.add_argument("--corpus", default="benchmark_corpus", help="Directory of the synthetic corpus, generated if missing.")
+    parser.add_argument("--workdir", default="benchmark_work", help="Directory for the benchmark databases and matrices.")
+    parser.add_argument("--files", type=int, default=1000, help="Number of files in the corpus.")
+    parser.add_argument("--seed", type=int, default=0, help="Corpus and query seed.")
+    parser.add_argument("--durations", type=float, nargs="+", default=[0.25, 1.0, 4.0, 15.0], help="File durations in seconds to draw from.")
+    parser.add_argument("--samplerates", type=int, nargs="+", default=[22050, 44100, 48000], help="Sample rates to draw from.")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 2], help="Channel counts to draw from.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run, each in a fresh process.")
+    parser.add_argument("--sample", type=int, default=200, help="Files timed one by one by the fft and mel stages.")
+    parser.add_argument("--queries", type=int, default=50, help="Queries timed by the find stage.")
+    parser.add_argument("--storage_records", type=int, default=10000, help="Synthetic records written by the storage stage.")
+    parser.add_argument("--find_modes", nargs="+", choices=["spectrogram", "embedding", "dtw", "xcorr"], default=["spectrogram", "embedding"], help="Search modes timed by the find stage.")
+    parser.add_argument("--index", choices=["brute", "tree", "ivf"], default=config.SEARCH_INDEX, help="Search index used by the find stage.")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="Worker processes for generation and ingest (0 for one per CPU).")
+    parser.add_argument("--window_length", type=int, default=config.FFT_WINDOW_SIZE, help="FFT window length.")
+    parser.add_argument("--step_size", type=int, default=config.FFT_STEP_SIZE, help="Step size for FFT.")
+    parser.add_argument("--n_filters", type=int, default=config.FFT_N_FILTERS, help="Number of Mel filters.")
+    parser.add_argument("--output", default="-", help="Report file, or - for stdout.")
+    parser.add_argument("--baseline", help="Earlier report to compare against.")
+    parser.add_argument("--verbose", action="store_true", help="Show the stages' own output.")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.stage:
+        run_stage(args)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    print(f"Generating corpus of {args.files} files in {args.corpus}", file=sys.stderr)
+    with contextlib.redirect_stdout(sys.stderr):
+        manifest = generate_corpus(args.corpus, corpus_spec_from(args), args.workers)
+
+    # Children get the same arguments plus the stage to run
+    child_args = [argument for argument in sys.argv[1:] if argument not in ('--verbose',)]
+    stages = []
+    for stage in args.stages:
+        print(f"Running {stage}", file=sys.stderr)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), *child_args, "--stage", stage],
+            stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.PIPE, text=True
+        )
+        if completed.returncode == 0:
+            stages.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        else:
+            error = (completed.stderr or '').strip().splitlines()
+            stages.append({'stage': stage, 'error': error[-1] if error else f"exit status {completed.returncode}"})
+
+    report = {
+        'format': REPORT_FORMAT,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': {
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+        },
+        'corpus': {key: value for key, value in manifest.items() if key != 'written'},
+        'settings': {
+            'window_length': args.window_length,
+            'step_size': args.step_size,
+            'n_filters': args.n_filters,
+            'workers': args.workers,
+            'sample': args.sample,
+            'queries': args.queries,
+            'index': args.index,
+        },
+        'stages': stages,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
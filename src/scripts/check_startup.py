@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Entry points whose startup must stay light, and libraries none of them may load just by starting
+ENTRY_POINTS = ["find", "ingest", "cluster", "locate", "index", "migrate", "serve", "query"]
+DEFERRED_MODULES = ["matplotlib", "sklearn", "sounddevice", "librosa", "PySide6"]
+BUDGET_MS = 1000
+
+def measure_import(module):
+    """
+    Import a script module in a fresh interpreter under -X importtime.
+
+    Returns:
+        tuple: (total import time in milliseconds, set of top-level packages imported, error or None).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SCRIPTS_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        return None, set(), result.stderr.strip().splitlines()[-1]
+
+    total_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line.split(":", 1)[1].split("|")
+        # Nesting is shown by indentation; top-level imports are indented by one space
+        if len(name) - len(name.lstrip()) == 1:
+            total_us += int(cumulative)
+        packages.add(name.strip().split(".")[0])
+    return total_us / 1000, packages, None
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the command-line scripts start quickly and defer heavy libraries.")
+    parser.add_argument("scripts", nargs="*", default=ENTRY_POINTS, help="Script modules to check.")
+    parser.add_argument("--budget_ms", type=float, default=BUDGET_MS, help="Maximum import time per script.")
+
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.scripts:
+        milliseconds, packages, error = measure_import(module)
+        loaded = sorted(packages.intersection(DEFERRED_MODULES))
+        problems = []
+        if error is not None:
+            problems.append(f"import failed: {error}")
+        else:
+            if milliseconds > args.budget_ms:
+                problems.append(f"over the {args.budget_ms:.0f} ms budget")
+            if loaded:
+                problems.append(f"loads {', '.join(loaded)} at startup")
+        failed = failed or bool(problems)
+        print(json.dumps({'script': module, 'import_ms': milliseconds, 'deferred_loaded': loaded, 'ok': not problems, 'problems': problems}))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
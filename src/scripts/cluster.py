@@ -1,56 +1,71 @@
 import os
 import sys
+import argparse
 import numpy as np
 
 # Dynamically add 'src' to the module search path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Config import config
+from Metrics import add_metrics_arguments, instrument_script
 from SpectrogramStorage import SpectrogramStorage
 from DataClusterer import DataClusterer
 
 def main():
-    import argparse
-    
-    parser = argparse.ArgumentParser(description="Process and cluster WAV files.")
+    parser = argparse.ArgumentParser(description="Cluster the catalogued WAV files on their embeddings.")
     parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to store data.")
-    
+    parser.add_argument("--method", choices=["hdbscan", "dbscan"], default=config.CLUSTER_METHOD, help="Density clustering run on the micro-cluster centroids.")
+    parser.add_argument("--min_cluster_size", type=int, default=config.CLUSTER_MIN_SIZE, help="Smallest cluster (HDBSCAN) or core weight (DBSCAN).")
+    parser.add_argument("--eps", type=float, default=config.DBSCAN_EPS, help="DBSCAN neighbourhood radius in the reduced space.")
+    parser.add_argument("--memory_mb", type=int, default=config.CLUSTER_MEMORY_MB, help="Memory budget for the chunks streamed from the embedding matrix.")
+    parser.add_argument("--jobs", type=int, default=config.CLUSTER_JOBS, help="Cores to use; 0 or less means all.")
+    parser.add_argument("--update", action="store_true", help="Only label records added since the last clustering, unless the catalogue has drifted.")
+    parser.add_argument("--output", help="Write id,filename,label CSV here.")
+    parser.add_argument("--plot", action="store_true", help="Show a 2-D projection of a sample of the clusters.")
+    add_metrics_arguments(parser)
+
     args = parser.parse_args()
+    instrument_script(args)
 
     storage = SpectrogramStorage(args.db)
-    clusterer = DataClusterer()
-
-    # Clustering
-    print(f"Clustering")
-    mel_spectrograms = storage.fetch_all_spectrograms()
-    
-    if mel_spectrograms:
-        print(f"Fetched {len(mel_spectrograms)} spectrograms.")
-        valid_spectrograms = []
-        
-        for idx, mel in enumerate(mel_spectrograms):
-            if isinstance(mel, np.ndarray) and mel.ndim >= 2:
-                print(f"Spectrogram {idx} shape: {mel.shape}")
-                valid_spectrograms.append(mel)
-            else:
-                print(f"Spectrogram {idx} is invalid: {type(mel)}")
-
-        if valid_spectrograms:
-            try:
-                max_len = max(mel.shape[0] for mel in valid_spectrograms)
-                num_features = valid_spectrograms[0].shape[1]
-                mel_spectrograms_padded = clusterer.pad_sequences(valid_spectrograms, max_len, num_features)
-                scaled_data, clusters = clusterer.cluster_data(mel_spectrograms_padded)
-                plt = clusterer.plot_clusters(scaled_data, clusters)
-                plt.show()
-                plt.close()
-            except Exception as e:
-                print(f"Error during clustering: {e}")
-        else:
-            print("No valid spectrograms available for clustering.")
+    clusterer = DataClusterer(eps=args.eps, storage=storage)
+
+    cluster_options = {'method': args.method, 'min_cluster_size': args.min_cluster_size, 'memory_mb': args.memory_mb, 'jobs': args.jobs}
+    if args.update:
+        updated = clusterer.update_clusters(**cluster_options)
+        if updated is not None:
+            print(f"{updated['assigned']} records labelled, {updated['new_fraction']:.1%} new since last fit, "
+                  f"distance ratio {updated['distance_ratio']:.2f}{', reclustered' if updated['reclustered'] else ''}")
+            storage.close()
+            return
+        print("Not clustered yet")
+
+    print("Clustering")
+    ids, labels, fitted = clusterer.cluster_catalogue(**cluster_options)
+    if not len(ids):
+        print("No records to cluster.")
+    else:
+        clusters, sizes = np.unique(labels[labels >= 0], return_counts=True)
+        print(f"{len(ids)} records: {len(clusters)} clusters, {int(np.sum(labels < 0))} noise")
+        for cluster, size in sorted(zip(clusters, sizes), key=lambda item: -item[1])[:20]:
+            print(f"  cluster {cluster}: {size} records")
+
+        if args.output:
+            import csv
+            filenames = storage.fetch_filenames(ids)
+            with open(args.output, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['id', 'filename', 'label'])
+                writer.writerows((int(record_id), filenames.get(int(record_id)), int(label)) for record_id, label in zip(ids, labels))
+
+        if args.plot:
+            sample_ids, points = fitted.projection_2d(clusterer.embedding_matrix(sync=False))
+            plt = clusterer.plot_clusters(points, labels[np.searchsorted(ids, sample_ids)])
+            plt.show()
+            plt.close()
 
     storage.close()
-    print(f"Done")
+    print("Done")
 
 if __name__ == "__main__":
     main()
@@ -1,43 +1,138 @@
 import argparse
+import contextlib
+import csv
+import glob
+import json
 import os
 import sys
-import sounddevice as sd
-from scipy.io import wavfile
 
 # Dynamically add 'src' to the module search path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Config import config
+from Metrics import add_metrics_arguments, instrument_script
 
 from AudioProcessor import AudioProcessor
 from SpectrogramStorage import SpectrogramStorage
 from SpectrogramPlotter import SpectrogramPlotter
 from DataClusterer import DataClusterer
+from Ingester import Ingester
+from FeatureCache import FeatureCache
 
 outpuot_dir = 'output/'
 
 def play_wav(filename):
     """Play a WAV file."""
+    # PortAudio is only loaded when something is actually played
+    import sounddevice as sd
+    from scipy.io import wavfile
+
     samplerate, data = wavfile.read(filename)
     sd.play(data, samplerate)
     # sd.wait()  # Wait until the file is done playing
 
+def expand_queries(spec):
+    """WAV files named by a directory, a list file (one path per line) or a glob pattern."""
+    if os.path.isdir(spec):
+        return sorted(Ingester.find_wav_files(spec))
+    if os.path.isfile(spec) and not spec.lower().endswith('.wav'):
+        with open(spec) as f:
+            return [line.strip() for line in f if line.strip()]
+    return sorted(glob.glob(spec, recursive=True))
+
+def write_results(results, output, output_format):
+    """Write (query, matches, error) results as JSON Lines or CSV; matches are (id, filename, distance)."""
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['query', 'rank', 'id', 'filename', 'distance', 'error'])
+        for query, matches, error in results:
+            if error is not None:
+                writer.writerow([query, '', '', '', '', error])
+            for rank, (record_id, filename, distance) in enumerate(matches, start=1):
+                writer.writerow([query, rank, record_id, filename, f"{distance:.6g}", ''])
+    else:
+        for query, matches, error in results:
+            output.write(json.dumps({
+                'query': query,
+                'matches': [
+                    {'rank': rank, 'id': record_id, 'filename': filename, 'distance': distance}
+                    for rank, (record_id, filename, distance) in enumerate(matches, start=1)
+                ],
+                'error': error,
+            }) + '\n')
+
+def batch_find(args, audio_processor, storage, clusterer, stdout, feature_cache=None):
+    """Headless mode: match many query files in one pass and write ranked results, without playback or plots."""
+    query_paths = expand_queries(args.queries)
+
+    spectrograms = {}
+    content_hashes = {}
+    results = {}
+    if feature_cache is not None:
+        # Unreadable files are left out, to be reported below by the same extraction error as without a cache
+        spectrograms, content_hashes = feature_cache.lookup_many(query_paths, args.workers)
+    pending = [filepath for filepath in query_paths if filepath not in spectrograms]
+    print(f"Extracting features for {len(pending)} query files ({len(spectrograms)} cached)")
+
+    for filepath, spectrogram, _, _, error in Ingester.extract_features(pending, audio_processor, workers=args.workers):
+        if error is not None:
+            print(f"Error processing {filepath}: {error}")
+            results[filepath] = ([], error)
+        else:
+            spectrograms[filepath] = spectrogram if feature_cache is None else feature_cache.store(filepath, spectrogram, content_hashes.get(filepath))
+    targets = [(filepath, spectrograms[filepath]) for filepath in query_paths if filepath in spectrograms]
+
+    print(f"Searching {len(targets)} queries")
+    matches = clusterer.find_closest_matches_in_db_many([spectrogram for _, spectrogram in targets], args.num_matches, args.mode, args.index, args.cluster_filter)
+    filenames = storage.fetch_filenames({int(record_id) for ids, _ in matches for record_id in ids})
+    for (filepath, _), (ids, distances) in zip(targets, matches):
+        results[filepath] = ([(int(record_id), filenames.get(int(record_id)), float(distance)) for record_id, distance in zip(ids, distances)], None)
+
+    ordered = [(filepath, *results[filepath]) for filepath in query_paths]
+    if args.output == '-':
+        write_results(ordered, stdout, args.format)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            write_results(ordered, output, args.format)
+        print(f"Wrote {len(ordered)} results to {args.output}")
+
 def main():
     parser = argparse.ArgumentParser(description="Find closest matches to a WAV file in the database.")
-    parser.add_argument("wav_path", help="Path to a WAV file to find closest matches for.")
+    parser.add_argument("wav_path", nargs="?", help="Path to a WAV file to find closest matches for.")
+    parser.add_argument("--queries", help="Batch mode: a directory, glob pattern or list file of query WAV files.")
+    parser.add_argument("--output", default="-", help="Batch mode: results file, or - for stdout.")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="Batch mode: results format.")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="Batch mode: feature extraction processes (0 for one per CPU).")
     parser.add_argument("--window_length", type=int, default=config.FFT_WINDOW_SIZE, help="FFT window length.")
     parser.add_argument("--step_size", type=int, default=config.FFT_STEP_SIZE, help="Step size for FFT.")
     parser.add_argument("--n_filters", type=int, default=config.FFT_N_FILTERS, help="Number of Mel filters.")
     parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to store data.")
     parser.add_argument("--num_matches", type=int, default=config.NUM_MATCHES, help="Number of closest matches to find.")
+    parser.add_argument("--index", choices=["brute", "tree", "ivf"], default=config.SEARCH_INDEX, help="Search index: exact scan, exact tree or approximate IVF.")
+    parser.add_argument("--mode", choices=["spectrogram", "embedding", "dtw", "xcorr"], default=config.SEARCH_MODE, help="Rank on whole spectrograms, on fixed-length embeddings, or on spectrograms allowing time shifts (dtw, xcorr).")
+    parser.add_argument("--cluster_filter", action="store_true", help="Only search the query's cluster neighbourhood, if the catalogue has been clustered.")
+    parser.add_argument("--no-cache", action="store_true", help="Always decode the query files instead of reusing cached or catalogued features.")
+    add_metrics_arguments(parser)
     
     args = parser.parse_args()
+    instrument_script(args)
+    if (args.wav_path is None) == (args.queries is None):
+        parser.error("give either wav_path or --queries")
 
     # Initialize components
     audio_processor = AudioProcessor(args.window_length, args.step_size, args.n_filters)
     storage = SpectrogramStorage(args.db)
     plotter = SpectrogramPlotter()
-    clusterer = DataClusterer()
+    clusterer = DataClusterer(storage=storage)
+    feature_cache = None if args.no_cache else FeatureCache(storage.feature_cache_dir, audio_processor, storage)
+
+    if args.queries is not None:
+        # Progress goes to stderr so stdout carries only the results
+        stdout = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            batch_find(args, audio_processor, storage, clusterer, stdout, feature_cache)
+            storage.close()
+        return
 
     if not os.path.exists(args.wav_path):
         raise FileNotFoundError(f"File not found: {args.wav_path}")
@@ -48,22 +143,21 @@ def main():
 
     # Step 1: Load and process the input WAV file
     print(f"Processing input WAV file: {args.wav_path}")
-    target_spectrogram = audio_processor.wav_file_to_mel_spectrogram(args.wav_path)
-    
-    # Step 2: Fetch all stored spectrograms from the database
-    records = storage.fetch_all_records()  # Fetch records including metadata
+    if feature_cache is None:
+        target_spectrogram = audio_processor.wav_file_to_mel_spectrogram(args.wav_path)
+    else:
+        target_spectrogram = feature_cache.features(args.wav_path)
     
-    # Prepare lists for processing
-    spectrograms = [record['spectrogram'] for record in records]
+    # Step 2: Find the closest matches in the memory-mapped feature or embedding matrix
+    closest_ids = clusterer.find_closest_matches_in_db(target_spectrogram, args.num_matches, args.mode, args.index, args.cluster_filter)
     
-    # Step 3: Find the closest matches
-    closest_indices = clusterer.find_closest_matches(target_spectrogram, spectrograms, args.num_matches)
+    # Step 3: Fetch only the matching records, with their metadata
+    records = storage.fetch_records(closest_ids)
     
     # Step 4: Plot the closest matches
-    print(f"Found {len(closest_indices)} closest matches. Plotting...")
-    for idx in closest_indices:
-        # Retrieve the record based on the index
-        record = records[idx]
+    print(f"Found {len(records)} closest matches. Plotting...")
+    for record in records:
+        idx = record['id']
         
         print(f'Filename: {record['filename']}')
         play_wav(record['filename'])
@@ -0,0 +1,39 @@
+import argparse
+import json
+import os
+import sys
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from SpectrogramStorage import SpectrogramStorage
+from DataClusterer import DataClusterer
+from SearchIndex import evaluate_index
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a search index and report its recall and latency against an exact scan.")
+    parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to index.")
+    parser.add_argument("--mode", choices=["spectrogram", "embedding"], default=config.SEARCH_MODE, help="Index whole spectrograms or embeddings.")
+    parser.add_argument("--index", choices=["brute", "tree", "ivf"], default=config.SEARCH_INDEX, help="Kind of index to build.")
+    parser.add_argument("--nprobe", type=int, default=config.IVF_NPROBE, help="Inverted lists scanned per IVF query.")
+    parser.add_argument("--queries", type=int, default=100, help="Number of stored samples to use as evaluation queries (0 to skip).")
+    parser.add_argument("--num_matches", type=int, default=config.NUM_MATCHES, help="Number of closest matches per query.")
+
+    args = parser.parse_args()
+
+    storage = SpectrogramStorage(args.db)
+    clusterer = DataClusterer(storage=storage)
+
+    index = clusterer.search_index(args.mode, args.index)
+    if args.index == 'ivf':
+        index.nprobe = args.nprobe
+
+    if args.queries:
+        print(json.dumps(evaluate_index(index, args.queries, args.num_matches), indent=2))
+
+    storage.close()
+    print("Done")
+
+if __name__ == "__main__":
+    main()
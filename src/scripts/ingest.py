@@ -6,10 +6,14 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from Config import config
+from Metrics import add_metrics_arguments, instrument_script
 from AudioProcessor import AudioProcessor
 from SpectrogramPlotter import SpectrogramPlotter
+from ThumbnailCache import ThumbnailCache
 from SpectrogramStorage import SpectrogramStorage
 from Ingester import Ingester
+from FeatureMatrix import FeatureMatrix
+from DataClusterer import DataClusterer
 
 def main():
     parser = argparse.ArgumentParser(description="Process and cluster WAV files.")
@@ -18,23 +22,52 @@ def main():
     parser.add_argument("--step_size", type=int, default=config.FFT_STEP_SIZE, help="Step size for FFT.")
     parser.add_argument("--n_filters", type=int, default=config.FFT_N_FILTERS, help="Number of Mel filters.")
     parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to store data.")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="Worker processes for directory ingest (0 for one per CPU).")
+    parser.add_argument("--full", action="store_true", help="Reprocess every file, not only new or changed ones.")
+    parser.add_argument("--hash", action="store_true", help="Fingerprint files by content hash as well as size and mtime.")
+    parser.add_argument("--no-prune", action="store_true", help="Keep records of files that no longer exist.")
+    parser.add_argument("--thumbnails", action="store_true", help="Render thumbnails into the cache during ingest instead of on first display.")
+    parser.add_argument("--plots", action="store_true", help="Also save a full-size matplotlib plot next to each WAV file (slow).")
+    parser.add_argument("--no-recluster", action="store_true", help="Only label new records with their nearest cluster, even if the catalogue has drifted.")
+    add_metrics_arguments(parser)
     
     args = parser.parse_args()
+    instrument_script(args)
 
     # Initialize components
     audio_processor = AudioProcessor(args.window_length, args.step_size, args.n_filters)
     storage = SpectrogramStorage(args.db)
-    plotter = SpectrogramPlotter()
+    if args.plots:
+        plotter = SpectrogramPlotter()
+    elif args.thumbnails:
+        plotter = ThumbnailCache(storage.thumbnail_dir)
+    else:
+        plotter = None
     ingester = Ingester()
 
     # Process files or directories
     if os.path.isfile(args.path):
-        ingester.wav_file_to_mel_spectrogram(args.path, audio_processor, storage, plotter)
+        if args.full or ingester.plan_incremental([args.path], storage, audio_processor.feature_config, args.hash):
+            ingester.wav_file_to_mel_spectrogram(args.path, audio_processor, storage, plotter, args.hash)
     elif os.path.isdir(args.path):
-        ingester.process_directory(args.path, audio_processor, storage, plotter)
+        ingester.process_directory(
+            args.path, audio_processor, storage, plotter, args.workers,
+            incremental=not args.full, content_hash=args.hash, prune=not args.no_prune
+        )
     else:
         raise ValueError("The provided path is neither a file nor a directory.")
 
+    # Append the new records to the search feature matrices
+    FeatureMatrix(storage.feature_matrix_path).sync(storage)
+    storage.backfill_embeddings(audio_processor.spectrogram_embedding)
+    FeatureMatrix(storage.embedding_matrix_path, source='embedding').sync(storage)
+
+    # Label new records in a clustered catalogue, reclustering once it has drifted
+    clusters = DataClusterer(storage=storage).update_clusters(recluster=not args.no_recluster)
+    if clusters is not None:
+        print(f"Clusters: {clusters['assigned']} records labelled, {clusters['new_fraction']:.1%} new since last fit, "
+              f"distance ratio {clusters['distance_ratio']:.2f}{', reclustered' if clusters['reclustered'] else ''}")
+
     storage.close()
     print("Done")
 
@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from Metrics import add_metrics_arguments, instrument_script
+from AudioProcessor import AudioProcessor
+from SpectrogramStorage import SpectrogramStorage
+from DataClusterer import DataClusterer
+
+def main():
+    parser = argparse.ArgumentParser(description="Find where a short WAV sample occurs inside the catalogued recordings.")
+    parser.add_argument("wav_path", help="Path to the WAV sample to locate.")
+    parser.add_argument("--window_length", type=int, default=config.FFT_WINDOW_SIZE, help="FFT window length.")
+    parser.add_argument("--step_size", type=int, default=config.FFT_STEP_SIZE, help="Step size for FFT.")
+    parser.add_argument("--n_filters", type=int, default=config.FFT_N_FILTERS, help="Number of Mel filters.")
+    parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to search.")
+    parser.add_argument("--num_matches", type=int, default=config.NUM_MATCHES, help="Number of hits to report.")
+    parser.add_argument("--raw", action="store_true", help="Compare raw levels instead of z-normalised windows.")
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args()
+    instrument_script(args)
+
+    if not os.path.exists(args.wav_path):
+        raise FileNotFoundError(f"File not found: {args.wav_path}")
+
+    audio_processor = AudioProcessor(args.window_length, args.step_size, args.n_filters)
+    storage = SpectrogramStorage(args.db)
+    clusterer = DataClusterer(storage=storage)
+
+    target_spectrogram = audio_processor.wav_file_to_mel_spectrogram(args.wav_path)
+    ids, offsets, distances = clusterer.find_segments_in_db(target_spectrogram, args.num_matches, normalize=not args.raw)
+    filenames = storage.fetch_filenames(ids)
+
+    for rank, (record_id, offset, distance) in enumerate(zip(ids, offsets, distances), start=1):
+        filename = filenames.get(record_id)
+        try:
+            seconds = f"{offset * args.step_size / audio_processor.probe_wav(filename)['samplerate']:.3f}s"
+        except (OSError, RuntimeError, TypeError):
+            # The recording has moved since it was catalogued: report the frame only
+            seconds = "?"
+        print(f"{rank}. id {record_id} at frame {offset} ({seconds}), distance {distance:.4g}: {filename}")
+
+    storage.close()
+
+if __name__ == "__main__":
+    main()
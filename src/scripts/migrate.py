@@ -0,0 +1,39 @@
+import argparse
+import os
+import sys
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from SpectrogramStorage import SpectrogramStorage
+from AudioProcessor import AudioProcessor
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert stored spectrograms to the current storage format.")
+    parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to migrate.")
+    parser.add_argument("--batch_size", type=int, default=config.DB_BATCH_SIZE, help="Rows re-encoded per transaction.")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the database afterwards to reclaim the freed space.")
+
+    args = parser.parse_args()
+
+    # Opening the storage adds any missing columns to the table
+    storage = SpectrogramStorage(args.db)
+
+    migrated, conflicts = storage.migrate_spectrogram_format(args.batch_size)
+    print(f"Migrated {migrated} spectrograms")
+    if conflicts:
+        print(f"Warning: {conflicts} spectrograms clashed with an existing spectrogram hash and were left in the old format")
+
+    filled = storage.backfill_embeddings(AudioProcessor.spectrogram_embedding, args.batch_size)
+    print(f"Computed {filled} missing embeddings")
+
+    if args.vacuum:
+        print("Vacuuming")
+        storage.conn.execute("VACUUM")
+
+    storage.close()
+    print("Done")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import sys
+
+# Only the standard library: the client must start instantly. Defaults mirror Config.
+DEFAULT_HOST = os.getenv('LEE_SERVICE_HOST', '127.0.0.1')
+DEFAULT_PORT = int(os.getenv('LEE_SERVICE_PORT', 8765))
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def request(args, method, path, payload=None):
+    """Send one JSON request to the search service and return the decoded response."""
+    if args.socket:
+        conn = UnixHTTPConnection(args.socket, timeout=args.timeout)
+    else:
+        conn = http.client.HTTPConnection(args.host, args.port, timeout=args.timeout)
+    try:
+        body = json.dumps(payload).encode() if payload is not None else None
+        conn.request(method, path, body, {'Content-Type': 'application/json'} if body else {})
+        response = conn.getresponse()
+        result = json.loads(response.read() or b'{}')
+    finally:
+        conn.close()
+    if response.status != 200:
+        sys.exit(f"Error {response.status}: {result.get('error')}")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a running search service (see serve.py).")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Service address.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Service TCP port.")
+    parser.add_argument("--socket", help="Service Unix socket, instead of host and port.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for a response.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    match = commands.add_parser("match", help="Closest matches for one or more WAV files, as JSON Lines.")
+    match.add_argument("wav_paths", nargs="+", help="Query WAV files.")
+    match.add_argument("--num_matches", type=int, default=5, help="Number of closest matches to find.")
+    match.add_argument("--index", choices=["brute", "tree", "ivf"], help="Search index (default: the service's).")
+    match.add_argument("--mode", choices=["spectrogram", "embedding", "dtw", "xcorr"], help="Search mode (default: the service's).")
+
+    notify = commands.add_parser("notify", help="Tell the service the catalogue changed, optionally ingesting files first.")
+    notify.add_argument("paths", nargs="*", help="WAV files or directories for the service to ingest.")
+
+    commands.add_parser("status", help="Show what the service has loaded.")
+
+    args = parser.parse_args()
+
+    # The service resolves paths from its own working directory
+    if args.command == "match":
+        result = request(args, "POST", "/match", {
+            'paths': [os.path.abspath(path) for path in args.wav_paths],
+            'num_matches': args.num_matches, 'mode': args.mode, 'index': args.index,
+        })
+        for line in result['results']:
+            print(json.dumps(line))
+    elif args.command == "notify":
+        print(json.dumps(request(args, "POST", "/notify", {'paths': [os.path.abspath(path) for path in args.paths]}), indent=2))
+    else:
+        print(json.dumps(request(args, "GET", "/status"), indent=2))
+
+if __name__ == "__main__":
+    main()
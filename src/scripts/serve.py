@@ -0,0 +1,55 @@
+import argparse
+import os
+import signal
+import sys
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from AudioProcessor import AudioProcessor
+from SearchService import SearchService, make_server
+from Metrics import metrics
+
+def stop(signum, frame):
+    # Shut down as cleanly on SIGTERM as on Ctrl-C
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve closest-match searches from a warm, long-running process.")
+    parser.add_argument("--window_length", type=int, default=config.FFT_WINDOW_SIZE, help="FFT window length.")
+    parser.add_argument("--step_size", type=int, default=config.FFT_STEP_SIZE, help="Step size for FFT.")
+    parser.add_argument("--n_filters", type=int, default=config.FFT_N_FILTERS, help="Number of Mel filters.")
+    parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file to search.")
+    parser.add_argument("--host", default=config.SERVICE_HOST, help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=config.SERVICE_PORT, help="TCP port to listen on.")
+    parser.add_argument("--socket", help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="Feature extraction processes for batch requests and ingest (0 for one per CPU).")
+    parser.add_argument("--index", choices=["brute", "tree", "ivf"], default=config.SEARCH_INDEX, help="Default search index, loaded at startup.")
+    parser.add_argument("--mode", choices=["spectrogram", "embedding", "dtw", "xcorr"], default=config.SEARCH_MODE, help="Default search mode.")
+    parser.add_argument("--metrics", action="store_true", help="Collect per-stage timings and counters, served at GET /metrics.")
+
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+
+    audio_processor = AudioProcessor(args.window_length, args.step_size, args.n_filters)
+    service = SearchService(audio_processor, args.db, args.mode, args.index, args.workers)
+    print("Loading the catalogue")
+    service.warm()
+
+    server = make_server(service, args.host, args.port, args.socket)
+    signal.signal(signal.SIGTERM, stop)
+    print(f"Listening on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        service.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+import argparse
+import os
+import sys
+
+# Dynamically add 'src' to the module search path
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from Config import config
+from SpectrogramStorage import SpectrogramStorage
+from ThumbnailCache import ThumbnailCache
+
+def main():
+    parser = argparse.ArgumentParser(description="Render missing or outdated spectrogram thumbnails for the whole catalogue.")
+    parser.add_argument("--db", default=config.DB_FILE, help="SQLite database file.")
+    parser.add_argument("--dir", help="Thumbnail directory (default: THUMBNAIL_DIR, or next to the database).")
+    parser.add_argument("--width", type=int, default=config.PLOT_SIZE[0], help="Thumbnail width in pixels.")
+    parser.add_argument("--height", type=int, default=config.PLOT_SIZE[1], help="Thumbnail height in pixels.")
+    parser.add_argument("--workers", type=int, default=config.INGEST_WORKERS, help="Rendering threads (0 for one per CPU).")
+
+    args = parser.parse_args()
+
+    storage = SpectrogramStorage(args.db)
+    thumbnails = ThumbnailCache(args.dir or storage.thumbnail_dir, (args.width, args.height))
+    rendered = thumbnails.render_missing(storage, args.workers)
+    print(f"Rendered {rendered} thumbnails into {thumbnails.directory}")
+
+    storage.close()
+
+if __name__ == "__main__":
+    main()
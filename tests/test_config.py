@@ -0,0 +1,16 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Config import Config
+
+def test_environment_overrides_are_cast(monkeypatch):
+    monkeypatch.setenv('LEE_TEST_INT', '12')
+    monkeypatch.setenv('LEE_TEST_FLOAT', '0.25')
+    monkeypatch.setenv('LEE_TEST_STR', 'mel_spectrograms')
+
+    assert Config._get_env_var('LEE_TEST_INT', 0) == 12
+    assert Config._get_env_var('LEE_TEST_FLOAT', 0.5) == 0.25
+    assert Config._get_env_var('LEE_TEST_STR', '') == 'mel_spectrograms'
+    assert Config._get_env_var('LEE_TEST_UNSET', 0.5) == 0.5
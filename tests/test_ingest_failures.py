@@ -0,0 +1,33 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from AudioProcessor import AudioProcessor
+from Ingester import Ingester
+from SpectrogramStorage import SpectrogramStorage
+from SyntheticCorpus import write_wav
+
+@pytest.fixture
+def corpus(tmp_path):
+    directory = tmp_path / 'corpus'
+    directory.mkdir()
+    t = np.arange(22050) / 22050
+    for index, frequency in enumerate((220, 440, 880)):
+        write_wav(str(directory / f"{index}.wav"), np.sin(2 * np.pi * frequency * t)[:, None] * 0.5, 22050)
+    (directory / 'broken.wav').write_bytes(b'not a wav file')
+    return directory
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_unreadable_file_fails_alone(corpus, tmp_path, workers):
+    storage = SpectrogramStorage(str(tmp_path / f"workers{workers}.sqlite3"))
+    try:
+        stats, failures = Ingester().process_directory(str(corpus), AudioProcessor(), storage, None, workers)
+    finally:
+        storage.close()
+
+    assert stats['inserted'] == 3
+    assert [os.path.basename(path) for path, _ in failures] == ['broken.wav']
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'scripts'))
+
+from check_startup import BUDGET_MS, DEFERRED_MODULES, ENTRY_POINTS, measure_import
+
+@pytest.mark.parametrize("module", ENTRY_POINTS)
+def test_entry_point_starts_without_heavy_libraries(module):
+    milliseconds, packages, error = measure_import(module)
+    if error is not None and error.startswith("SyntaxError") and sys.version_info < (3, 12):
+        pytest.skip("the scripts need Python 3.12")
+
+    assert error is None
+    assert sorted(packages.intersection(DEFERRED_MODULES)) == []
+    assert milliseconds <= BUDGET_MS
@@ -0,0 +1,90 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from Config import config
+from SpectrogramStorage import SpectrogramStorage
+from Ingester import Ingester
+
+FEATURE_CONFIG = 'test'
+
+def spectrogram(seed):
+    return np.random.default_rng(seed).random((20, 8), dtype=np.float32)
+
+def audio_file(directory, name, size=100):
+    path = str(directory / name)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return path
+
+def record(path, mel_spectrogram):
+    return mel_spectrogram, path, Ingester.file_fingerprint(path, FEATURE_CONFIG), None
+
+def ids_by_filename(storage):
+    rows = storage.conn.execute(f"SELECT filename, id FROM {config.TABLE_SEPECTROGRAMS}").fetchall()
+    return dict(rows)
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = SpectrogramStorage(str(tmp_path / 'test.sqlite3'))
+    yield storage
+    storage.close()
+
+def test_replace_supersedes_changed_file(storage, tmp_path):
+    a = audio_file(tmp_path, 'a.wav')
+    storage.save_many([record(a, spectrogram(0))], replace=True)
+    old_id = ids_by_filename(storage)[a]
+
+    a = audio_file(tmp_path, 'a.wav', size=200)
+    stats = storage.save_many([record(a, spectrogram(1))], replace=True)
+
+    assert stats['inserted'] == 1 and stats['replaced'] == 1
+    assert ids_by_filename(storage)[a] != old_id
+    assert storage.fetch_fingerprints()[a]['file_size'] == 200
+
+def test_replace_colliding_with_another_record_keeps_the_old_one(storage, tmp_path):
+    a = audio_file(tmp_path, 'a.wav')
+    b = audio_file(tmp_path, 'b.wav')
+    storage.save_many([record(a, spectrogram(0)), record(b, spectrogram(1))], replace=True)
+    before = ids_by_filename(storage)
+
+    # a now has the same audio as b: its new row would be ignored, so its record must stay
+    a = audio_file(tmp_path, 'a.wav', size=200)
+    stats = storage.save_many([record(a, spectrogram(1))], replace=True)
+
+    assert stats == {'inserted': 0, 'replaced': 0, 'duplicates': 1, 'skipped': 0}
+    assert ids_by_filename(storage) == before
+    # Its current state is known, so the next incremental ingest skips it
+    assert storage.fetch_fingerprints()[a]['file_size'] == 200
+    assert Ingester().plan_incremental([a, b], storage, FEATURE_CONFIG) == []
+
+def test_duplicates_within_a_batch_keep_their_records(storage, tmp_path):
+    a = audio_file(tmp_path, 'a.wav')
+    b = audio_file(tmp_path, 'b.wav')
+    storage.save_many([record(a, spectrogram(0)), record(b, spectrogram(1))], replace=True)
+
+    a = audio_file(tmp_path, 'a.wav', size=200)
+    b = audio_file(tmp_path, 'b.wav', size=200)
+    stats = storage.save_many([record(a, spectrogram(2)), record(b, spectrogram(2))], replace=True)
+
+    assert stats['inserted'] == 1 and stats['duplicates'] == 1
+    assert set(ids_by_filename(storage)) == {a, b}
+
+def test_new_duplicate_file_is_skipped_until_its_original_goes(storage, tmp_path):
+    a = audio_file(tmp_path, 'a.wav')
+    c = audio_file(tmp_path, 'c.wav')
+    storage.save_many([record(a, spectrogram(0)), record(c, spectrogram(0))], replace=True)
+
+    assert c not in ids_by_filename(storage)
+    assert Ingester().plan_incremental([a, c], storage, FEATURE_CONFIG) == []
+
+    # Without the record it duplicates, it needs one of its own
+    storage.delete_filenames([a])
+    assert Ingester().plan_incremental([c], storage, FEATURE_CONFIG) == [c]
+    stats = storage.save_many([record(c, spectrogram(0))], replace=True)
+    assert stats['inserted'] == 1
+    assert c in ids_by_filename(storage)